@@ -0,0 +1,262 @@
+import gzip
+import hashlib
+import json
+from datetime import date, datetime
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request, stream_with_context, url_for
+from sqlalchemy import select
+
+from cache import page_cache
+from models import db, Venue, Artist, Show
+from replicas import replicas
+from schedule import SCHEDULE_COLUMNS, batches, range_filters, schedule
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# ----------------------------------------------------------------------------#
+# JSON API.
+#
+# Rows are selected as plain column tuples and serialized without loading ORM
+# objects. Listings are keyset paginated on id and kept in the page cache;
+# every response carries a strong ETag (plus Last-Modified for single
+# venues/artists) so unchanged resources come back as 304 Not Modified.
+# ----------------------------------------------------------------------------#
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+VENUE_COLUMNS = (Venue.id, Venue.name, Venue.city, Venue.state, Venue.address, Venue.phone, Venue.genres,
+                 Venue.image_link, Venue.facebook_link, Venue.website, Venue.seeking_talent, Venue.latitude,
+                 Venue.longitude)
+ARTIST_COLUMNS = (Artist.id, Artist.name, Artist.city, Artist.state, Artist.phone, Artist.genres,
+                  Artist.image_link, Artist.facebook_link, Artist.website, Artist.seeking_venue,
+                  Artist.seeking_description)
+SHOW_COLUMNS = (Show.id, Show.venue_id, Show.artist_id, Show.start_time)
+
+# responses smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 500
+
+
+def default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def dumps(payload):
+    return json.dumps(payload, default=default, separators=(',', ':'))
+
+
+def serialize(columns, rows):
+    keys = [column.key for column in columns]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def json_response(body, last_modified=None):
+    response = Response(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body.encode('utf-8')).hexdigest())
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response.make_conditional(request)
+
+
+def page_size():
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int)
+    if limit < 1:
+        abort(400)
+    return min(limit, current_app.config['API_MAX_PAGE_SIZE'])
+
+
+def listing_statement(statement):
+    """Limit a select of columns starting with the id to the requested keyset page (plus one row)."""
+    model_id = statement.selected_columns[0]
+    after = request.args.get('after', type=int)
+    if after is not None:
+        statement = statement.where(model_id > after)
+    return statement.order_by(model_id).limit(page_size() + 1)
+
+
+def listing(name, columns, rows):
+    """Serialize one keyset page of rows selected by listing_statement() under the given name."""
+    limit = page_size()
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        args = request.args.to_dict()
+        args.update(after=rows[-1][0], limit=limit)
+        next_url = url_for(request.endpoint, **args)
+    return dumps({
+        'success': True,
+        name: serialize(columns, rows),
+        'next': next_url
+    })
+
+
+# Statements and responses are shared with the async views of asgi.py, which only swap in an async connection.
+
+def venues_statement():
+    statement = select(*VENUE_COLUMNS)
+    if request.args.get('state'):
+        statement = statement.where(Venue.state == request.args['state'])
+    if request.args.get('genre'):
+        statement = statement.where(Venue.genres.contains([request.args['genre']]))
+    return listing_statement(statement)
+
+
+def venue_statement(venue_id):
+    return select(Venue.updated_at, *VENUE_COLUMNS).where(Venue.id == venue_id)
+
+
+def venue_response(row):
+    if row is None:
+        abort(404)
+    return json_response(dumps({
+        'success': True,
+        'venue': serialize(VENUE_COLUMNS, [row[1:]])[0]
+    }), last_modified=row[0])
+
+
+def artists_statement():
+    statement = select(*ARTIST_COLUMNS)
+    if request.args.get('state'):
+        statement = statement.where(Artist.state == request.args['state'])
+    if request.args.get('genre'):
+        statement = statement.where(Artist.genres.contains([request.args['genre']]))
+    return listing_statement(statement)
+
+
+def artist_statement(artist_id):
+    return select(Artist.updated_at, *ARTIST_COLUMNS).where(Artist.id == artist_id)
+
+
+def artist_response(row):
+    if row is None:
+        abort(404)
+    return json_response(dumps({
+        'success': True,
+        'artist': serialize(ARTIST_COLUMNS, [row[1:]])[0]
+    }), last_modified=row[0])
+
+
+def shows_statement():
+    statement = select(*SHOW_COLUMNS)
+    if request.args.get('venue_id'):
+        statement = statement.where(Show.venue_id == request.args.get('venue_id', type=int))
+    if request.args.get('artist_id'):
+        statement = statement.where(Show.artist_id == request.args.get('artist_id', type=int))
+    return listing_statement(statement)
+
+
+#  Venues
+#  ----------------------------------------------------------------
+
+@api.route('/venues')
+@replicas.reads
+def get_venues():
+    return json_response(venues_page())
+
+
+@page_cache.cached('venues')
+def venues_page():
+    return listing('venues', VENUE_COLUMNS, db.session.execute(venues_statement()).all())
+
+
+@api.route('/venues/<int:venue_id>')
+@replicas.reads
+def get_venue(venue_id):
+    return venue_response(db.session.execute(venue_statement(venue_id)).first())
+
+
+#  Artists
+#  ----------------------------------------------------------------
+
+@api.route('/artists')
+@replicas.reads
+def get_artists():
+    return json_response(artists_page())
+
+
+@page_cache.cached('artists')
+def artists_page():
+    return listing('artists', ARTIST_COLUMNS, db.session.execute(artists_statement()).all())
+
+
+@api.route('/artists/<int:artist_id>')
+@replicas.reads
+def get_artist(artist_id):
+    return artist_response(db.session.execute(artist_statement(artist_id)).first())
+
+
+#  Shows
+#  ----------------------------------------------------------------
+
+@api.route('/shows')
+@replicas.reads
+def get_shows():
+    return json_response(shows_page())
+
+
+@page_cache.cached('shows')
+def shows_page():
+    return listing('shows', SHOW_COLUMNS, db.session.execute(shows_statement()).all())
+
+
+@api.route('/calendar')
+@replicas.reads
+def get_calendar():
+    # every show in ?from= ... ?to= at ?city=/?state= of ?genre=, in start time order, streamed as it's read
+    statement = schedule(**range_filters())
+
+    def generate():
+        yield '{"success":true,"shows":['
+        separator = ''
+        for rows in batches(statement):
+            yield separator + ','.join(dumps(show) for show in serialize(SCHEDULE_COLUMNS, rows))
+            separator = ','
+        yield ']}'
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+#  Compression and errors
+#  ----------------------------------------------------------------
+
+@api.after_request
+def compress(response):
+    accepted = request.accept_encodings
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or len(response.get_data()) < MIN_COMPRESS_SIZE):
+        return response
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(response.get_data()))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    response.vary.add('Accept-Encoding')
+    # the ETag identifies the uncompressed representation
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+@api.errorhandler(400)
+def bad_request(error):
+    return jsonify({
+        "success": False,
+        "error": 400,
+        "message": "bad request"
+    }), 400
+
+
+@api.errorhandler(404)
+def not_found(error):
+    return jsonify({
+        "success": False,
+        "error": 404,
+        "message": "resource not found"
+    }), 404
@@ -2,15 +2,40 @@
 # Imports
 # ----------------------------------------------------------------------------#
 
+import functools
+import os
+from datetime import datetime, timedelta
+import click
 import dateutil.parser
 import babel
-from flask import Flask, render_template, request, flash, redirect, url_for
+import babel.dates
+from flask import Flask, Response, render_template, request, flash, redirect, url_for, abort, jsonify, \
+    stream_with_context
 from flask_moment import Moment
+from jinja2 import FileSystemBytecodeCache
 import logging
 from logging import Formatter, FileHandler
 from flask_migrate import Migrate
 from forms import *
 from models import db, Artist, Venue, Show
+from search import search, complete, clear_indexes
+import cache
+from cache import page_cache
+import summaries
+import availability
+import facets
+import geo
+import deletion
+import export
+import outbox
+import readmodel
+import schedule
+import importer
+import seed
+from api import api
+from metrics import metrics
+from replicas import replicas
+from writebehind import write_behind
 
 # ----------------------------------------------------------------------------#
 # App Config.
@@ -21,23 +46,49 @@ moment = Moment(app)
 app.config.from_object('config')
 db.init_app(app)
 migrate = Migrate(app, db)
+page_cache.init_app(app)
+app.register_blueprint(api)
+metrics.init_app(app)
+replicas.init_app(app)
+write_behind.init_app(app)
 
 
 # ----------------------------------------------------------------------------#
 # Filters.
 # ----------------------------------------------------------------------------#
 
-def format_datetime(value, format='medium'):
-    date = dateutil.parser.parse(value)
-    if format == 'full':
-        format = "EEEE MMMM, d, y 'at' h:mma"
-    elif format == 'medium':
-        format = "EE MM, dd, y h:mma"
-    return babel.dates.format_datetime(date, format)
+DATETIME_FORMATS = {
+    'full': "EEEE MMMM, d, y 'at' h:mma",
+    'medium': "EE MM, dd, y h:mma",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def datetime_pattern(format, locale):
+    # parses the locale and the (named or raw) Babel pattern once per combination
+    return babel.Locale.parse(locale), babel.dates.parse_pattern(DATETIME_FORMATS.get(format, format))
+
+
+@functools.lru_cache(maxsize=4096)
+def format_datetime(value, format='medium', locale=babel.dates.LC_TIME):
+    if isinstance(value, str):
+        value = dateutil.parser.parse(value)
+    locale, pattern = datetime_pattern(format, locale)
+    return pattern.apply(value, locale)
 
 
 app.jinja_env.filters['datetime'] = format_datetime
 
+# compile every template at startup rather than on the first request rendering it; with TEMPLATE_CACHE_DIR set
+# the compiled code is kept on disk, so restarted and new workers load it instead of compiling again.
+# It also depends on the {% cache %} tag, hence the version of cache.py in the file names
+if app.config['TEMPLATE_CACHE_DIR']:
+    os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+        app.config['TEMPLATE_CACHE_DIR'], '__jinja2_%s_{:x}.cache'.format(int(os.path.getmtime(cache.__file__))))
+for template_name in app.jinja_env.list_templates(extensions=['html']):
+    app.jinja_env.get_template(template_name)
+
 
 # ----------------------------------------------------------------------------#
 # Controllers.
@@ -52,124 +103,179 @@ def index():
 #  ----------------------------------------------------------------
 
 @app.route('/venues')
+@replicas.reads
+@page_cache.cached('venues')
 def venues():
     try:
-        data = []
-        # venue_list = Venue.query.outerjoin(Show, Show.venue_id == Venue.id) \
-        #     .add_columns(Venue.id, Venue.city, Venue.state, Venue.name, Show.start_time, Show.artist_id) \
-        #     .all()
-        venue_list = Venue.query.group_by(Venue.id, Venue.state, Venue.city) \
-            .add_columns(Venue.id, Venue.city, Venue.state, Venue.name) \
-            .all()
-        venue_state_and_city = ''
-        for venue in venue_list:
-            upcoming_shows = Show.query.filter(venue.id == Show.venue_id, Show.start_time > datetime.utcnow()) \
-                .count()
-
-            if venue_state_and_city == venue.city + venue.state:
-                data[len(data) - 1]["venues"].append({
+        venue_list = db.session.execute(venue_list_statement()).all()
+        return venues_page(venue_list, facets.facet_counts(Venue, **listing_filters()))
+    except:
+        return venues_unavailable()
+
+
+# Statements and pages of the listings and detail pages are shared with the async views of asgi.py, which only
+# swap in an async connection.
+
+def venue_list_statement():
+    return filtered(db.select(Venue.id, Venue.city, Venue.state, Venue.name,
+                              Venue.upcoming_shows_count.label('num_upcoming_shows')), Venue, listing_filters()) \
+        .order_by(Venue.state, Venue.city, Venue.id)
+
+
+def venues_page(venue_list, facet_counts):
+    data = []
+    page_cache.prefetch(['venue:{}'.format(venue.id) for venue in venue_list])
+    venue_state_and_city = ''
+    for venue in venue_list:
+        if venue_state_and_city == venue.city + venue.state:
+            data[len(data) - 1]["venues"].append({
+                "id": venue.id,
+                "name": venue.name,
+                "num_upcoming_shows": venue.num_upcoming_shows
+            })
+        else:
+            venue_state_and_city = venue.city + venue.state
+            data.append({
+                "city": venue.city,
+                "state": venue.state,
+                "venues": [{
                     "id": venue.id,
                     "name": venue.name,
-                    "num_upcoming_shows": upcoming_shows
-                })
-            else:
-                venue_state_and_city = venue.city + venue.state
-                data.append({
-                    "city": venue.city,
-                    "state": venue.state,
-                    "venues": [{
-                        "id": venue.id,
-                        "name": venue.name,
-                        "num_upcoming_shows": upcoming_shows
-                    }]
-                })
-        if data:
-            return render_template('pages/venues.html', areas=data)
-        else:
-            return render_template('errors/no_item.html', message="No Venues found")
-    except:
-        flash('An error occurred. No venues to display currently')
-        return redirect(url_for('index'))
+                    "num_upcoming_shows": venue.num_upcoming_shows
+                }]
+            })
+    if data:
+        filters = listing_filters()
+        return render_template('pages/venues.html', areas=data, filters=filters,
+                               facets=facet_links(filters, facet_counts))
+    else:
+        return render_template('errors/no_item.html', message="No Venues found")
+
+
+def venues_unavailable():
+    flash('An error occurred. No venues to display currently')
+    return redirect(url_for('index'))
+
+
+def listing_filters():
+    # ?genre=, ?state= and ?city= of the venue and artist listings
+    return {field: request.args[field] for field in ('genre', 'state', 'city') if request.args.get(field)}
+
+
+def facet_links(filters, facet_counts):
+    # [(value, count, url)] per facet of the listing sidebar, url None for the selected value
+    links = {}
+    for field, counts in facet_counts.items():
+        links[field] = []
+        for value, count in counts:
+            args = dict(filters, **{field: value})
+            if field == 'state':
+                args.pop('city', None)
+            url = None if filters.get(field) == value else url_for(request.endpoint, **args)
+            links[field].append((value, count, url))
+    return links
+
+
+def filtered(query, model, filters):
+    if 'genre' in filters:
+        # @> so the GIN index on genres is used
+        query = query.filter(model.genres.contains([filters['genre']]))
+    if 'state' in filters:
+        query = query.filter(model.state == filters['state'])
+    if 'city' in filters:
+        query = query.filter(model.city == filters['city'])
+    return query
 
 
 @app.route('/venues/search', methods=['POST'])
+@replicas.reads
 def search_venues():
     # search for Hop should return "The Musical Hop".
     # search for "Music" should return "The Musical Hop" and "Park Square Live Music & Coffee"
-    search_term = request.form.get('search_term')
-    venue_list = Venue.query.filter(Venue.name.ilike(f'%{search_term}%')).all();
+    search_term = request.form.get('search_term', '')
+    page = max(request.form.get('page', 1, type=int), 1)
+    per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+    count, data = search(Venue, search_term, page, per_page, app.config['SEARCH_MAX_MATCHES'])
+    return search_results('pages/search_venues.html', search_term, page, count, data)
 
-    data = list(map(Venue.get_venue_id_name, venue_list))
+
+def search_results(template, search_term, page, count, data):
+    per_page, most = app.config['SEARCH_RESULTS_PER_PAGE'], app.config['SEARCH_MAX_MATCHES']
     response = {
-        "count": len(venue_list),
-        "data": data
+        "count": count if count <= most else '{}+'.format(most),
+        "data": data,
+        # beyond the cap only the matches with the lowest ids are ranked
+        "ranked": most if count > most else None
     }
-    return render_template('pages/search_venues.html', results=response,
-                           search_term=request.form.get('search_term', ''))
+    return render_template(template, results=response, search_term=search_term,
+                           page=page, pages=(min(count, most) + per_page - 1) // per_page)
+
+
+@app.route('/venues/autocomplete')
+@replicas.reads
+def autocomplete_venues():
+    # names completing ?q= for the venue picker of the new show form
+    limit = min(request.args.get('limit', app.config['AUTOCOMPLETE_LIMIT'], type=int), 50)
+    return jsonify({
+        'success': True,
+        'venues': complete(Venue, request.args.get('q', ''), max(limit, 1))
+    })
+
+
+@app.route('/venues/nearby')
+@replicas.reads
+def nearby_venues():
+    # venues within ?radius= km (default 10) of ?lat= ?lng=, nearest first
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lng', type=float)
+    radius = request.args.get('radius', 10.0, type=float)
+    limit = min(request.args.get('limit', app.config['NEARBY_LIMIT'], type=int), app.config['NEARBY_MAX_LIMIT'])
+    if latitude is None or longitude is None or not -90 <= latitude <= 90 or not -180 <= longitude <= 180 \
+            or not 0 < radius <= app.config['NEARBY_MAX_RADIUS'] or limit < 1:
+        abort(400)
+    return jsonify({
+        'success': True,
+        'venues': [{
+            'id': venue.id,
+            'name': venue.name,
+            'address': venue.address,
+            'city': venue.city,
+            'state': venue.state,
+            'latitude': venue.latitude,
+            'longitude': venue.longitude,
+            'distance_km': round(distance, 3)
+        } for distance, venue in geo.nearby(latitude, longitude, radius, limit)]
+    })
 
 
 @app.route('/venues/<int:venue_id>')
+@replicas.reads
+@page_cache.cached('venue:{venue_id}')
 def show_venue(venue_id):
-    seeking_description = ''
-    past_show_count = 0
-    upcoming_show_count = 0
-    show_list = Show.query.filter_by(venue_id=venue_id) \
-        .order_by(db.desc(Show.start_time)) \
-        .all()
-
-    # shows the venue page with the given venue_id
-    if len(show_list):
-        if show_list[0].venues.seeking_talent:
-            seeking_description = "We are on the lookout for a local artist to play every two weeks. Please call us."
-        data = fill_data(show_list[0].venues, seeking_description)
-
-        for show in show_list:
-            if show.start_time < datetime.utcnow():
-                past_show_count = past_show_count + 1
-                data["past_shows"].append({
-                    "artist_id": show.artist_id,
-                    "artist_name": show.artists.name,
-                    "artist_image_link": show.artists.image_link,
-                    "start_time": format_datetime(str(show.start_time))
-                })
-            else:
-                upcoming_show_count = upcoming_show_count + 1
-                data["upcoming_shows"].append({
-                    "artist_id": show.artist_id,
-                    "artist_name": show.artists.name,
-                    "artist_image_link": show.artists.image_link,
-                    "start_time": format_datetime(str(show.start_time))
-                })
-        data['past_shows_count'] = past_show_count
-        data['upcoming_shows_count'] = upcoming_show_count
-        data["id"] = venue_id
-    else:
-        venue = Venue.query.filter_by(id=venue_id).first()
-        if venue.seeking_talent:
-            seeking_description = "We are on the lookout for a local artist to play every two weeks. Please call us."
-        data = fill_data(venue, seeking_description)
-        data["id"] = venue_id
+    # shows the venue page with the given venue_id, read from its document
+    return venue_page(readmodel.document(Venue, venue_id))
+
+
+def venue_page(data):
+    if data is None:
+        abort(404)
     return render_template('pages/show_venue.html', venue=data)
 
 
-def fill_data(obj, seeking_description):
-    return {
-        "name": obj.name,
-        "genres": obj.genres,
-        "address": obj.address,
-        "city": obj.city,
-        "state": obj.state,
-        "phone": obj.phone,
-        "website": obj.website,
-        "facebook_link": obj.facebook_link,
-        "seeking_talent": obj.seeking_talent,
-        "seeking_description": seeking_description,
-        "image_link": obj.image_link,
-        "past_shows": [],
-        "upcoming_shows": [],
-        "past_shows_count": 0,
-        "upcoming_shows_count": 0,
-    }
+@app.route('/venues/<int:venue_id>/shows.ics')
+@replicas.reads
+def venue_calendar(venue_id):
+    # the venue's shows (within ?from= ... ?to=) as an iCalendar feed, written while it's read from the database
+    name = db.session.query(Venue.name).filter(Venue.id == venue_id).scalar()
+    if name is None:
+        abort(404)
+    return calendar_response(name, schedule.schedule(venue_id=venue_id, **schedule.range_filters()))
+
+
+def calendar_response(name, statement):
+    response = Response(stream_with_context(schedule.ical(name, statement)), mimetype='text/calendar')
+    response.headers['Content-Disposition'] = 'inline; filename=shows.ics'
+    return response
 
 
 #  Create Venue
@@ -185,14 +291,13 @@ def create_venue_form():
 def create_venue_submission():
     try:
         form = VenueForm()
-        venue = Venue(name=form.name.data, city=form.city.data, state=form.state.data, address=form.address.data,
-                      phone=form.phone.data, image_link=form.image_link.data, genres=form.genres.data,
-                      facebook_link=form.facebook_link.data, website=form.website.data,
-                      seeking_talent=bool(form.seeking_talent.data))
-
-        db.session.add(venue)
-        db.session.commit()
-        flash('Venue ' + form.name.data + ' was successfully listed!')
+        if write_behind.enabled:
+            flash_queued('Venue ' + form.name.data, write_behind.submit(write_new_venue))
+        else:
+            venue_id, tags = write_new_venue(form)
+            db.session.commit()
+            page_cache.invalidate(*tags)
+            flash('Venue ' + form.name.data + ' was successfully listed!')
 
     except:
         db.session.rollback()
@@ -202,121 +307,167 @@ def create_venue_submission():
     return render_template('pages/home.html')
 
 
-@app.route('/venues/<venue_id>', methods=['DELETE'])
-def delete_venue(venue_id):
-    # SQLAlchemy ORM to delete a record. Handle cases where the session commit could fail.
+@write_behind.writer(VenueForm, url='/venues/{}')
+def write_new_venue(form):
+    venue = Venue(name=form.name.data, city=form.city.data, state=form.state.data, address=form.address.data,
+                  phone=form.phone.data, image_link=form.image_link.data, genres=form.genres.data,
+                  facebook_link=form.facebook_link.data, website=form.website.data,
+                  seeking_talent=bool(form.seeking_talent.data))
+    db.session.add(venue)
+    db.session.flush()
+    return venue.id, ['venues']
 
-    try:
-        # Get venue by ID
-        venue = Venue.query.get(venue_id)
-        venue_name = venue.name
 
-        db.session.delete(venue)
-        db.session.commit()
+def flash_queued(listing, ticket):
+    # the write-behind queue has the submission; the user can follow it at /submissions?id=<ticket>
+    flash('{} was received and will be saved in a moment. Check {} to see it landed.'.format(
+        listing, url_for('submissions', id=ticket)))
+
 
-        flash('Venue ' + venue_name + ' was deleted')
+@app.route('/venues/<int:venue_id>', methods=['DELETE'])
+def delete_venue(venue_id):
+    # deletes the venue together with its shows, one statement per table
+    try:
+        names, tags = deletion.delete_with_shows(Venue, [venue_id])
+        db.session.commit()
+        page_cache.invalidate(*tags)
+        flash('Venue ' + names[0] + ' was deleted' if names else 'Venue {} was not found'.format(venue_id))
     except:
-        flash('an error occured and Venue ' + venue_name + ' was not deleted')
         db.session.rollback()
+        flash('an error occured and Venue {} was not deleted'.format(venue_id))
     finally:
         db.session.close()
 
     return redirect(url_for('index'))
 
-    return None
+
+@app.route('/venues', methods=['DELETE'])
+def delete_venues():
+    return delete_many(Venue)
+
+
+def delete_many(model):
+    # bulk deletion of the venues/artists listed as {"ids": [...]} in the JSON body
+    ids = (request.get_json(silent=True) or {}).get('ids')
+    if not isinstance(ids, list) or not all(isinstance(id, int) for id in ids):
+        abort(400)
+    try:
+        names, tags = deletion.delete_with_shows(model, ids)
+        db.session.commit()
+        page_cache.invalidate(*tags)
+    except:
+        db.session.rollback()
+        app.logger.exception('%s %s could not be deleted', model.__tablename__, ids)
+        return jsonify({
+            'success': False,
+            'error': 500,
+            'message': 'an error occured and nothing was deleted'
+        }), 500
+    finally:
+        db.session.close()
+    return jsonify({
+        'success': True,
+        'deleted': len(names)
+    })
 
 
 #  Artists
 #  ----------------------------------------------------------------
 @app.route('/artists')
+@replicas.reads
+@page_cache.cached('artists')
 def artists():
+    artists_list = db.session.execute(artist_list_statement()).all()
+    return artists_page(artists_list, facets.facet_counts(Artist, **listing_filters()))
+
+
+def artist_list_statement():
+    return filtered(db.select(Artist.id, Artist.name), Artist, listing_filters()).order_by(Artist.id)
+
+
+def artists_page(artists_list, facet_counts):
     data = []
-    artists_list = Artist.query.add_columns(Artist.id, Artist.name).all()
+    page_cache.prefetch(['artist:{}'.format(artist.id) for artist in artists_list])
     for artist in artists_list:
         data.append({
             "id": artist.id,
             "name": artist.name
         })
     if data:
-        return render_template('pages/artists.html', artists=data)
+        filters = listing_filters()
+        return render_template('pages/artists.html', artists=data, filters=filters,
+                               facets=facet_links(filters, facet_counts))
     else:
         return render_template('errors/no_item.html', message="No Artists found")
 
 
 @app.route('/artists/search', methods=['POST'])
+@replicas.reads
 def search_artists():
     # search for "A" should return "Guns N Petals", "Matt Quevado", and "The Wild Sax Band".
     # search for "band" should return "The Wild Sax Band".
-    search_term = request.form.get('search_term')
-    artist_list = Artist.query.filter(Artist.name.ilike(f'%{search_term}%')).all()
+    search_term = request.form.get('search_term', '')
+    page = max(request.form.get('page', 1, type=int), 1)
+    per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+    count, data = search(Artist, search_term, page, per_page, app.config['SEARCH_MAX_MATCHES'])
+    return search_results('pages/search_artists.html', search_term, page, count, data)
 
-    data = list(map(Artist.get_artist_id_name, artist_list))
-    response = {
-        "count": len(artist_list),
-        "data": data
-    }
-    return render_template('pages/search_artists.html', results=response,
-                           search_term=request.form.get('search_term', ''))
+
+@app.route('/artists/autocomplete')
+@replicas.reads
+def autocomplete_artists():
+    # names completing ?q= for the artist picker of the new show form
+    limit = min(request.args.get('limit', app.config['AUTOCOMPLETE_LIMIT'], type=int), 50)
+    return jsonify({
+        'success': True,
+        'artists': complete(Artist, request.args.get('q', ''), max(limit, 1))
+    })
 
 
 @app.route('/artists/<int:artist_id>')
+@replicas.reads
+@page_cache.cached('artist:{artist_id}')
 def show_artist(artist_id):
-    past_show_count = 0
-    upcoming_show_count = 0
-    show_list = Show.query.filter_by(artist_id=artist_id) \
-        .order_by(db.desc(Show.start_time)) \
-        .all()
-
-    # shows the venue page with the given venue_id
-    if len(show_list):
-        data = fill_artist_data(show_list[0].artists)
-
-        for show in show_list:
-            if show.start_time < datetime.utcnow():
-                past_show_count = past_show_count + 1
-                data["past_shows"].append({
-                    "venue_id": show.venue_id,
-                    "venue_name": show.venues.name,
-                    "venue_image_link": show.venues.image_link,
-                    "start_time": format_datetime(str(show.start_time))
-                })
-            else:
-                upcoming_show_count = upcoming_show_count + 1
-                data["upcoming_shows"].append({
-                    "venue_id": show.venue_id,
-                    "venue_name": show.venues.name,
-                    "venue_image_link": show.venues.image_link,
-                    "start_time": format_datetime(str(show.start_time))
-                })
-        data['past_shows_count'] = past_show_count
-        data['upcoming_shows_count'] = upcoming_show_count
-        data["id"] = artist_id
-    else:
-        artist = Artist.query.filter_by(id=artist_id).first()
-        data = fill_artist_data(artist)
-        data["id"] = artist_id
+    # shows the artist page with the given artist_id, read from its document
+    return artist_page(readmodel.document(Artist, artist_id))
+
+
+def artist_page(data):
+    if data is None:
+        abort(404)
     return render_template('pages/show_artist.html', artist=data)
 
 
-def fill_artist_data(obj):
-    print(obj.seeking_venue)
-    return {
-        "name": obj.name,
-        "genres": obj.genres,
-        "city": obj.city,
-        "state": obj.state,
-        "phone": obj.phone,
-        "website": obj.website,
-        "facebook_link": obj.facebook_link,
-        "seeking_venue": obj.seeking_venue,
-        "seeking_description": obj.seeking_description,
-        "image_link": obj.image_link,
-        "past_shows": [],
-        "upcoming_shows": [],
-        "past_shows_count": 0,
-        "upcoming_shows_count": 0,
-    }
-    # shows the venue page with the given venue_id
+@app.route('/artists/<int:artist_id>/shows.ics')
+@replicas.reads
+def artist_calendar(artist_id):
+    # the artist's shows (within ?from= ... ?to=) as an iCalendar feed
+    name = db.session.query(Artist.name).filter(Artist.id == artist_id).scalar()
+    if name is None:
+        abort(404)
+    return calendar_response(name, schedule.schedule(artist_id=artist_id, **schedule.range_filters()))
+
+
+@app.route('/artists/<int:artist_id>', methods=['DELETE'])
+def delete_artist(artist_id):
+    # deletes the artist together with its shows, one statement per table
+    try:
+        names, tags = deletion.delete_with_shows(Artist, [artist_id])
+        db.session.commit()
+        page_cache.invalidate(*tags)
+        flash('Artist ' + names[0] + ' was deleted' if names else 'Artist {} was not found'.format(artist_id))
+    except:
+        db.session.rollback()
+        flash('an error occured and Artist {} was not deleted'.format(artist_id))
+    finally:
+        db.session.close()
+
+    return redirect(url_for('index'))
+
+
+@app.route('/artists', methods=['DELETE'])
+def delete_artists():
+    return delete_many(Artist)
 
 
 #  Update
@@ -347,24 +498,16 @@ def edit_artist_submission(artist_id):
     # artist record with ID <artist_id> using the new attributes
     try:
         form = ArtistForm()
-        artist = Artist.query.get(artist_id)
-        artist.name = form.name.data
-        print(form.genres.data)
-        artist.genres = form.genres.data
-        print(artist.genres)
-        artist.city = form.city.data
-        artist.state = form.state.data
-        artist.phone = form.phone.data
-        artist.website = form.website.data
-        artist.facebook_link = form.facebook_link.data
-        artist.seeking_venue = bool(form.seeking_venue.data)
-        artist.seeking_description = form.seeking_description.data
-        artist.image_link = form.image_link.data
-        print(artist.seeking_venue)
-        db.session.commit()
-        flash('Artist ' + form.name.data + ' has been updated')
-    except Exception as e:
-        print(e)
+        if write_behind.enabled:
+            flash_queued('The update of Artist ' + form.name.data,
+                         write_behind.submit(write_artist, artist_id=artist_id))
+        else:
+            artist_id, tags = write_artist(form, artist_id)
+            db.session.commit()
+            page_cache.invalidate(*tags)
+            flash('Artist ' + form.name.data + ' has been updated')
+    except Exception:
+        app.logger.exception('Artist %s could not be updated', artist_id)
         db.session.rollback()
         flash('An error occured while trying to update Artist')
     finally:
@@ -373,6 +516,24 @@ def edit_artist_submission(artist_id):
     return redirect(url_for('show_artist', artist_id=artist_id))
 
 
+@write_behind.writer(ArtistForm, url='/artists/{}')
+def write_artist(form, artist_id):
+    artist = Artist.query.get(artist_id)
+    if artist is None:
+        raise LookupError('Artist {} does not exist'.format(artist_id))
+    artist.name = form.name.data
+    artist.genres = form.genres.data
+    artist.city = form.city.data
+    artist.state = form.state.data
+    artist.phone = form.phone.data
+    artist.website = form.website.data
+    artist.facebook_link = form.facebook_link.data
+    artist.seeking_venue = bool(form.seeking_venue.data)
+    artist.seeking_description = form.seeking_description.data
+    artist.image_link = form.image_link.data
+    return artist_id, artist_cache_tags(artist_id)
+
+
 @app.route('/venues/<int:venue_id>/edit', methods=['GET'])
 def edit_venue(venue_id):
     form = VenueForm()
@@ -396,20 +557,14 @@ def edit_venue_submission(venue_id):
     # venue record with ID <venue_id> using the new attributes
     try:
         form = VenueForm()
-        venue = Venue.query.filter_by(id=venue_id).first()
-        venue.name = form.name.data
-        venue.genres = form.genres.data
-        venue.city = form.city.data
-        venue.state = form.state.data
-        venue.address = form.address.data
-        venue.phone = form.phone.data
-        venue.facebook_link = form.facebook_link.data
-        venue.website = form.website.data
-        venue.image_link = form.image_link.data
-        venue.seeking_talent = form.seeking_talent.data
-
-        db.session.commit()
-        flash('Venue ' + form.name.data + ' has been updated')
+        if write_behind.enabled:
+            flash_queued('The update of Venue ' + form.name.data,
+                         write_behind.submit(write_venue, venue_id=venue_id))
+        else:
+            venue_id, tags = write_venue(form, venue_id)
+            db.session.commit()
+            page_cache.invalidate(*tags)
+            flash('Venue ' + form.name.data + ' has been updated')
     except:
         db.session.rollback()
         flash('An error occured while trying to update Venue')
@@ -419,6 +574,24 @@ def edit_venue_submission(venue_id):
     return redirect(url_for('show_venue', venue_id=venue_id))
 
 
+@write_behind.writer(VenueForm, url='/venues/{}')
+def write_venue(form, venue_id):
+    venue = Venue.query.filter_by(id=venue_id).first()
+    if venue is None:
+        raise LookupError('Venue {} does not exist'.format(venue_id))
+    venue.name = form.name.data
+    venue.genres = form.genres.data
+    venue.city = form.city.data
+    venue.state = form.state.data
+    venue.address = form.address.data
+    venue.phone = form.phone.data
+    venue.facebook_link = form.facebook_link.data
+    venue.website = form.website.data
+    venue.image_link = form.image_link.data
+    venue.seeking_talent = form.seeking_talent.data
+    return venue_id, venue_cache_tags(venue_id)
+
+
 #  Create Artist
 #  ----------------------------------------------------------------
 
@@ -433,15 +606,13 @@ def create_artist_submission():
     # called upon submitting the new artist listing form
     try:
         form = ArtistForm()
-        artist = Artist(name=form.name.data, city=form.city.data, state=form.state.data,
-                        phone=form.phone.data, image_link=form.image_link.data, genres=form.genres.data,
-                        facebook_link=form.facebook_link.data, website=form.website.data,
-                        seeking_venue=bool(form.seeking_venue.data),
-                        seeking_description=form.seeking_description.data)
-
-        db.session.add(artist)
-        db.session.commit()
-        flash('Artist ' + request.form['name'] + ' was successfully listed!')
+        if write_behind.enabled:
+            flash_queued('Artist ' + request.form['name'], write_behind.submit(write_new_artist))
+        else:
+            artist_id, tags = write_new_artist(form)
+            db.session.commit()
+            page_cache.invalidate(*tags)
+            flash('Artist ' + request.form['name'] + ' was successfully listed!')
 
     except:
         db.session.rollback()
@@ -451,29 +622,105 @@ def create_artist_submission():
     return render_template('pages/home.html')
 
 
+@write_behind.writer(ArtistForm, url='/artists/{}')
+def write_new_artist(form):
+    artist = Artist(name=form.name.data, city=form.city.data, state=form.state.data,
+                    phone=form.phone.data, image_link=form.image_link.data, genres=form.genres.data,
+                    facebook_link=form.facebook_link.data, website=form.website.data,
+                    seeking_venue=bool(form.seeking_venue.data),
+                    seeking_description=form.seeking_description.data)
+    db.session.add(artist)
+    db.session.flush()
+    return artist.id, ['artists']
+
+
 #  Shows
 #  ----------------------------------------------------------------
 
 @app.route('/shows')
+@replicas.reads
+@page_cache.cached('shows')
 def shows():
-    # displays list of shows at /shows
+    # displays list of shows at /shows, newest first, one page at a time.
+    # pages are addressed by keyset cursors on (start_time, id) so any page costs one query.
+    return shows_page(db.session.execute(show_list_statement()).all())
+
+
+def shows_per_page():
+    per_page = min(request.args.get('per_page', app.config['SHOWS_PER_PAGE'], type=int),
+                   app.config['SHOWS_MAX_PER_PAGE'])
+    if per_page < 1:
+        abort(400)
+    return per_page
+
+
+def show_list_statement():
+    # ?from=, ?to=, ?city=, ?state= and ?genre= narrow the list, e.g. to the shows in NY next weekend
+    before = request.args.get('before')
+    after = request.args.get('after')
+    statement = db.select(Show.id, Show.venue_id, Show.artist_id, Show.start_time,
+                          Venue.name.label('venue_name'), Artist.name.label('artist_name'),
+                          Artist.image_link.label('artist_image_link')) \
+        .join(Venue, Venue.id == Show.venue_id) \
+        .join(Artist, Artist.id == Show.artist_id)
+    statement = schedule.in_range(statement, **schedule.range_filters())
+    position = db.tuple_(Show.start_time, Show.id)
+    if before:
+        statement = statement.where(position > parse_show_cursor(before)) \
+            .order_by(Show.start_time, Show.id)
+    else:
+        if after:
+            statement = statement.where(position < parse_show_cursor(after))
+        statement = statement.order_by(db.desc(Show.start_time), db.desc(Show.id))
+    return statement.limit(shows_per_page() + 1)
+
+
+def shows_page(show_list):
+    per_page = shows_per_page()
+    before = request.args.get('before')
+    after = request.args.get('after')
+    filters = schedule.range_filters()
+
+    has_more = len(show_list) > per_page
+    show_list = show_list[:per_page]
+    if before:
+        show_list.reverse()
+
     data = []
-    show_list = Show.query.order_by(db.desc(Show.start_time))
+    page_cache.prefetch([tag for show in show_list
+                         for tag in ('artist:{}'.format(show.artist_id), 'venue:{}'.format(show.venue_id))])
     for show in show_list:
         data.append({
+            "id": show.id,
             "venue_id": show.venue_id,
-            "venue_name": show.venues.name,
+            "venue_name": show.venue_name,
             "artist_id": show.artist_id,
-            "artist_name": show.artists.name,
-            "artist_image_link": show.artists.image_link,
-            "start_time": format_datetime(str(show.start_time))
+            "artist_name": show.artist_name,
+            "artist_image_link": show.artist_image_link,
+            "start_time": show.start_time
         })
     if data:
-        return render_template('pages/shows.html', shows=data)
+        newer_cursor = show_cursor(show_list[0]) if (before and has_more) or after else None
+        older_cursor = show_cursor(show_list[-1]) if (not before and has_more) or before else None
+        return render_template('pages/shows.html', shows=data, per_page=per_page,
+                               newer_cursor=newer_cursor, older_cursor=older_cursor,
+                               filter_args={name: request.args[name] for name in filters})
     else:
         return render_template('errors/no_item.html', message='No Shows are found currently')
 
 
+def show_cursor(show):
+    return '{},{}'.format(show.start_time.isoformat(), show.id)
+
+
+def parse_show_cursor(cursor):
+    try:
+        start_time, show_id = cursor.rsplit(',', 1)
+        return dateutil.parser.parse(start_time), int(show_id)
+    except (ValueError, OverflowError):
+        abort(400)
+
+
 @app.route('/shows/create')
 def create_shows():
     # renders form. do not touch.
@@ -487,12 +734,26 @@ def create_show_submission():
     # TODO: insert form data as a new Show record in the db, instead
     try:
         form = ShowForm()
-        show = Show(artist_id=form.artist_id.data, venue_id=form.venue_id.data,
-                    start_time=form.start_time.data)
-
-        db.session.add(show)
-        db.session.commit()
-        flash('Show was successfully listed!')
+        artist_id, venue_id, start_time = form.artist_id.data, form.venue_id.data, form.start_time.data
+
+        booked = availability.conflicts(artist_id, venue_id, start_time)
+        if booked:
+            # offer the form again at the next time both are free
+            slot = availability.next_free_slot(artist_id, venue_id, start_time)
+            flash('The {} is already booked at {}. The next free slot is {}.'.format(
+                'artist' if booked[0].artist_id == int(artist_id) else 'venue',
+                format_datetime(booked[0].start_time, 'full'), format_datetime(slot, 'full')))
+            form = ShowForm(formdata=None, artist_id=artist_id, venue_id=venue_id, start_time=slot)
+            return render_template('forms/new_show.html', form=form)
+
+        if write_behind.enabled:
+            # a booking racing this one is caught when the queue writes it, by the no-overlap constraints
+            flash_queued('Show', write_behind.submit(write_new_show))
+        else:
+            show_id, tags = write_new_show(form)
+            db.session.commit()
+            page_cache.invalidate(*tags)
+            flash('Show was successfully listed!')
 
     except:
         db.session.rollback()
@@ -502,6 +763,228 @@ def create_show_submission():
     return render_template('pages/home.html')
 
 
+@write_behind.writer(ShowForm)
+def write_new_show(form):
+    show = Show(artist_id=form.artist_id.data, venue_id=form.venue_id.data,
+                start_time=form.start_time.data)
+    db.session.add(show)
+    db.session.flush()
+    return show.id, ['shows', 'venues', 'venue:{}'.format(show.venue_id), 'artist:{}'.format(show.artist_id)]
+
+
+@app.route('/shows/next-free-slot')
+def next_free_slot():
+    # earliest start time, from ?after= (default now) on, at which both the artist and the venue are free
+    artist_id = request.args.get('artist_id', type=int)
+    venue_id = request.args.get('venue_id', type=int)
+    if artist_id is None or venue_id is None:
+        abort(400)
+    try:
+        after = dateutil.parser.parse(request.args['after']) if request.args.get('after') else datetime.utcnow()
+    except (ValueError, OverflowError):
+        abort(400)
+    return jsonify({
+        'success': True,
+        'start_time': availability.next_free_slot(artist_id, venue_id, after).isoformat()
+    })
+
+
+#  Exports
+#  ----------------------------------------------------------------
+
+@app.route('/export/<any(venues, artists, shows):kind>.<any(csv, ndjson):format>')
+@replicas.reads
+def export_catalog(kind, format):
+    # every venue/artist/show matching ?state= ?city= ?genre= ?from= ?to=, streamed as it's read
+    text = export.chunks(kind, format, export.export_batches(kind, **schedule.range_filters()))
+    if request.accept_encodings['gzip']:
+        response = Response(stream_with_context(export.gzipped(text)), mimetype=export.FORMATS[format])
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    else:
+        response = Response(stream_with_context(text), mimetype=export.FORMATS[format])
+    response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(kind, format)
+    return response
+
+
+#  Cache
+#  ----------------------------------------------------------------
+
+def venue_cache_tags(venue_id):
+    # every cached page showing the venue: the listings, its own page and the pages of artists playing there
+    artist_ids = db.session.query(Show.artist_id).filter(Show.venue_id == venue_id).distinct()
+    return ['venues', 'shows', 'venue:{}'.format(venue_id)] + ['artist:{}'.format(row.artist_id) for row in artist_ids]
+
+
+def artist_cache_tags(artist_id):
+    # every cached page showing the artist: the listings, its own page and the pages of venues it plays at
+    venue_ids = db.session.query(Show.venue_id).filter(Show.artist_id == artist_id).distinct()
+    return ['artists', 'shows', 'artist:{}'.format(artist_id)] + ['venue:{}'.format(row.venue_id) for row in venue_ids]
+
+
+def invalidate_rolled_over(venue_ids, artist_ids):
+    page_cache.invalidate('venues', *['venue:{}'.format(venue_id) for venue_id in venue_ids],
+                          *['artist:{}'.format(artist_id) for artist_id in artist_ids])
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(page_cache.stats())
+
+
+#  Show summaries
+#  ----------------------------------------------------------------
+
+@app.cli.command('rollover-summaries')
+def rollover_summaries_command():
+    """Move the shows that started since the last rollover from upcoming to past."""
+    venue_ids, artist_ids = summaries.rollover()
+    db.session.commit()
+    invalidate_rolled_over(venue_ids, artist_ids)
+    click.echo('Rolled over {} venues and {} artists'.format(len(venue_ids), len(artist_ids)))
+
+
+@app.cli.command('rebuild-summaries')
+def rebuild_summaries_command():
+    """Recompute every venue and artist show summary from the shows table."""
+    summaries.rebuild()
+    readmodel.rebuild()
+    db.session.commit()
+    page_cache.clear()
+    click.echo('Show summaries rebuilt')
+
+
+@app.cli.command('rebuild-facets')
+def rebuild_facets_command():
+    """Recount the genre facets of the venue and artist listings."""
+    facets.rebuild()
+    db.session.commit()
+    page_cache.clear()
+    click.echo('Genre facets rebuilt')
+
+
+@app.cli.command('rebuild-documents')
+def rebuild_documents_command():
+    """Rewrite the page document of every venue and artist from the tables."""
+    readmodel.rebuild()
+    db.session.commit()
+    page_cache.clear()
+    click.echo('Venue and artist documents rebuilt')
+
+
+#  Bulk import
+#  ----------------------------------------------------------------
+
+@app.cli.command('import-catalog')
+@click.argument('kind', type=click.Choice(sorted(importer.IMPORTERS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=5000, show_default=True, help='Records per transaction.')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint and start from the first record.')
+def import_catalog_command(kind, path, batch_size, restart):
+    """Bulk import venues, artists or shows from a CSV or JSON Lines file."""
+    checkpoint = importer.import_file(kind, path, batch_size, restart,
+                                      progress=lambda message: click.echo(message, err=True))
+    if kind == 'shows':
+        summaries.rebuild()
+        readmodel.rebuild()
+    else:
+        facets.rebuild([importer.IMPORTERS[kind][0]])
+        readmodel.rebuild([importer.IMPORTERS[kind][0]])
+    # servers rebuild their autocomplete indexes on this event; page_cache.clear() only reaches them with redis
+    outbox.reloaded(db.session, importer.IMPORTERS[kind][0])
+    db.session.commit()
+    clear_indexes()
+    page_cache.clear()
+    click.echo('Imported {} {}, rejected {} (see {}.rejects)'.format(checkpoint['imported'], kind,
+                                                                     checkpoint['rejected'], path))
+
+
+@app.cli.command('export-catalog')
+@click.argument('kind', type=click.Choice(sorted(export.EXPORTS)))
+@click.argument('path')
+@click.option('--format', 'format', type=click.Choice(sorted(export.FORMATS)),
+              help='Defaults to the extension of PATH, or csv.')
+@click.option('--state')
+@click.option('--city')
+@click.option('--genre')
+@click.option('--from', 'start', type=click.DateTime(), help='Shows starting, or venues/artists changed, from.')
+@click.option('--to', 'end', type=click.DateTime(), help='... until this (exclusive).')
+@click.option('--batch-size', default=export.BATCH_SIZE, show_default=True, help='Rows per cursor fetch.')
+def export_catalog_command(kind, path, format, state, city, genre, start, end, batch_size):
+    """Export venues, artists or shows to PATH (- for stdout) as CSV or JSON Lines, gzipped for PATH.gz."""
+    if format is None:
+        name = path[:-len('.gz')] if path.endswith('.gz') else path
+        format = 'ndjson' if name.endswith(('.ndjson', '.jsonl')) else 'csv'
+    count = export.write_file(path, kind, format, batch_size, state=state, city=city, genre=genre, **{
+        'from': start, 'to': end})
+    click.echo('Exported {} {}'.format(count, kind), err=True)
+
+
+@app.cli.command('seed-synthetic')
+@click.option('--venues', default=1000, show_default=True)
+@click.option('--artists', default=2000, show_default=True)
+@click.option('--shows', default=20000, show_default=True)
+@click.option('--seed', 'random_seed', default=0, show_default=True,
+              help='The same seed and counts always generate the same catalog.')
+def seed_synthetic_command(venues, artists, shows, random_seed):
+    """Add a synthetic catalog of venues, artists and shows, e.g. to run benchmark.py against."""
+    seed.seed(venues, artists, shows, random_seed)
+    db.session.commit()
+    clear_indexes()
+    page_cache.clear()
+    click.echo('Added {} venues, {} artists and {} shows'.format(venues, artists, shows))
+
+
+@app.cli.command('geocode-venues')
+@click.option('--gazetteer', type=click.Path(exists=True, dir_okay=False), help='Defaults to GAZETTEER_PATH.')
+@click.option('--all', 'everything', is_flag=True, help='Locate every venue again, not just those without a location.')
+@click.option('--batch-size', default=1000, show_default=True, help='Venues per UPDATE.')
+def geocode_venues_command(gazetteer, everything, batch_size):
+    """Locate the venues by city and state (or address) in a local gazetteer, for /venues/nearby."""
+    located, missing = geo.geocode(geo.load_gazetteer(gazetteer or app.config['GAZETTEER_PATH']), everything,
+                                   batch_size)
+    outbox.reloaded(db.session, Venue)
+    db.session.commit()
+    click.echo('Located {} venues, {} not found in the gazetteer'.format(located, missing))
+
+
+#  Change events
+#  ----------------------------------------------------------------
+
+@app.cli.command('relay-events')
+@click.argument('sink')
+@click.option('--consumer', default='default', show_default=True,
+              help='Name the position in the event stream is kept under.')
+@click.option('--batch-size', default=500, show_default=True, help='Events per publish.')
+@click.option('--interval', default=1.0, show_default=True, help='Seconds between polls once caught up.')
+@click.option('--replay-from', type=int, help='Publish again every event from this offset on.')
+@click.option('--once', is_flag=True, help='Publish the pending events and exit.')
+def relay_events_command(sink, consumer, batch_size, interval, replay_from, once):
+    """Publish the venue, artist and show change events to SINK: file:PATH, sqlite:PATH or redis://HOST/DB."""
+    if replay_from is not None:
+        outbox.replay_from(consumer, replay_from)
+        db.session.commit()
+    sink = outbox.open_sink(sink)
+    try:
+        published = outbox.relay(sink, consumer, batch_size, interval, once)
+    finally:
+        sink.close()
+    click.echo('Published {} events for {}'.format(published, consumer))
+
+
+@app.cli.command('prune-events')
+@click.option('--days', default=7, show_default=True, help='Keep the events of the last DAYS days.')
+def prune_events_command(days):
+    """Delete old change events that every consumer has been sent."""
+    deleted = outbox.prune(datetime.utcnow() - timedelta(days=days))
+    db.session.commit()
+    click.echo('Deleted {} events'.format(deleted))
+
+
+if app.config['SUMMARY_ROLLOVER_INTERVAL']:
+    summaries.start_rollover_job(app, app.config['SUMMARY_ROLLOVER_INTERVAL'], invalidate_rolled_over)
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
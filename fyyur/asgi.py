@@ -0,0 +1,273 @@
+import asyncio
+import contextvars
+import io
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import g, request
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.exceptions import HTTPException
+
+import facets
+import readmodel
+from app import (app, listing_filters, venue_list_statement, venues_page, venues_unavailable, venue_page,
+                 artist_list_statement, artists_page, artist_page, show_list_statement, shows_page)
+from api import (VENUE_COLUMNS, ARTIST_COLUMNS, SHOW_COLUMNS, json_response, listing, venues_statement,
+                 venue_statement, venue_response, artists_statement, artist_statement, artist_response,
+                 shows_statement)
+from cache import page_cache
+from models import Venue, Artist
+from replicas import replicas
+
+# ----------------------------------------------------------------------------#
+# ASGI entry point: uvicorn asgi:application
+#
+# The read-heavy pages (venue, artist and show listings, venue and artist
+# pages) and the JSON API run as async views over an async database driver
+# and connection pool, so a worker keeps serving while queries and slow
+# clients are waiting. They reuse the statements, templates, page cache and
+# request hooks of the Flask app; the templates render on a pool of
+# ASGI_THREADS threads. Like the @replicas.reads views, they read from an
+# async engine per read replica unless the client or this process wrote within
+# REPLICA_MAX_LAG. Every other route (forms, search, feeds) is handed to the
+# Flask app on that pool.
+# ----------------------------------------------------------------------------#
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+
+def async_url(url):
+    """The database URL with its driver swapped for the async one."""
+    scheme, separator, rest = url.partition('://')
+    return ASYNC_DRIVERS.get(scheme, scheme) + separator + rest
+
+
+def build_environ(scope):
+    """The WSGI environ of a bodiless ASGI HTTP request, for routing it and building the Flask request."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+class ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        # asgiref's own run_wsgi_app is thread sensitive, so every request would wait for one shared thread
+        run = WsgiToAsgiInstance.__dict__['run_wsgi_app'].func
+        await sync_to_async(run, thread_sensitive=False, executor=self.executor)(self, body)
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi running the WSGI app on a pool of threads."""
+
+    def __init__(self, wsgi_application, threads):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiInstance(self.wsgi_application, self.executor)(scope, receive, send)
+
+
+class Application:
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.wsgi = ThreadPoolWsgiToAsgi(flask_app, flask_app.config.get('ASGI_THREADS', 30))
+        url = flask_app.config.get('ASYNC_DATABASE_URL') or async_url(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+        options = flask_app.config.get('ASYNC_ENGINE_OPTIONS', {})
+        self.engine = create_async_engine(url, **options)
+        self.replica_engines = [create_async_engine(async_url(replica_url), **options)
+                                for replica_url in flask_app.config.get('SQLALCHEMY_REPLICA_URIS', [])]
+        # endpoint -> async view
+        self.views = {
+            'venues': self.venues,
+            'show_venue': self.show_venue,
+            'artists': self.artists,
+            'show_artist': self.show_artist,
+            'shows': self.shows,
+            'api.get_venues': self.get_venues,
+            'api.get_venue': self.get_venue,
+            'api.get_artists': self.get_artists,
+            'api.get_artist': self.get_artist,
+            'api.get_shows': self.get_shows,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            environ = build_environ(scope)
+            try:
+                endpoint, view_args = self.app.url_map.bind_to_environ(environ).match()
+            except HTTPException:
+                endpoint = None
+            if endpoint in self.views:
+                return await self.dispatch(environ, self.views[endpoint], send)
+        await self.wsgi(scope, receive, send)
+
+    async def dispatch(self, environ, view, send):
+        """Run an async view with the request hooks and error handlers of the Flask app."""
+        with self.app.request_context(environ):
+            try:
+                try:
+                    response = self.app.preprocess_request()
+                    if response is None:
+                        response = await view(**request.view_args)
+                except Exception as e:
+                    response = self.app.handle_user_exception(e)
+                response = self.app.finalize_request(response)
+            except Exception as e:
+                response = self.app.handle_exception(e)
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response.headers.items()],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': b'' if environ['REQUEST_METHOD'] == 'HEAD' else response.get_data(),
+        })
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in [self.engine] + self.replica_engines:
+                    await engine.dispose()
+                self.wsgi.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def read_engine(self):
+        """The engine the current request reads from, as replicas.engine_for() picks it for the Flask views."""
+        if not self.replica_engines or not replicas.replica_allowed():
+            return self.engine
+        if 'async_replica' not in g:
+            g.async_replica = random.choice(self.replica_engines)
+        return g.async_replica
+
+    async def fetch(self, statement):
+        async with self.read_engine().connect() as connection:
+            return (await connection.execute(statement)).all()
+
+    async def render(self, page, *args):
+        # templates render on the thread pool, so a long listing doesn't hold up the event loop
+        return await asyncio.get_running_loop().run_in_executor(self.wsgi.executor, contextvars.copy_context().run,
+                                                                page, *args)
+
+    async def fetch_document(self, model, id):
+        # see readmodel.document()
+        async with self.read_engine().connect() as connection:
+            data = (await connection.execute(readmodel.document_statement(model, id))).scalar()
+            if data is None:
+                data = await connection.run_sync(readmodel.build_document, model, id)
+            return data
+
+    async def facet_counts(self, model):
+        # see facets.facet_counts()
+        statements = facets.facet_statements(model, **listing_filters())
+        return {field: await self.fetch(statement) if statement is not None else []
+                for field, statement in statements.items()}
+
+    async def cached(self, tag, kwargs, render):
+        """The page of the current request from the page cache, else the one the coroutine render() returns,
+        as @page_cache.cached does for the Flask views."""
+        key = page_cache.page_key([tag], kwargs)
+        if key is None:
+            return await render()
+        page = page_cache.get(key)
+        if page is None:
+            held = page_cache.holding([tag.format(**kwargs)])
+            page = await render()
+            if not held:
+                page_cache.set(key, page)
+        return page
+
+    async def cached_listing(self, tag, name, columns, statement):
+        async def render():
+            return listing(name, columns, await self.fetch(statement))
+        return await self.cached(tag, {}, render)
+
+    # pages
+
+    async def venues(self):
+        async def render():
+            try:
+                venue_list = await self.fetch(venue_list_statement())
+                return await self.render(venues_page, venue_list, await self.facet_counts(Venue))
+            except Exception:
+                return venues_unavailable()
+        return await self.cached('venues', {}, render)
+
+    async def show_venue(self, venue_id):
+        async def render():
+            return await self.render(venue_page, await self.fetch_document(Venue, venue_id))
+        return await self.cached('venue:{venue_id}', {'venue_id': venue_id}, render)
+
+    async def artists(self):
+        async def render():
+            artists_list = await self.fetch(artist_list_statement())
+            return await self.render(artists_page, artists_list, await self.facet_counts(Artist))
+        return await self.cached('artists', {}, render)
+
+    async def show_artist(self, artist_id):
+        async def render():
+            return await self.render(artist_page, await self.fetch_document(Artist, artist_id))
+        return await self.cached('artist:{artist_id}', {'artist_id': artist_id}, render)
+
+    async def shows(self):
+        async def render():
+            return await self.render(shows_page, await self.fetch(show_list_statement()))
+        return await self.cached('shows', {}, render)
+
+    # API
+
+    async def get_venues(self):
+        return json_response(await self.cached_listing('venues', 'venues', VENUE_COLUMNS, venues_statement()))
+
+    async def get_venue(self, venue_id):
+        rows = await self.fetch(venue_statement(venue_id))
+        return venue_response(rows[0] if rows else None)
+
+    async def get_artists(self):
+        return json_response(await self.cached_listing('artists', 'artists', ARTIST_COLUMNS, artists_statement()))
+
+    async def get_artist(self, artist_id):
+        rows = await self.fetch(artist_statement(artist_id))
+        return artist_response(rows[0] if rows else None)
+
+    async def get_shows(self):
+        return json_response(await self.cached_listing('shows', 'shows', SHOW_COLUMNS, shows_statement()))
+
+
+application = Application(app)
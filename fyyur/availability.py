@@ -0,0 +1,91 @@
+import bisect
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy import DDL, event
+
+from models import db, Show
+
+# ----------------------------------------------------------------------------#
+# Booking conflicts.
+#
+# Every show occupies its artist and its venue for SHOW_LENGTH from its start
+# time, so two shows of the same artist or at the same venue conflict when
+# they start less than SHOW_LENGTH apart. Checks are range scans on the
+# (artist_id, start_time) and (venue_id, start_time) indexes; on PostgreSQL
+# exclusion constraints also reject overlapping shows that race past them.
+# ----------------------------------------------------------------------------#
+
+# the exclusion constraints (and their migration) spell the same length as an interval
+SHOW_LENGTH = timedelta(hours=3)
+
+EXCLUSION_CONSTRAINT = (
+    "ALTER TABLE shows ADD CONSTRAINT shows_{0}_no_overlap EXCLUDE USING gist "
+    "({0} WITH =, tsrange(start_time, start_time + interval '3 hours') WITH &&)"
+)
+
+# btree_gist lets the gist exclusion constraints compare the integer ids with =
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS btree_gist').execute_if(dialect='postgresql'))
+for column in ('artist_id', 'venue_id'):
+    event.listen(Show.__table__, 'after_create',
+                 DDL(EXCLUSION_CONSTRAINT.format(column)).execute_if(dialect='postgresql'))
+
+
+def booked(artist_id, venue_id):
+    return db.or_(Show.artist_id == artist_id, Show.venue_id == venue_id)
+
+
+def conflicts(artist_id, venue_id, start_time):
+    """Shows of the artist or at the venue overlapping a show starting at start_time."""
+    return Show.query.filter(booked(artist_id, venue_id),
+                             Show.start_time > start_time - SHOW_LENGTH,
+                             Show.start_time < start_time + SHOW_LENGTH).order_by(Show.start_time).all()
+
+
+def next_free_slot(artist_id, venue_id, after):
+    """The earliest start time from after on at which both the artist and the venue are free."""
+    slot = after
+    starts = db.session.query(Show.start_time) \
+        .filter(booked(artist_id, venue_id), Show.start_time > after - SHOW_LENGTH) \
+        .order_by(Show.start_time).yield_per(100)
+    for start_time, in starts:
+        if start_time >= slot + SHOW_LENGTH:
+            break
+        slot = max(slot, start_time + SHOW_LENGTH)
+    return slot
+
+
+class Bookings:
+    """Sorted start times of the shows of a set of artists and venues, for checking many new shows at once."""
+
+    def __init__(self):
+        self.starts = defaultdict(list)  # ('artist', id) or ('venue', id) -> sorted start times
+
+    def add(self, artist_id, venue_id, start_time):
+        bisect.insort(self.starts[('artist', artist_id)], start_time)
+        bisect.insort(self.starts[('venue', venue_id)], start_time)
+
+    def conflicts(self, artist_id, venue_id, start_time):
+        for key in (('artist', artist_id), ('venue', venue_id)):
+            starts = self.starts.get(key, [])
+            i = bisect.bisect_right(starts, start_time - SHOW_LENGTH)
+            if i < len(starts) and starts[i] < start_time + SHOW_LENGTH:
+                return True
+        return False
+
+    @classmethod
+    def load(cls, shows):
+        """The existing bookings that could conflict with shows (dicts of artist_id, venue_id, start_time)."""
+        bookings = cls()
+        if not shows:
+            return bookings
+        start_times = [show['start_time'] for show in shows]
+        query = db.session.query(Show.artist_id, Show.venue_id, Show.start_time).filter(
+            db.or_(Show.artist_id.in_({show['artist_id'] for show in shows}),
+                   Show.venue_id.in_({show['venue_id'] for show in shows})),
+            Show.start_time > min(start_times) - SHOW_LENGTH,
+            Show.start_time < max(start_times) + SHOW_LENGTH)
+        for artist_id, venue_id, start_time in query:
+            bookings.add(artist_id, venue_id, start_time)
+        return bookings
@@ -0,0 +1,308 @@
+"""Benchmark every GET and POST route of fyyur in process.
+
+Point DATABASE_URL at a scratch database (the POST routes add and edit rows), then
+
+    python benchmark.py --venues 1000 --artists 2000 --shows 20000 --output before.json
+    git checkout my-branch
+    python benchmark.py --output after.json --baseline before.json
+
+--venues/--artists/--shows first add that synthetic catalog (see seed.py,
+also available as `flask seed-synthetic`). Each route then gets --requests
+requests from --concurrency threads, on ids and search terms drawn from the
+same random sequence every run. The report lists throughput, latency
+percentiles and SQL statements per request for every route; the JSON output
+diffs cleanly between commits, and --baseline prints how every number moved
+against an earlier report. loadtest.py measures over real sockets instead.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import geo
+import seed
+from availability import SHOW_LENGTH
+from loadtest import percentile
+from models import db, Venue, Artist, Show
+
+METHODS = ('GET', 'POST')
+# reported numbers, and whether a higher value is better
+FIELDS = (('rps', True), ('p50_ms', False), ('p95_ms', False), ('p99_ms', False), ('queries', False),
+          ('errors', False))
+
+
+class Catalog:
+    """Draws the ids, search terms and form data requested from the database being benchmarked."""
+
+    def __init__(self, random_seed):
+        self.rng = random.Random(random_seed)
+        self.venue_ids = [id for id, in db.session.query(Venue.id).order_by(Venue.id)]
+        self.artist_ids = [id for id, in db.session.query(Artist.id).order_by(Artist.id)]
+        if not (self.venue_ids and self.artist_ids):
+            sys.exit('The database has no venues or artists, add some with --venues and --artists')
+        self.first_show, self.last_show = db.session.query(db.func.min(Show.start_time),
+                                                           db.func.max(Show.start_time)).one()
+        self.new_shows = 0
+        self.places = sorted(geo.load_gazetteer(current_app.config['GAZETTEER_PATH']).values())
+
+    def venue(self):
+        return self.rng.choice(self.venue_ids)
+
+    def artist(self):
+        return self.rng.choice(self.artist_ids)
+
+    def point(self):
+        """A point (as lat/lng query arguments) in one of the gazetteer's places."""
+        latitude, longitude = self.rng.choice(self.places)
+        return {'lat': latitude, 'lng': longitude}
+
+    def term(self):
+        return self.rng.choice(seed.WORDS).lower()
+
+    def day(self):
+        """A day (as from/to query arguments) within the seeded shows."""
+        if self.first_show is None:
+            return {}
+        span = max(int((self.last_show - self.first_show).total_seconds()), 1)
+        start = self.first_show + timedelta(seconds=self.rng.randrange(span))
+        return {'from': start.isoformat(), 'to': (start + timedelta(days=1)).isoformat()}
+
+    def show_time(self):
+        """A start time after every existing show, so the new shows don't conflict."""
+        self.new_shows += 1
+        return ((self.last_show or datetime.utcnow()) + self.new_shows * SHOW_LENGTH).strftime('%Y-%m-%d %H:%M:%S')
+
+    def venue_form(self):
+        row = seed.venue_row(self.rng, self.rng.randrange(10 ** 6))
+        return dict(row, seeking_talent=str(row['seeking_talent']))
+
+    def artist_form(self):
+        row = seed.artist_row(self.rng, self.rng.randrange(10 ** 6))
+        return dict(row, seeking_venue=str(row['seeking_venue']), seeking_description='')
+
+
+def query(path, **args):
+    return path + '?' + urlencode(args)
+
+
+# endpoint -> function of the catalog returning the path (and form data) of one request
+SCENARIOS = {
+    'index': lambda c: '/',
+    'venues': lambda c: '/venues',
+    'search_venues': lambda c: ('/venues/search', {'search_term': c.term()}),
+    'autocomplete_venues': lambda c: query('/venues/autocomplete', q=c.term()[:3]),
+    'nearby_venues': lambda c: query('/venues/nearby', radius=25, **c.point()),
+    'show_venue': lambda c: '/venues/{}'.format(c.venue()),
+    'venue_calendar': lambda c: '/venues/{}/shows.ics'.format(c.venue()),
+    'create_venue_form': lambda c: '/venues/create',
+    'create_venue_submission': lambda c: ('/venues/create', c.venue_form()),
+    'edit_venue': lambda c: '/venues/{}/edit'.format(c.venue()),
+    'edit_venue_submission': lambda c: ('/venues/{}/edit'.format(c.venue()), c.venue_form()),
+    'artists': lambda c: '/artists',
+    'search_artists': lambda c: ('/artists/search', {'search_term': c.term()}),
+    'autocomplete_artists': lambda c: query('/artists/autocomplete', q=c.term()[:3]),
+    'show_artist': lambda c: '/artists/{}'.format(c.artist()),
+    'artist_calendar': lambda c: '/artists/{}/shows.ics'.format(c.artist()),
+    'create_artist_form': lambda c: '/artists/create',
+    'create_artist_submission': lambda c: ('/artists/create', c.artist_form()),
+    'edit_artist': lambda c: '/artists/{}/edit'.format(c.artist()),
+    'edit_artist_submission': lambda c: ('/artists/{}/edit'.format(c.artist()), c.artist_form()),
+    'shows': lambda c: query('/shows', **c.day()),
+    'create_shows': lambda c: '/shows/create',
+    'create_show_submission': lambda c: ('/shows/create', {
+        'artist_id': c.artist(), 'venue_id': c.venue(), 'start_time': c.show_time()}),
+    'next_free_slot': lambda c: query('/shows/next-free-slot', artist_id=c.artist(), venue_id=c.venue()),
+    'export_catalog': lambda c: query('/export/shows.csv', state='NY', **c.day()),
+    'submissions': lambda c: '/submissions',
+    'cache_stats': lambda c: '/cache/stats',
+    'metrics': lambda c: '/metrics',
+    'slow_queries': lambda c: '/metrics/slow-queries',
+    'api.get_venues': lambda c: '/api/v1/venues',
+    'api.get_venue': lambda c: '/api/v1/venues/{}'.format(c.venue()),
+    'api.get_artists': lambda c: '/api/v1/artists',
+    'api.get_artist': lambda c: '/api/v1/artists/{}'.format(c.artist()),
+    'api.get_shows': lambda c: '/api/v1/shows',
+    'api.get_calendar': lambda c: query('/api/v1/calendar', state='NY', **c.day()),
+}
+
+
+def routes(app):
+    """(method, rule) of every GET and POST route, in URL order; exits if one has no scenario."""
+    found, missing = [], []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        if rule.endpoint == 'static':
+            continue
+        for method in METHODS:
+            if method in rule.methods:
+                (found if rule.endpoint in SCENARIOS else missing).append((method, rule))
+    if missing:
+        sys.exit('No benchmark scenario for ' + ', '.join('{} {}'.format(method, rule) for method, rule in missing))
+    return found
+
+
+class Runner:
+    def __init__(self, app, concurrency):
+        self.app = app
+        self.concurrency = concurrency
+        self.local = threading.local()
+        event.listen(Engine, 'before_cursor_execute', self.count_statement)
+
+    def close(self):
+        event.remove(Engine, 'before_cursor_execute', self.count_statement)
+
+    def count_statement(self, *args):
+        if getattr(self.local, 'statements', None) is not None:
+            self.local.statements += 1
+
+    def execute(self, method, request):
+        path, data = request if isinstance(request, tuple) else (request, None)
+        if getattr(self.local, 'client', None) is None:
+            self.local.client = self.app.test_client()
+        self.local.statements = 0
+        start = time.perf_counter()
+        response = self.local.client.open(path, method=method, data=data)
+        response.get_data()  # streamed bodies are produced while they're read
+        elapsed = time.perf_counter() - start
+        statements, self.local.statements = self.local.statements, None
+        response.close()
+        return response.status_code, elapsed, statements
+
+    def run(self, method, requests, warmup):
+        """Time the requests; the results of the first warmup ones aren't recorded."""
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            list(pool.map(lambda request: self.execute(method, request), requests[:warmup]))
+            start = time.perf_counter()
+            results = list(pool.map(lambda request: self.execute(method, request), requests[warmup:]))
+            elapsed = time.perf_counter() - start
+        latencies = sorted(latency for status, latency, statements in results)
+        return {
+            'requests': len(results),
+            'errors': sum(1 for status, latency, statements in results if status >= 400),
+            'rps': round(len(results) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'queries': round(sum(statements for status, latency, statements in results) / len(results), 2),
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    if args.no_page_cache:
+        os.environ['CACHE_BACKEND'] = 'none'
+    os.environ.setdefault('SUMMARY_ROLLOVER_INTERVAL', '0')
+    from app import app  # after choosing the cache backend, which the app reads at import
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        if args.venues or args.artists or args.shows:
+            print('Seeding {} venues, {} artists and {} shows'.format(args.venues, args.artists, args.shows),
+                  file=sys.stderr)
+            seed.seed(args.venues, args.artists, args.shows, args.seed)
+            db.session.commit()
+        catalog = Catalog(args.seed)
+        meta = {
+            'commit': git_commit(),
+            'database': db.engine.dialect.name,
+            'venues': db.session.query(Venue).count(),
+            'artists': db.session.query(Artist).count(),
+            'shows': db.session.query(Show).count(),
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'page_cache': not args.no_page_cache,
+            'python': platform.python_version(),
+        }
+
+    runner = Runner(app, args.concurrency)
+    report = {'meta': meta, 'routes': {}}
+    for method, rule in routes(app):
+        if args.route and not any(pattern in rule.endpoint or pattern in rule.rule for pattern in args.route):
+            continue
+        requests = [SCENARIOS[rule.endpoint](catalog) for _ in range(args.warmup + args.requests)]
+        name = '{} {}'.format(method, rule.rule)
+        print('{:<44}'.format(name), end='', file=sys.stderr, flush=True)
+        report['routes'][name] = runner.run(method, requests, args.warmup)
+        print(' {rps:>8.1f} req/s'.format(**report['routes'][name]), file=sys.stderr)
+    runner.close()
+    return report
+
+
+def change(value, baseline, higher_is_better):
+    if baseline is None:
+        return ''
+    if not baseline:
+        return ' (new)' if value else ''
+    percent = (value - baseline) * 100.0 / baseline
+    better = percent > 0 if higher_is_better else percent < 0
+    return ' ({:+.0f}%{})'.format(percent, '' if abs(percent) < 5 else ' better' if better else ' worse')
+
+
+def print_report(report, baseline=None):
+    meta = report['meta']
+    print('commit {commit}, {database}: {venues} venues, {artists} artists, {shows} shows; '
+          '{requests} requests per route, concurrency {concurrency}'.format(**meta))
+    if baseline is not None:
+        print('compared with commit {commit} ({venues} venues, {artists} artists, {shows} shows)'.format(
+            **baseline['meta']))
+    print('{:<44} '.format('route') + ' '.join('{:>20}'.format(field) for field, _ in FIELDS))
+    for name, numbers in report['routes'].items():
+        before = (baseline or {}).get('routes', {}).get(name, {})
+        print('{:<44} '.format(name) + ' '.join(
+            '{:>20}'.format('{:g}{}'.format(numbers[field], change(numbers[field], before.get(field), higher)))
+            for field, higher in FIELDS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--venues', type=int, default=0, help='synthetic venues to add first')
+    parser.add_argument('--artists', type=int, default=0, help='synthetic artists to add first')
+    parser.add_argument('--shows', type=int, default=0, help='synthetic shows to add first')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the catalog and the requests')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests per route first')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--route', action='append', help='only routes whose URL or endpoint contains this, repeatable')
+    parser.add_argument('--no-page-cache', action='store_true', help='render every page instead of caching it')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--baseline', help='a JSON report to compare with')
+    parser.add_argument('--report', help='print this JSON report instead of running the benchmark')
+    args = parser.parse_args()
+
+    if args.report:
+        with open(args.report) as f:
+            report = json.load(f)
+    else:
+        report = benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, request, session
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+# ----------------------------------------------------------------------------#
+# Page cache.
+#
+# Rendered pages are stored under their route and query string plus the
+# current version of every tag they depend on ('venues', 'venue:3', ...).
+# Write handlers bump the versions of the tags they touch, so stale entries
+# are never read again and simply age out of the backend.
+#
+# When a page has to be rendered again, its {% cache %} fragments (one row of
+# a listing, say) are reused from a per-process store under the versions of
+# the tags they show, so only the rows of edited venues/artists are rendered.
+#
+# With read replicas, a page rendered just after an invalidation may show what
+# a lagging replica still holds. For CACHE_HOLD_AFTER_INVALIDATE seconds after
+# a tag is bumped (REPLICA_MAX_LAG when replicas are configured), the pages
+# and fragments under it are rendered but not stored, in every process
+# sharing the backend.
+# ----------------------------------------------------------------------------#
+
+
+class MemoryBackend:
+    """In-process LRU with a per-entry TTL."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.tag_versions = {}
+        self.holds = {}  # tag -> monotonic time its hold ends
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def versions(self, tags):
+        with self.lock:
+            return [self.tag_versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.tag_versions[tag] = self.tag_versions.get(tag, 0) + 1
+
+    def hold(self, tags, seconds):
+        now = time.monotonic()
+        with self.lock:
+            self.holds = {tag: until for tag, until in self.holds.items() if until > now}
+            for tag in tags:
+                self.holds[tag] = now + seconds
+
+    def held(self, tags):
+        now = time.monotonic()
+        with self.lock:
+            return any(self.holds.get(tag, 0) > now for tag in tags)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tag_versions.clear()
+            self.holds.clear()
+
+
+class RedisBackend:
+    """Shared cache on a Redis-compatible server, so every worker sees the same invalidations."""
+
+    def __init__(self, url, ttl=300, prefix='fyyur:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND = 'redis' needs the redis package (pip install redis)")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + 'page:' + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + 'page:' + key, value.encode('utf-8'), ex=self.ttl)
+
+    def versions(self, tags):
+        if not tags:
+            return []
+        return [int(version or 0) for version in self.client.mget([self.prefix + 'tag:' + tag for tag in tags])]
+
+    def bump(self, tags):
+        pipeline = self.client.pipeline()
+        for tag in tags:
+            pipeline.incr(self.prefix + 'tag:' + tag)
+        pipeline.execute()
+
+    def hold(self, tags, seconds):
+        pipeline = self.client.pipeline()
+        for tag in tags:
+            pipeline.set(self.prefix + 'hold:' + tag, 1, px=max(int(seconds * 1000), 1))
+        pipeline.execute()
+
+    def held(self, tags):
+        return any(self.client.mget([self.prefix + 'hold:' + tag for tag in tags]))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class PageCache:
+    def __init__(self, app=None):
+        self.backend = None
+        self.fragments = None
+        self.hold = 0
+        self.hits = 0
+        self.misses = 0
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'memory')
+        app.config.setdefault('CACHE_TTL', 300)
+        app.config.setdefault('CACHE_MAXSIZE', 1024)
+        app.config.setdefault('FRAGMENT_CACHE_MAXSIZE', 20000)
+        app.config.setdefault('CACHE_HOLD_AFTER_INVALIDATE', 0)
+        self.hold = app.config['CACHE_HOLD_AFTER_INVALIDATE']
+        if app.config['CACHE_BACKEND'] == 'redis':
+            self.backend = RedisBackend(app.config['CACHE_REDIS_URL'], app.config['CACHE_TTL'])
+        elif app.config['CACHE_BACKEND'] == 'memory':
+            self.backend = MemoryBackend(app.config['CACHE_MAXSIZE'], app.config['CACHE_TTL'])
+        if self.backend is not None and app.config['FRAGMENT_CACHE_MAXSIZE']:
+            self.fragments = MemoryBackend(app.config['FRAGMENT_CACHE_MAXSIZE'], app.config['CACHE_TTL'])
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.extend(page_cache=self)
+        app.extensions['page_cache'] = self
+
+    def cached(self, *tags):
+        """Cache the page rendered by a view under its URL and the given tags.
+
+        Tags may use the view arguments, e.g. 'venue:{venue_id}'.
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                key = self.page_key(tags, kwargs)
+                if key is None:
+                    return view(**kwargs)
+                page = self.get(key)
+                if page is None:
+                    held = self.holding([tag.format(**kwargs) for tag in tags])
+                    page = view(**kwargs)
+                    if not held:
+                        self.set(key, page)
+                return page
+            return wrapper
+        return decorator
+
+    def page_key(self, tags, kwargs):
+        """The key of the current request's page under tags, None if it must not be cached."""
+        # pages carrying flashed messages are personal, render them fresh
+        if self.backend is None or '_flashes' in session:
+            return None
+        page_tags = [tag.format(**kwargs) for tag in tags]
+        versions = self.backend.versions(page_tags)
+        return '{}?{}|{}'.format(request.path, '&'.join(sorted(
+            '{}={}'.format(name, value) for name, value in request.args.items(multi=True))),
+            ','.join('{}={}'.format(tag, version) for tag, version in zip(page_tags, versions)))
+
+    def get(self, key):
+        page = self.backend.get(key)
+        if page is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return page
+
+    def set(self, key, page):
+        if isinstance(page, str):
+            self.backend.set(key, page)
+
+    def holding(self, tags):
+        """Whether the page about to be rendered under tags must not be stored, as one of them was invalidated
+        less than CACHE_HOLD_AFTER_INVALIDATE seconds ago; its fragments aren't stored either."""
+        if self.hold and tags and self.backend.held(tags):
+            g.cache_held = True
+            return True
+        return False
+
+    def fragment(self, name, tags, render):
+        """The template fragment name, rendered by render() unless cached under the current versions of tags."""
+        if self.fragments is None:
+            return render()
+        known = g.get('tag_versions') or {}
+        try:
+            versions = tuple([known[tag] for tag in tags])
+        except KeyError:
+            versions = tuple(self.backend.versions(tags))
+        key = (name, tags, versions)
+        fragment = self.fragments.get(key)
+        if fragment is None:
+            self.fragment_misses += 1
+            fragment = render()
+            if not g.get('cache_held'):
+                self.fragments.set(key, fragment)
+        else:
+            self.fragment_hits += 1
+        return fragment
+
+    def prefetch(self, tags):
+        """Look up the versions of the tags of the fragments about to be rendered at once, not one by one."""
+        if self.fragments is not None:
+            g.tag_versions = dict(zip(tags, self.backend.versions(tags)))
+
+    def invalidate(self, *tags):
+        if self.backend is not None and tags:
+            self.backend.bump(tags)
+            if self.hold:
+                self.backend.hold(tags, self.hold)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+        if self.fragments is not None:
+            self.fragments.clear()
+        self.hits = 0
+        self.misses = 0
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__ if self.backend is not None else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'fragment_hits': self.fragment_hits,
+            'fragment_misses': self.fragment_misses,
+        }
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache [key,] venue=venue.id, ... %}...{% endcache %}: cache the enclosed fragment under the current
+    versions of the entities it shows, e.g. one row or a block of rows (venue=[ids]) of a listing. The key tells
+    apart fragments showing the same entities, as in {% cache show.id, artist=show.artist_id, venue=show.venue_id %}.
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = nodes.Const(None)
+        if not (parser.stream.current.type == 'name' and parser.stream.look().type == 'assign'):
+            key = parser.parse_expression()
+            parser.stream.skip_if('comma')
+        kinds, ids = [], []
+        while parser.stream.current.type != 'block_end':
+            if kinds:
+                parser.stream.expect('comma')
+            kinds.append(parser.stream.expect('name').value)
+            parser.stream.expect('assign')
+            ids.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        args = [nodes.Const((parser.name, lineno)), key, nodes.Const(tuple(kinds)), nodes.Tuple(ids, 'load')]
+        return nodes.CallBlock(self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, name, key, kinds, ids, caller):
+        tags = []
+        for kind, id in zip(kinds, ids):
+            if isinstance(id, (list, tuple)):
+                tags.extend(['{}:{}'.format(kind, each) for each in id])
+            else:
+                tags.append('{}:{}'.format(kind, id))
+        return self.environment.page_cache.fragment((name, key), tuple(tags), caller)
+
+
+page_cache = PageCache()
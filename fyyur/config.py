@@ -9,5 +9,82 @@ DEBUG = True
 # Connect to the database
 
 
-SQLALCHEMY_DATABASE_URI = 'postgresql://mnm@localhost:5432/fyyur'
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql://mnm@localhost:5432/fyyur')
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Connection pool of every database engine, per process
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    # test connections before use, so ones dropped by a database restart or idle timeout are replaced
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+}
+
+# Async engine of the ASGI mode (asgi.py); defaults to SQLALCHEMY_DATABASE_URI with the asyncpg/aiosqlite driver.
+# Its pool can be larger, as waiting on the database doesn't hold a thread
+ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL')
+ASYNC_ENGINE_OPTIONS = dict(SQLALCHEMY_ENGINE_OPTIONS, pool_size=int(os.environ.get('ASYNC_DB_POOL_SIZE', 50)))
+# Threads running the routes without an async view in the ASGI mode; as many as the synchronous pool has
+# connections (pool_size + max_overflow), so none waits on the pool
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 30))
+
+# Read replicas (comma separated URLs) serving the read-only pages, and the seconds they may lag behind the
+# primary; for that long after a write the writing client reads from the primary
+SQLALCHEMY_REPLICA_URIS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+
+# Number of shows listed per page at /shows, and the largest page a client can ask for with ?per_page=
+SHOWS_PER_PAGE = 30
+SHOWS_MAX_PER_PAGE = 100
+
+# Number of venue/artist search results per page
+SEARCH_RESULTS_PER_PAGE = 20
+# Matches counted and ranked per search; broader searches show "1000+" results
+SEARCH_MAX_MATCHES = 1000
+
+# Number of names suggested by the artist/venue pickers of the new show form
+AUTOCOMPLETE_LIMIT = 10
+
+# CSV of places (city, state, latitude, longitude, optionally address) `flask geocode-venues` locates venues in
+GAZETTEER_PATH = os.environ.get('GAZETTEER_PATH', os.path.join(basedir, 'gazetteer.csv'))
+# Default and largest number of venues, and largest radius in km, of /venues/nearby
+NEARBY_LIMIT = 20
+NEARBY_MAX_LIMIT = 100
+NEARBY_MAX_RADIUS = 500
+
+# Rendered page cache: 'memory' (per-process LRU) or 'redis' (needs the redis package and CACHE_REDIS_URL),
+# any other value turns it off
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+CACHE_TTL = 300
+CACHE_MAXSIZE = 1024
+# Rendered listing rows ({% cache %} fragments) kept per process, 0 to render every row of a page again
+FRAGMENT_CACHE_MAXSIZE = 20000
+# Seconds after an invalidation during which pages are rendered but not cached, as a replica may still show
+# the old rows
+CACHE_HOLD_AFTER_INVALIDATE = REPLICA_MAX_LAG if SQLALCHEMY_REPLICA_URIS else 0
+
+# Directory of the compiled template cache, empty to compile the templates in every process
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR', os.path.join(basedir, '.template_cache'))
+
+# Write-behind queue for the create/edit forms: off by default. When on, submissions are appended to the
+# WRITE_BEHIND_JOURNAL file and acknowledged at once, then written in one transaction per WRITE_BEHIND_BATCH_SIZE
+# submissions or every WRITE_BEHIND_INTERVAL seconds. One process owns a journal; others write synchronously
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_JOURNAL = os.environ.get('WRITE_BEHIND_JOURNAL', os.path.join(basedir, 'write_behind.journal'))
+WRITE_BEHIND_BATCH_SIZE = 100
+WRITE_BEHIND_INTERVAL = 0.5
+
+# Seconds between background rollovers of the venue/artist show summaries, 0 to leave it to `flask rollover-summaries`
+SUMMARY_ROLLOVER_INTERVAL = int(os.environ.get('SUMMARY_ROLLOVER_INTERVAL', 60))
+
+# Default and largest page size of the /api/v1 listings (?limit=)
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Number of slowest SQL statements kept (and logged with their call site) for /metrics/slow-queries, and the
+# milliseconds a statement must take to count as slow
+METRICS_SLOW_QUERIES = 10
+METRICS_SLOW_QUERY_THRESHOLD = float(os.environ.get('METRICS_SLOW_QUERY_THRESHOLD', 100))
@@ -0,0 +1,56 @@
+from sqlalchemy import delete
+
+import facets
+import outbox
+import readmodel
+import search
+import summaries
+from models import db, Venue, Artist, Show
+
+# ----------------------------------------------------------------------------#
+# Set-based deletion of venues and artists.
+#
+# A venue or artist goes together with its shows: one DELETE per table, however
+# many shows there are, instead of loading and deleting every show through the
+# ORM. The summaries and page documents of the artists/venues at the other
+# end of those shows, the genre facets and the in-process search indexes are
+# patched, and the change events written, with a constant number of
+# statements as well.
+# ----------------------------------------------------------------------------#
+
+# model -> (foreign key of its shows, the model at the other end of them, foreign key to that one)
+SHOW_SIDES = {
+    Venue: (Show.venue_id, Artist, Show.artist_id),
+    Artist: (Show.artist_id, Venue, Show.venue_id),
+}
+
+
+def cache_tag(model, id):
+    return '{}:{}'.format(model.__tablename__[:-1], id)
+
+
+def delete_with_shows(model, ids):
+    """Delete the venues or artists with the given ids along with their shows. The caller commits.
+
+    Returns the names of the deleted rows and the page cache tags to invalidate after the commit.
+    """
+    foreign_key, other, other_key = SHOW_SIDES[model]
+    rows = db.session.query(model.id, model.name, model.state, model.city, model.genres) \
+        .filter(model.id.in_(ids)).all()
+    if not rows:
+        return [], []
+    ids = [row.id for row in rows]
+    other_ids = [id for id, in db.session.query(other_key).filter(foreign_key.in_(ids)).distinct()]
+
+    db.session.execute(delete(Show).where(foreign_key.in_(ids)), execution_options={'synchronize_session': False})
+    db.session.execute(delete(model).where(model.id.in_(ids)), execution_options={'synchronize_session': False})
+    summaries.recount(other, other_ids)
+    facets.uncount(model, [(row.state, row.city, row.genres) for row in rows])
+    search.forget(db.session, model, ids)
+    readmodel.mark_stale(db.session, model, ids)
+    outbox.shows_deleted(db.session, model, ids)
+    outbox.record(db.session, model, 'deleted', ids)
+
+    tags = ['venues', 'artists', 'shows'] + [cache_tag(model, id) for id in ids] + \
+        [cache_tag(other, id) for id in other_ids]
+    return [row.name for row in rows], tags
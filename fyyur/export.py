@@ -0,0 +1,136 @@
+import csv
+import gzip
+import io
+import sys
+import zlib
+from datetime import date, datetime
+
+from sqlalchemy import select
+
+from api import dumps
+from models import Venue, Artist
+from schedule import SCHEDULE_COLUMNS, batches, schedule
+
+# ----------------------------------------------------------------------------#
+# Catalog exports for reporting.
+#
+# A full dump of the venues, artists or shows (narrowed by state, city, genre
+# or a time range) is written as CSV or newline-delimited JSON while it's read
+# from a server-side cursor, a batch of rows at a time, so neither the web
+# process (/export/shows.csv) nor `flask export-catalog` holds more than one
+# batch in memory however large the catalog. Both can gzip the output as it
+# goes: the route when the client accepts it, the command for a FILE.gz.
+# ----------------------------------------------------------------------------#
+
+VENUE_EXPORT_COLUMNS = (Venue.id, Venue.name, Venue.city, Venue.state, Venue.address, Venue.phone, Venue.genres,
+                        Venue.image_link, Venue.facebook_link, Venue.website, Venue.seeking_talent,
+                        Venue.latitude, Venue.longitude, Venue.upcoming_shows_count, Venue.past_shows_count,
+                        Venue.updated_at)
+ARTIST_EXPORT_COLUMNS = (Artist.id, Artist.name, Artist.city, Artist.state, Artist.phone, Artist.genres,
+                         Artist.image_link, Artist.facebook_link, Artist.website, Artist.seeking_venue,
+                         Artist.seeking_description, Artist.upcoming_shows_count, Artist.past_shows_count,
+                         Artist.updated_at)
+
+# kind -> (model, exported columns); shows are exported with their venue and artist, see schedule()
+EXPORTS = {
+    'venues': (Venue, VENUE_EXPORT_COLUMNS),
+    'artists': (Artist, ARTIST_EXPORT_COLUMNS),
+    'shows': (None, SCHEDULE_COLUMNS),
+}
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# rows fetched from the cursor per batch
+BATCH_SIZE = 2000
+
+
+def export_statement(kind, **filters):
+    """Select the rows of kind matching the range_filters(): venues and artists by their own state, city and
+    genre, changed (updated_at) from/to; shows by those of their venue/artist, starting from/to."""
+    model, columns = EXPORTS[kind]
+    if model is None:
+        return schedule(**filters)
+    statement = select(*columns)
+    if filters.get('state'):
+        statement = statement.where(model.state == filters['state'])
+    if filters.get('city'):
+        statement = statement.where(model.city == filters['city'])
+    if filters.get('genre'):
+        statement = statement.where(model.genres.contains([filters['genre']]))
+    if filters.get('from'):
+        statement = statement.where(model.updated_at >= filters['from'])
+    if filters.get('to'):
+        statement = statement.where(model.updated_at < filters['to'])
+    return statement.order_by(model.id)
+
+
+def csv_value(value):
+    # list fields are comma separated, as import-catalog reads them
+    if isinstance(value, list):
+        return ','.join(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(keys, partitions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(keys)
+    for rows in partitions:
+        writer.writerows([csv_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():  # nothing matched: just the header
+        yield buffer.getvalue()
+
+
+def ndjson_chunks(keys, partitions):
+    for rows in partitions:
+        yield ''.join(dumps(dict(zip(keys, row))) + '\n' for row in rows)
+
+
+def export_batches(kind, batch_size=BATCH_SIZE, **filters):
+    """The rows of kind matching filters, in lists of batch_size read from a server-side cursor."""
+    return batches(export_statement(kind, **filters), batch_size)
+
+
+def chunks(kind, format, partitions):
+    """The export of kind in format ('csv' or 'ndjson') as text, one chunk per batch of rows in partitions."""
+    keys = [column.key for column in EXPORTS[kind][1]]
+    return (csv_chunks if format == 'csv' else ndjson_chunks)(keys, partitions)
+
+
+def gzipped(text_chunks, level=6):
+    """Compress text chunks into gzip bytes as they come."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for text in text_chunks:
+        data = compressor.compress(text.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def write_file(path, kind, format, batch_size=BATCH_SIZE, **filters):
+    """Write the export of kind to path ('-' for stdout), gzipped if it ends in .gz. Returns the rows written."""
+    if path == '-':
+        f = sys.stdout
+    elif path.endswith('.gz'):
+        f = gzip.open(path, 'wt', encoding='utf-8', newline='')
+    else:
+        f = open(path, 'w', encoding='utf-8', newline='')
+    count = 0
+
+    def counted(partitions):
+        nonlocal count
+        for rows in partitions:
+            count += len(rows)
+            yield rows
+    try:
+        for chunk in chunks(kind, format, counted(export_batches(kind, batch_size, **filters))):
+            f.write(chunk)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+    return count
@@ -0,0 +1,122 @@
+from collections import Counter
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Venue, Artist, GenreFacet
+
+# ----------------------------------------------------------------------------#
+# Genre facets of the venue and artist listings.
+#
+# genre_facets holds the number of venues/artists per state, city and genre.
+# Inserting, editing or deleting a venue or artist adjusts only the rows of its
+# old and new (state, city, genre) combinations, so the facet counts of a
+# listing are read from a handful of small rows instead of grouping the whole
+# table.
+# ----------------------------------------------------------------------------#
+
+FACETED = (Venue, Artist)
+
+# genre of the rows counting every venue/artist of a city, whatever its genres
+ALL = ''
+
+FIELDS = ('state', 'city', 'genres')
+
+
+def facet_keys(model, state, city, genres):
+    return {(model.__tablename__, state, city, genre) for genre in [ALL] + list(genres or [])}
+
+
+def previous_values(target):
+    """The state, city and genres of target before the flush being processed."""
+    attrs = inspect(target).attrs
+    values = []
+    for field in FIELDS:
+        history = attrs[field].history
+        values.append(history.deleted[0] if history.deleted else getattr(target, field))
+    return values
+
+
+def adjust(connection, deltas):
+    """Add the {facet key: delta} changes to the facet counts."""
+    if not deltas:
+        return
+    insert = (postgresql if connection.dialect.name == 'postgresql' else sqlite).insert
+    statement = insert(GenreFacet.__table__).values([
+        {'kind': kind, 'state': state, 'city': city, 'genre': genre, 'count': delta}
+        for (kind, state, city, genre), delta in sorted(deltas.items())])
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=['kind', 'state', 'city', 'genre'],
+        set_={'count': GenreFacet.__table__.c.count + statement.excluded.count}))
+
+
+def count_inserted(mapper, connection, target):
+    adjust(connection, dict.fromkeys(facet_keys(type(target), target.state, target.city, target.genres), 1))
+
+
+def count_updated(mapper, connection, target):
+    old = facet_keys(type(target), *previous_values(target))
+    new = facet_keys(type(target), target.state, target.city, target.genres)
+    deltas = dict.fromkeys(old - new, -1)
+    deltas.update(dict.fromkeys(new - old, 1))
+    adjust(connection, deltas)
+
+
+def count_deleted(mapper, connection, target):
+    adjust(connection, dict.fromkeys(facet_keys(type(target), *previous_values(target)), -1))
+
+
+for faceted in FACETED:
+    event.listen(faceted, 'after_insert', count_inserted)
+    event.listen(faceted, 'after_update', count_updated)
+    event.listen(faceted, 'after_delete', count_deleted)
+
+
+def uncount(model, rows):
+    """Take the (state, city, genres) rows of set-based deleted venues or artists out of the facet counts."""
+    deltas = Counter()
+    for state, city, genres in rows:
+        deltas.subtract(facet_keys(model, state, city, genres))
+    adjust(db.session.connection(), deltas)
+
+
+def rebuild(models=FACETED):
+    """Recount the facets of models from their tables, after bulk writes that bypass the ORM. The caller commits."""
+    for model in models:
+        counts = Counter()
+        for state, city, genres in db.session.query(model.state, model.city, model.genres).yield_per(10000):
+            counts.update(facet_keys(model, state, city, genres))
+        db.session.execute(GenreFacet.__table__.delete().where(GenreFacet.kind == model.__tablename__))
+        if counts:
+            db.session.execute(GenreFacet.__table__.insert(), [
+                {'kind': kind, 'state': state, 'city': city, 'genre': genre, 'count': count}
+                for (kind, state, city, genre), count in counts.items()])
+
+
+def facet_statements(model, genre=None, state=None, city=None):
+    """The selects of (value, count) per facet of a listing filtered by genre, state and city; None for the
+    city facet until a state is chosen.
+
+    Each facet is counted under the other filters, so it lists the choices that narrow the current selection.
+    """
+    def count(field, *criteria):
+        column = getattr(GenreFacet, field)
+        total = db.func.sum(GenreFacet.count)
+        return select(column, total) \
+            .where(GenreFacet.kind == model.__tablename__, GenreFacet.count > 0, *criteria) \
+            .group_by(column).order_by(db.desc(total), column)
+
+    located = [GenreFacet.state == state] if state else []
+    if city:
+        located.append(GenreFacet.city == city)
+    return {
+        'genre': count('genre', GenreFacet.genre != ALL, *located),
+        'state': count('state', GenreFacet.genre == (genre or ALL)),
+        'city': count('city', GenreFacet.genre == (genre or ALL), GenreFacet.state == state) if state else None,
+    }
+
+
+def facet_counts(model, genre=None, state=None, city=None):
+    """The sidebar of a listing filtered by genre, state and city: [(value, count)] per facet."""
+    return {field: db.session.execute(statement).all() if statement is not None else []
+            for field, statement in facet_statements(model, genre, state, city).items()}
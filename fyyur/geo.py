@@ -0,0 +1,206 @@
+import csv
+import heapq
+import math
+
+from sqlalchemy import bindparam, event, inspect, update
+
+from models import db, Venue
+
+# ----------------------------------------------------------------------------#
+# Venue locations and "venues near me".
+#
+# Venues carry a latitude, longitude and the geohash of the two, filled in by
+# `flask geocode-venues` from a local gazetteer file rather than an online
+# service. The geohash index is the spatial index: a circle is covered by a
+# few geohash cells, each a key range of the (geohash, latitude, longitude)
+# index, so a nearby query reads only the index entries around the point,
+# keeps those within the radius and sorts them by great-circle distance. It
+# starts with a small circle and widens it until the circle holds as many
+# venues as were asked for, so dense cities don't read every venue in the
+# radius.
+# ----------------------------------------------------------------------------#
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# characters of the stored geohashes, cells of about 5 by 5 meters
+PRECISION = 9
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# a key greater than every geohash starting with a given prefix
+PREFIX_END = '~'
+
+# key ranges (cells) read per circle
+MAX_CELLS = 16
+# a nearby query first looks within FIRST_SEARCH_RADIUS km, then SEARCH_GROWTH times as far each time
+# until it has found enough venues
+FIRST_SEARCH_RADIUS = 0.5
+SEARCH_GROWTH = 4
+
+# fields a gazetteer entry is matched on, most specific first
+MATCHES = (('address', 'city', 'state'), ('city', 'state'))
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    """The geohash of a point, precision characters long."""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        span, coordinate = (lng_range, longitude) if even else (lat_range, latitude)
+        middle = (span[0] + span[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            span[0] = middle
+        else:
+            span[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """Height and width in degrees of the geohash cells of the given precision."""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance (haversine)."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """South, north, west and east edges of a box around the circle; west/east may run past +-180."""
+    dlat = radius_km / KM_PER_DEGREE
+    # the circle is widest in degrees of longitude at its edge furthest from the equator
+    edge = min(abs(latitude) + dlat, 90.0)
+    dlng = min(180.0, dlat / max(math.cos(math.radians(edge)), 1e-9))
+    return max(latitude - dlat, -90.0), min(latitude + dlat, 90.0), longitude - dlng, longitude + dlng
+
+
+def covering_cells(latitude, longitude, radius_km):
+    """Geohash prefixes whose cells together cover the circle: the finest grid of at most MAX_CELLS cells."""
+    south, north, west, east = bounding_box(latitude, longitude, radius_km)
+    for precision in range(PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        first_row, first_column = math.floor((south + 90.0) / height), math.floor((west + 180.0) / width)
+        rows = math.floor((north + 90.0) / height) - first_row + 1
+        columns = math.floor((east + 180.0) / width) - first_column + 1
+        if rows * columns <= MAX_CELLS:
+            break
+    cells = set()
+    for row in range(first_row, first_row + rows):
+        lat = min((row + 0.5) * height - 90.0, 90.0)
+        for column in range(first_column, first_column + columns):
+            cells.add(encode(lat, ((column + 0.5) * width) % 360.0 - 180.0, precision))
+    return sorted(cells)
+
+
+def within(latitude, longitude, radius_km):
+    """[(distance in km, id)] of the venues within radius_km of the point."""
+    south, north, west, east = bounding_box(latitude, longitude, radius_km)
+    candidates = db.session.query(Venue.id, Venue.latitude, Venue.longitude).filter(
+        db.or_(*[Venue.geohash.between(cell, cell + PREFIX_END)
+                 for cell in covering_cells(latitude, longitude, radius_km)]),
+        Venue.latitude.between(south, north))
+    if west >= -180.0 and east <= 180.0:
+        candidates = candidates.filter(Venue.longitude.between(west, east))
+    found = []
+    for id, lat, lng in candidates:
+        distance = distance_km(latitude, longitude, lat, lng)
+        if distance <= radius_km:
+            found.append((distance, id))
+    return found
+
+
+def nearby(latitude, longitude, radius_km, limit):
+    """The venues within radius_km of the point, nearest first: [(distance in km, venue row)]."""
+    # look in growing circles: once one holds limit venues, the nearest limit of them are the nearest of all
+    search_radius = min(FIRST_SEARCH_RADIUS, radius_km)
+    while True:
+        found = within(latitude, longitude, search_radius)
+        if len(found) >= limit or search_radius == radius_km:
+            break
+        search_radius = min(search_radius * SEARCH_GROWTH, radius_km)
+    nearest = heapq.nsmallest(limit, found)
+    if not nearest:
+        return []
+    venues = {venue.id: venue for venue in db.session.query(
+        Venue.id, Venue.name, Venue.address, Venue.city, Venue.state, Venue.latitude, Venue.longitude)
+        .filter(Venue.id.in_([id for distance, id in nearest]))}
+    return [(distance, venues[id]) for distance, id in nearest]
+
+
+#  Geocoding
+#  ----------------------------------------------------------------
+
+def normalize(value):
+    return ' '.join((value or '').lower().replace(',', ' ').replace('.', ' ').split())
+
+
+def load_gazetteer(path):
+    """Read a CSV gazetteer with city, state, latitude, longitude and optionally address columns.
+
+    Returns {(normalized address, city, state) or (city, state): (latitude, longitude)}.
+    """
+    places = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            point = (float(row['latitude']), float(row['longitude']))
+            for fields in MATCHES:
+                if all(row.get(field) for field in fields):
+                    places.setdefault(tuple(normalize(row[field]) for field in fields), point)
+                    break
+    return places
+
+
+def locate(places, address, city, state):
+    """The point of the most specific gazetteer entry matching a venue, None if there is none."""
+    values = {'address': address, 'city': city, 'state': state}
+    for fields in MATCHES:
+        point = places.get(tuple(normalize(values[field]) for field in fields))
+        if point is not None:
+            return point
+    return None
+
+
+def geocode(places, everything=False, batch_size=1000):
+    """Locate the venues not located yet (every venue with everything) in the gazetteer. The caller commits.
+
+    Returns the number of venues located and of those not found in the gazetteer.
+    """
+    query = db.session.query(Venue.id, Venue.address, Venue.city, Venue.state).order_by(Venue.id)
+    if not everything:
+        query = query.filter(Venue.geohash.is_(None))
+    statement = update(Venue.__table__).where(Venue.__table__.c.id == bindparam('venue_id')) \
+        .values(latitude=bindparam('lat'), longitude=bindparam('lng'), geohash=bindparam('hash'))
+    located, missing, rows = 0, 0, []
+    for venue in query.yield_per(batch_size):
+        point = locate(places, venue.address, venue.city, venue.state)
+        if point is None:
+            missing += 1
+            continue
+        rows.append({'venue_id': venue.id, 'lat': point[0], 'lng': point[1], 'hash': encode(*point)})
+        if len(rows) == batch_size:
+            db.session.execute(statement, rows)
+            located, rows = located + len(rows), []
+    if rows:
+        db.session.execute(statement, rows)
+        located += len(rows)
+    return located, missing
+
+
+@event.listens_for(Venue, 'before_update')
+def forget_moved_location(mapper, connection, venue):
+    # a venue whose address changed is located again by the next geocoding run
+    attrs = inspect(venue).attrs
+    if any(attrs[field].history.has_changes() for field in ('address', 'city', 'state')) \
+            and not attrs.geohash.history.has_changes():
+        venue.latitude = venue.longitude = venue.geohash = None
@@ -0,0 +1,174 @@
+import csv
+import json
+import os
+from datetime import datetime
+
+from werkzeug.datastructures import MultiDict
+
+from availability import Bookings
+from forms import VenueForm, ArtistForm, ShowForm
+from models import db, Venue, Artist, Show, ImportCheckpoint
+
+# ----------------------------------------------------------------------------#
+# Bulk import of venues, artists and shows from CSV or JSON Lines files.
+#
+# Records are streamed from the file, validated with the same forms as the
+# create pages and inserted in batches of executemany INSERTs. The number of
+# consumed records is stored in import_checkpoints in the same transaction as
+# the batch, so an interrupted import resumes where it stopped without
+# inserting a committed batch twice. Rejected records go to <file>.rejects
+# with their validation errors (a batch interrupted before its commit may
+# list them again when it is retried).
+# ----------------------------------------------------------------------------#
+
+
+def read_records(path):
+    """Yield one dict per CSV row or JSON line. List fields in CSV files are comma separated."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                if row.get('genres'):
+                    row['genres'] = [genre.strip() for genre in row['genres'].split(',')]
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def to_formdata(record):
+    formdata = MultiDict()
+    for name, value in record.items():
+        if isinstance(value, list):
+            formdata.setlist(name, [str(item) for item in value])
+        elif value is not None:
+            formdata[name] = str(value)
+    return formdata
+
+
+def venue_values(form):
+    return {
+        'name': form.name.data, 'city': form.city.data, 'state': form.state.data, 'address': form.address.data,
+        'phone': form.phone.data, 'image_link': form.image_link.data, 'genres': form.genres.data,
+        'facebook_link': form.facebook_link.data, 'website': form.website.data,
+        'seeking_talent': form.seeking_talent.data == 'True'
+    }
+
+
+def artist_values(form):
+    return {
+        'name': form.name.data, 'city': form.city.data, 'state': form.state.data, 'phone': form.phone.data,
+        'image_link': form.image_link.data, 'genres': form.genres.data, 'facebook_link': form.facebook_link.data,
+        'website': form.website.data, 'seeking_venue': form.seeking_venue.data == 'True',
+        'seeking_description': form.seeking_description.data
+    }
+
+
+def show_values(form):
+    return {
+        'artist_id': int(form.artist_id.data), 'venue_id': int(form.venue_id.data),
+        'start_time': form.start_time.data
+    }
+
+
+# kind -> (model, form, values builder)
+IMPORTERS = {
+    'venues': (Venue, VenueForm, venue_values),
+    'artists': (Artist, ArtistForm, artist_values),
+    'shows': (Show, ShowForm, show_values),
+}
+
+
+def missing_references(rows):
+    """Reject shows pointing at unknown artists or venues, which would fail the whole batch."""
+    artist_ids = {row['artist_id'] for row in rows}
+    venue_ids = {row['venue_id'] for row in rows}
+    known_artists = {id for id, in db.session.query(Artist.id).filter(Artist.id.in_(artist_ids))}
+    known_venues = {id for id, in db.session.query(Venue.id).filter(Venue.id.in_(venue_ids))}
+    return [not (row['artist_id'] in known_artists and row['venue_id'] in known_venues) for row in rows]
+
+
+def double_bookings(rows):
+    """Reject shows overlapping a booked show of their artist or venue, including earlier shows of the batch."""
+    bookings = Bookings.load(rows)
+    invalid = []
+    for row in rows:
+        conflict = bookings.conflicts(row['artist_id'], row['venue_id'], row['start_time'])
+        if not conflict:
+            bookings.add(row['artist_id'], row['venue_id'], row['start_time'])
+        invalid.append(conflict)
+    return invalid
+
+
+def load_checkpoint(path, kind):
+    checkpoint = db.session.get(ImportCheckpoint, path)
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(path=path, kind=kind, records=0, imported=0, rejected=0)
+        db.session.add(checkpoint)
+    return checkpoint
+
+
+def delete_checkpoint(path):
+    db.session.query(ImportCheckpoint).filter_by(path=path).delete()
+    db.session.commit()
+
+
+def import_file(kind, path, batch_size=5000, restart=False, progress=print):
+    """Import every record of path as kind ('venues', 'artists' or 'shows'). Returns the final checkpoint."""
+    model, form_class, values = IMPORTERS[kind]
+    checkpoint_path = os.path.abspath(path)
+    if restart:
+        delete_checkpoint(checkpoint_path)
+    checkpoint = load_checkpoint(checkpoint_path, kind)
+    if checkpoint.records:
+        progress('Resuming after {} records'.format(checkpoint.records))
+
+    with open(path + '.rejects', 'a', encoding='utf-8') as rejects:
+        def flush(rows, records, rejected):
+            if kind == 'shows' and rows:
+                invalid = missing_references([row for row, record in rows])
+                for (row, record), missing in zip(rows, invalid):
+                    if missing:
+                        rejected.append((record, {'artist_id/venue_id': ['Unknown artist or venue']}))
+                rows = [pair for pair, missing in zip(rows, invalid) if not missing]
+                invalid = double_bookings([row for row, record in rows])
+                for (row, record), conflict in zip(rows, invalid):
+                    if conflict:
+                        rejected.append((record, {'start_time': ['Artist or venue already booked']}))
+                rows = [pair for pair, conflict in zip(rows, invalid) if not conflict]
+            if rows:
+                db.session.execute(model.__table__.insert(), [row for row, record in rows])
+            checkpoint.records += records
+            checkpoint.imported += len(rows)
+            checkpoint.rejected += len(rejected)
+            checkpoint.updated_at = datetime.utcnow()
+            for record, errors in rejected:
+                rejects.write(json.dumps({'record': record, 'errors': errors}, default=str) + '\n')
+            rejects.flush()
+            # the rows and the checkpoint counting them commit together
+            db.session.commit()
+            progress('{} records read, {} imported, {} rejected'.format(checkpoint.records, checkpoint.imported,
+                                                                        checkpoint.rejected))
+
+        rows, rejected, records = [], [], 0
+        for position, record in enumerate(read_records(path)):
+            if position < checkpoint.records:
+                continue
+            records += 1
+            form = form_class(formdata=to_formdata(record), meta={'csrf': False})
+            if form.validate():
+                try:
+                    rows.append((values(form), record))
+                except ValueError as e:
+                    rejected.append((record, {'form': [str(e)]}))
+            else:
+                rejected.append((record, form.errors))
+            if records == batch_size:
+                flush(rows, records, rejected)
+                rows, rejected, records = [], [], 0
+        if records:
+            flush(rows, records, rejected)
+
+    result = {'records': checkpoint.records, 'imported': checkpoint.imported, 'rejected': checkpoint.rejected}
+    delete_checkpoint(checkpoint_path)
+    return result
@@ -0,0 +1,121 @@
+"""Compare the throughput and tail latency of running fyyur servers.
+
+Start the WSGI and ASGI modes side by side, e.g.
+
+    python app.py                                 # WSGI, http://127.0.0.1:5000
+    uvicorn asgi:application --port 8000          # ASGI, http://127.0.0.1:8000
+
+then run
+
+    python loadtest.py http://127.0.0.1:5000 http://127.0.0.1:8000 --path /venues --path /venues/1 --slow-clients 200
+
+Each server gets the same number of requests from --concurrency parallel
+clients while --slow-clients connections trickle their request headers one
+byte a second, the way slow mobile clients hold connections open.
+"""
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+async def request(host, port, path):
+    """GET path on a fresh connection, returning the status code."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write('GET {} HTTP/1.1\r\nHost: {}:{}\r\nConnection: close\r\n\r\n'.format(path, host, port).encode())
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def slow_client(host, port, path, stop):
+    """Hold a connection open by sending the request headers one byte a second until stop is set."""
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        return
+    payload = 'GET {} HTTP/1.1\r\nHost: {}:{}\r\nX-Padding: {}\r\n'.format(path, host, port, 'x' * 1000).encode()
+    try:
+        for i in range(len(payload)):
+            if stop.is_set():
+                break
+            writer.write(payload[i:i + 1])
+            await writer.drain()
+            await asyncio.sleep(1)
+    except OSError:
+        pass
+    finally:
+        writer.close()
+
+
+def percentile(samples, q):
+    return samples[min(int(q * len(samples)), len(samples) - 1)] if samples else float('nan')
+
+
+async def run(url, paths, requests, concurrency, slow_clients, timeout):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    stop = asyncio.Event()
+    slow = [asyncio.ensure_future(slow_client(host, port, paths[0], stop)) for _ in range(slow_clients)]
+    await asyncio.sleep(1 if slow_clients else 0)
+
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(paths[i % len(paths)])
+
+    async def client():
+        nonlocal errors
+        while not queue.empty():
+            path = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(request(host, port, path), timeout)
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                status = None
+            if status is not None and status < 400:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await asyncio.gather(*slow)
+    latencies.sort()
+    return {
+        'url': url,
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('urls', nargs='+', help='base URL of each server to compare')
+    parser.add_argument('--path', action='append', dest='paths', help='path to request, repeatable')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--slow-clients', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds before a request counts as failed')
+    args = parser.parse_args()
+    paths = args.paths or ['/api/v1/venues']
+
+    print('{:<32} {:>9} {:>9} {:>9} {:>9} {:>7}'.format('server', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for url in args.urls:
+        result = asyncio.run(run(url, paths, args.requests, args.concurrency, args.slow_clients, args.timeout))
+        print('{url:<32} {rps:>9.1f} {p50_ms:>9.1f} {p95_ms:>9.1f} {p99_ms:>9.1f} {errors:>7}'.format(
+            p50_ms=result['p50'] * 1000, p95_ms=result['p95'] * 1000, p99_ms=result['p99'] * 1000, **result))
+
+
+if __name__ == '__main__':
+    main()
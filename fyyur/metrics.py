@@ -0,0 +1,212 @@
+import heapq
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+
+from flask import Response, g, has_request_context, jsonify, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# ----------------------------------------------------------------------------#
+# Request instrumentation.
+#
+# Every request records how many SQL statements it ran, the time spent in the
+# database and in templates, and its latency. Per-route aggregates are
+# served in the Prometheus text format at /metrics; the slowest statements
+# seen so far are logged with the line of fyyur code that issued them and
+# listed at /metrics/slow-queries.
+# ----------------------------------------------------------------------------#
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+# latency samples kept per route to estimate the quantiles
+RESERVOIR_SIZE = 1024
+
+
+class RouteStats:
+    def __init__(self):
+        self.requests = defaultdict(int)  # (method, status) -> count
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+
+    def observe(self, method, status, latency, statements, db_seconds, template_seconds):
+        self.requests[(method, status)] += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+        self.latency_sum += latency
+        self.latency_count += 1
+        self.recent.append(latency)
+        self.statements += statements
+        self.db_seconds += db_seconds
+        self.template_seconds += template_seconds
+
+    def quantiles(self):
+        samples = sorted(self.recent)
+        if not samples:
+            return [(q, 0.0) for q in QUANTILES]
+        return [(q, samples[min(int(q * len(samples)), len(samples) - 1)]) for q in QUANTILES]
+
+
+class Metrics:
+    def __init__(self, app=None):
+        self.routes = defaultdict(RouteStats)
+        self.slow_queries = []  # min-heap of (seconds, statement, call site)
+        self.lock = threading.Lock()
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_SLOW_QUERIES', 10)
+        app.config.setdefault('METRICS_SLOW_QUERY_THRESHOLD', 100)
+        self.app = app
+        self.slow_query_count = app.config['METRICS_SLOW_QUERIES']
+        self.slow_query_threshold = app.config['METRICS_SLOW_QUERY_THRESHOLD'] / 1000
+        self.root_path = app.root_path + os.sep
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        before_render_template.connect(self.start_template, app)
+        template_rendered.connect(self.finish_template, app)
+        event.listen(Engine, 'before_cursor_execute', self.start_statement)
+        event.listen(Engine, 'after_cursor_execute', self.finish_statement)
+        app.add_url_rule('/metrics', 'metrics', self.prometheus)
+        app.add_url_rule('/metrics/slow-queries', 'slow_queries', self.slow_queries_view)
+        app.extensions['metrics'] = self
+
+    # request hooks
+
+    def start_request(self):
+        g.metrics = {'start': time.perf_counter(), 'statements': 0, 'db_seconds': 0.0,
+                     'template_seconds': 0.0, 'template_starts': []}
+
+    def finish_request(self, response):
+        stats = g.pop('metrics', None)
+        if stats is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            latency = time.perf_counter() - stats['start']
+            with self.lock:
+                self.routes[route].observe(request.method, response.status_code, latency, stats['statements'],
+                                           stats['db_seconds'], stats['template_seconds'])
+        return response
+
+    def start_template(self, sender, template, context, **extra):
+        if has_request_context() and 'metrics' in g:
+            g.metrics['template_starts'].append(time.perf_counter())
+
+    def finish_template(self, sender, template, context, **extra):
+        if has_request_context() and 'metrics' in g and g.metrics['template_starts']:
+            g.metrics['template_seconds'] += time.perf_counter() - g.metrics['template_starts'].pop()
+
+    # engine hooks
+
+    def start_statement(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_starts', []).append(time.perf_counter())
+
+    def finish_statement(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_starts')
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        if has_request_context() and 'metrics' in g:
+            g.metrics['statements'] += 1
+            g.metrics['db_seconds'] += seconds
+        if self.slow_query_count and seconds >= self.slow_query_threshold and (
+                len(self.slow_queries) < self.slow_query_count or seconds > self.slow_queries[0][0]):
+            self.record_slow_query(seconds, statement)
+
+    def record_slow_query(self, seconds, statement):
+        call_site = self.call_site()
+        with self.lock:
+            entry = (seconds, ' '.join(statement.split()), call_site)
+            if len(self.slow_queries) < self.slow_query_count:
+                heapq.heappush(self.slow_queries, entry)
+            elif seconds > self.slow_queries[0][0]:
+                heapq.heapreplace(self.slow_queries, entry)
+            else:
+                return
+        if self.app is not None:
+            self.app.logger.info('slow query %.1fms at %s: %s', seconds * 1000, call_site, entry[1][:500])
+
+    def call_site(self):
+        """The innermost frame of fyyur code (outside this module) on the current stack."""
+        frame = sys._getframe(1)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if filename.startswith(self.root_path) and filename != __file__:
+                return '{}:{} in {}'.format(filename[len(self.root_path):], frame.f_lineno, frame.f_code.co_name)
+            frame = frame.f_back
+        return 'unknown'
+
+    # views
+
+    def prometheus(self):
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, str(label).replace('"', '\\"'))
+                                      for key, label in labels)
+                lines.append('{}{}{} {}'.format(name, suffix, '{' + label_text + '}' if labels else '', value))
+
+        with self.lock:
+            routes = sorted(self.routes.items())
+            metric('fyyur_requests_total', 'counter', 'Requests served.', [
+                ('', (('route', route), ('method', method), ('status', status)), count)
+                for route, stats in routes for (method, status), count in sorted(stats.requests.items())])
+            samples = []
+            for route, stats in routes:
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    samples.append(('_bucket', (('route', route), ('le', bound)), count))
+                samples.append(('_bucket', (('route', route), ('le', '+Inf')), stats.latency_count))
+                samples.append(('_sum', (('route', route),), stats.latency_sum))
+                samples.append(('_count', (('route', route),), stats.latency_count))
+            metric('fyyur_request_duration_seconds', 'histogram', 'Request latency.', samples)
+            samples = []
+            for route, stats in routes:
+                for quantile, value in stats.quantiles():
+                    samples.append(('', (('route', route), ('quantile', quantile)), value))
+                samples.append(('_sum', (('route', route),), stats.latency_sum))
+                samples.append(('_count', (('route', route),), stats.latency_count))
+            metric('fyyur_request_latency_seconds', 'summary',
+                   'Request latency quantiles over the last {} requests.'.format(RESERVOIR_SIZE), samples)
+            metric('fyyur_db_statements_total', 'counter', 'SQL statements executed.', [
+                ('', (('route', route),), stats.statements) for route, stats in routes])
+            metric('fyyur_db_seconds_total', 'counter', 'Time spent executing SQL statements.', [
+                ('', (('route', route),), stats.db_seconds) for route, stats in routes])
+            metric('fyyur_template_seconds_total', 'counter', 'Time spent rendering templates.', [
+                ('', (('route', route),), stats.template_seconds) for route, stats in routes])
+
+        page_cache = self.app.extensions.get('page_cache') if self.app is not None else None
+        if page_cache is not None:
+            cache_stats = page_cache.stats()
+            metric('fyyur_page_cache_hits_total', 'counter', 'Page cache hits.', [('', (), cache_stats['hits'])])
+            metric('fyyur_page_cache_misses_total', 'counter', 'Page cache misses.',
+                   [('', (), cache_stats['misses'])])
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+    def slow_queries_view(self):
+        with self.lock:
+            slowest = sorted(self.slow_queries, reverse=True)
+        return jsonify({
+            'success': True,
+            'queries': [{'seconds': seconds, 'statement': statement, 'call_site': call_site}
+                        for seconds, statement, call_site in slowest]
+        })
+
+    def reset(self):
+        with self.lock:
+            self.routes.clear()
+            self.slow_queries = []
+
+
+metrics = Metrics()
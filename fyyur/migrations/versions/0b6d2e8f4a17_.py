@@ -0,0 +1,43 @@
+"""add genre indexes and precomputed genre facet counts
+
+Revision ID: 0b6d2e8f4a17
+Revises: f3a9c2d1b7e6
+Create Date: 2020-08-16 11:47:05.208316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b6d2e8f4a17'
+down_revision = 'f3a9c2d1b7e6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_venues_genres', 'venues', ['genres'], unique=False, postgresql_using='gin')
+    op.create_index('ix_artists_genres', 'artists', ['genres'], unique=False, postgresql_using='gin')
+    op.create_table('genre_facets',
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('state', sa.String(length=120), nullable=False),
+    sa.Column('city', sa.String(length=120), nullable=False),
+    sa.Column('genre', sa.String(length=120), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'state', 'city', 'genre')
+    )
+    # every genre of every row, plus '' counting the row itself
+    for table in ('venues', 'artists'):
+        op.execute(
+            "INSERT INTO genre_facets (kind, state, city, genre, count) "
+            "SELECT '{0}', state, city, genre, count(DISTINCT id) "
+            "FROM {0}, unnest(coalesce(genres, '{{}}') || ARRAY['']::varchar[]) AS genre "
+            "GROUP BY state, city, genre".format(table)
+        )
+
+
+def downgrade():
+    op.drop_table('genre_facets')
+    op.drop_index('ix_artists_genres', table_name='artists')
+    op.drop_index('ix_venues_genres', table_name='venues')
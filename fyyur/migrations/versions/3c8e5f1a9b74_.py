@@ -0,0 +1,30 @@
+"""venue and artist page documents
+
+Revision ID: 3c8e5f1a9b74
+Revises: 9d4b7a2c1e58
+Create Date: 2020-08-19 09:27:51.804417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c8e5f1a9b74'
+down_revision = '9d4b7a2c1e58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # filled by `flask rebuild-documents`; until then the pages are built from the tables
+    op.create_table('detail_documents',
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('document', sa.JSON(), nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'id')
+    )
+
+
+def downgrade():
+    op.drop_table('detail_documents')
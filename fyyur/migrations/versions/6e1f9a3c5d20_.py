@@ -0,0 +1,27 @@
+"""delete shows together with their venue or artist
+
+Revision ID: 6e1f9a3c5d20
+Revises: 0b6d2e8f4a17
+Create Date: 2020-08-17 15:12:40.661093
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '6e1f9a3c5d20'
+down_revision = '0b6d2e8f4a17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for column, table in (('artist_id', 'artists'), ('venue_id', 'venues')):
+        op.drop_constraint('shows_{}_fkey'.format(column), 'shows', type_='foreignkey')
+        op.create_foreign_key('shows_{}_fkey'.format(column), 'shows', table, [column], ['id'], ondelete='CASCADE')
+
+
+def downgrade():
+    for column, table in (('artist_id', 'artists'), ('venue_id', 'venues')):
+        op.drop_constraint('shows_{}_fkey'.format(column), 'shows', type_='foreignkey')
+        op.create_foreign_key('shows_{}_fkey'.format(column), 'shows', table, [column], ['id'])
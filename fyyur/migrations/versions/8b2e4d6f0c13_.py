@@ -0,0 +1,35 @@
+"""add full-text search indexes over the searchable venue and artist columns
+
+Revision ID: 8b2e4d6f0c13
+Revises: 5f1c3e8d9a21
+Create Date: 2020-08-05 18:40:02.551370
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4d6f0c13'
+down_revision = '5f1c3e8d9a21'
+branch_labels = None
+depends_on = None
+
+# must stay in sync with search.document_sql() so the planner can match the expression
+VENUE_DOCUMENT = ("setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+                  "setweight(to_tsvector('simple', coalesce(city, '')), 'B') || "
+                  "setweight(to_tsvector('simple', coalesce(state, '')), 'B') || "
+                  "setweight(to_tsvector('simple', coalesce(address, '')), 'B')")
+ARTIST_DOCUMENT = ("setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+                   "setweight(to_tsvector('simple', coalesce(city, '')), 'B') || "
+                   "setweight(to_tsvector('simple', coalesce(state, '')), 'B')")
+
+
+def upgrade():
+    op.execute('CREATE INDEX ix_venues_search ON venues USING gin (({}))'.format(VENUE_DOCUMENT))
+    op.execute('CREATE INDEX ix_artists_search ON artists USING gin (({}))'.format(ARTIST_DOCUMENT))
+
+
+def downgrade():
+    op.drop_index('ix_artists_search', table_name='artists')
+    op.drop_index('ix_venues_search', table_name='venues')
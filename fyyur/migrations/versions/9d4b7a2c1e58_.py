@@ -0,0 +1,31 @@
+"""submissions written by the write-behind queue
+
+Revision ID: 9d4b7a2c1e58
+Revises: 6e1f9a3c5d20
+Create Date: 2020-08-18 10:41:07.318524
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4b7a2c1e58'
+down_revision = '6e1f9a3c5d20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('submissions',
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('writer', sa.String(length=60), nullable=False),
+    sa.Column('result_id', sa.Integer(), nullable=True),
+    sa.Column('error', sa.String(length=500), nullable=True),
+    sa.Column('written_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('submissions')
@@ -0,0 +1,49 @@
+"""add venue and artist show summaries
+
+Revision ID: c41a7e29d5b8
+Revises: 8b2e4d6f0c13
+Create Date: 2020-08-09 14:03:11.872645
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41a7e29d5b8'
+down_revision = '8b2e4d6f0c13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('show_summary_checkpoint',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('rolled_over_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    for table in ('venues', 'artists'):
+        op.add_column(table, sa.Column('upcoming_shows_count', sa.Integer(), server_default='0', nullable=False))
+        op.add_column(table, sa.Column('past_shows_count', sa.Integer(), server_default='0', nullable=False))
+        op.add_column(table, sa.Column('next_show_time', sa.DateTime(), nullable=True))
+
+    # backfill, same as `flask rebuild-summaries`
+    op.execute("INSERT INTO show_summary_checkpoint (id, rolled_over_at) VALUES (1, now() at time zone 'utc')")
+    for table, foreign_key in (('venues', 'venue_id'), ('artists', 'artist_id')):
+        op.execute("""
+            UPDATE {0} SET
+              upcoming_shows_count = (SELECT count(*) FROM shows
+                                      WHERE shows.{1} = {0}.id AND start_time > (SELECT rolled_over_at FROM show_summary_checkpoint)),
+              past_shows_count = (SELECT count(*) FROM shows
+                                  WHERE shows.{1} = {0}.id AND start_time <= (SELECT rolled_over_at FROM show_summary_checkpoint)),
+              next_show_time = (SELECT min(start_time) FROM shows
+                                WHERE shows.{1} = {0}.id AND start_time > (SELECT rolled_over_at FROM show_summary_checkpoint))
+        """.format(table, foreign_key))
+
+
+def downgrade():
+    for table in ('artists', 'venues'):
+        op.drop_column(table, 'next_show_time')
+        op.drop_column(table, 'past_shows_count')
+        op.drop_column(table, 'upcoming_shows_count')
+    op.drop_table('show_summary_checkpoint')
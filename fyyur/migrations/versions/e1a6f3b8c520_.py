@@ -0,0 +1,32 @@
+"""venue locations
+
+Revision ID: e1a6f3b8c520
+Revises: b5e2c7d94f31
+Create Date: 2020-08-21 11:48:36.207195
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1a6f3b8c520'
+down_revision = 'b5e2c7d94f31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # filled by `flask geocode-venues`
+    op.add_column('venues', sa.Column('latitude', sa.Float(), nullable=True))
+    op.add_column('venues', sa.Column('longitude', sa.Float(), nullable=True))
+    op.add_column('venues', sa.Column('geohash', postgresql.VARCHAR(length=12, collation='C'), nullable=True))
+    op.create_index('ix_venues_geohash', 'venues', ['geohash', 'latitude', 'longitude', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_venues_geohash', table_name='venues')
+    op.drop_column('venues', 'geohash')
+    op.drop_column('venues', 'longitude')
+    op.drop_column('venues', 'latitude')
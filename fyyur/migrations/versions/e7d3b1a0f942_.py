@@ -0,0 +1,26 @@
+"""add updated_at to venues and artists for the JSON API
+
+Revision ID: e7d3b1a0f942
+Revises: c41a7e29d5b8
+Create Date: 2020-08-12 09:26:37.114580
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7d3b1a0f942'
+down_revision = 'c41a7e29d5b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('venues', sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False))
+    op.add_column('artists', sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False))
+
+
+def downgrade():
+    op.drop_column('artists', 'updated_at')
+    op.drop_column('venues', 'updated_at')
@@ -0,0 +1,28 @@
+"""reject overlapping shows of the same artist or at the same venue
+
+Revision ID: f3a9c2d1b7e6
+Revises: e7d3b1a0f942
+Create Date: 2020-08-14 18:02:51.430917
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a9c2d1b7e6'
+down_revision = 'e7d3b1a0f942'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # shows last 3 hours (availability.SHOW_LENGTH); existing double bookings must be resolved first
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+    for column in ('artist_id', 'venue_id'):
+        op.execute("ALTER TABLE shows ADD CONSTRAINT shows_{0}_no_overlap EXCLUDE USING gist "
+                   "({0} WITH =, tsrange(start_time, start_time + interval '3 hours') WITH &&)".format(column))
+
+
+def downgrade():
+    op.drop_constraint('shows_venue_id_no_overlap', 'shows')
+    op.drop_constraint('shows_artist_id_no_overlap', 'shows')
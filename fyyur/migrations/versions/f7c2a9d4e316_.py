@@ -0,0 +1,24 @@
+"""time outbox gaps from when the relay found them
+
+Revision ID: f7c2a9d4e316
+Revises: e1a6f3b8c520
+Create Date: 2020-08-24 10:12:51.640318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7c2a9d4e316'
+down_revision = 'e1a6f3b8c520'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('outbox_offsets', sa.Column('waiting_since', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('outbox_offsets', 'waiting_since')
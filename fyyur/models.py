@@ -1,26 +1,48 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql
 from datetime import datetime
 
-db = SQLAlchemy()
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 
 class Venue(db.Model):
     __tablename__ = 'venues'
     __searchable__ = ["name", "city", "state", "address"]
+    __table_args__ = (
+        db.Index('ix_venues_state_city', 'state', 'city'),
+        db.Index('ix_venues_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+        db.Index('ix_venues_genres', 'genres', postgresql_using='gin'),
+        # covers the nearby queries of geo.py
+        db.Index('ix_venues_geohash', 'geohash', 'latitude', 'longitude', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     city = db.Column(db.String(120), nullable=False)
     state = db.Column(db.String(120), nullable=False)
     address = db.Column(db.String(120))
+    # location from the gazetteer, maintained by geo.py; the geohash sorts bytewise so prefixes are key ranges
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    geohash = db.Column(db.String(12).with_variant(postgresql.VARCHAR(12, collation='C'), 'postgresql'))
     phone = db.Column(db.String(120))
     image_link = db.Column(db.String(500))
     facebook_link = db.Column(db.String(120))
     genres = db.Column(db.ARRAY(db.String))
     seeking_talent = db.Column(db.Boolean, nullable=False, default=False)
     website = db.Column(db.String(120))
+    # show summary, maintained by summaries.py
+    upcoming_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    past_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    next_show_time = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           server_default=db.func.now())
 
-    shows = db.relationship("Show", backref='venues', lazy=True)
+    # shows go with their venue/artist, deleted by the database (or deletion.py) rather than loaded and orphaned
+    shows = db.relationship("Show", backref='venues', lazy=True, passive_deletes=True)
 
     def to_dict(self):
         """ Returns a dictionary of venues """
@@ -31,11 +53,13 @@ class Venue(db.Model):
             'state': self.state,
             'address': self.address,
             'phone': self.phone,
-            'genres': self.genres.split(','),  # convert string to list
+            'genres': list(self.genres or []),
             'image_link': self.image_link,
             'facebook_link': self.facebook_link,
             'seeking_talent': self.seeking_talent,
-            'website': self.website
+            'website': self.website,
+            'latitude': self.latitude,
+            'longitude': self.longitude
         }
 
     def __repr__(self):
@@ -51,6 +75,10 @@ class Venue(db.Model):
 class Artist(db.Model):
     __tablename__ = 'artists'
     __searchable__ = ["name", "city", "state"]
+    __table_args__ = (
+        db.Index('ix_artists_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+        db.Index('ix_artists_genres', 'genres', postgresql_using='gin'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
@@ -63,7 +91,13 @@ class Artist(db.Model):
     website = db.Column(db.String(120))
     seeking_venue = db.Column(db.Boolean, nullable=False, default=False)
     seeking_description = db.Column(db.String(500))
-    shows = db.relationship("Show", backref='artists', lazy=True)
+    # show summary, maintained by summaries.py
+    upcoming_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    past_shows_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    next_show_time = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                           server_default=db.func.now())
+    shows = db.relationship("Show", backref='artists', lazy=True, passive_deletes=True)
 
     def to_dict(self):
         """ Returns a dictionary of artists """
@@ -72,7 +106,7 @@ class Artist(db.Model):
             'name': self.name,
             'city': self.city,
             'state': self.state,
-            'genres': self.genres.split(','),  # convert string to list
+            'genres': list(self.genres or []),
             'phone': self.phone,
             'image_link': self.image_link,
             'facebook_link': self.facebook_link,
@@ -93,9 +127,14 @@ class Artist(db.Model):
 
 class Show(db.Model):
     __tablename__ = 'shows'
+    __table_args__ = (
+        db.Index('ix_shows_venue_id_start_time', 'venue_id', 'start_time'),
+        db.Index('ix_shows_artist_id_start_time', 'artist_id', 'start_time'),
+        db.Index('ix_shows_start_time_id', 'start_time', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    artist_id = db.Column(db.Integer, db.ForeignKey('artists.id'), nullable=False)
-    venue_id = db.Column(db.Integer, db.ForeignKey('venues.id'), nullable=False)
+    artist_id = db.Column(db.Integer, db.ForeignKey('artists.id', ondelete='CASCADE'), nullable=False)
+    venue_id = db.Column(db.Integer, db.ForeignKey('venues.id', ondelete='CASCADE'), nullable=False)
     start_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     def __repr__(self):
@@ -128,3 +167,79 @@ class Show(db.Model):
             'start_time': self.start_time
 
         }
+
+
+class ShowSummaryCheckpoint(db.Model):
+    """Single row holding the time up to which the show summaries classify shows as past."""
+    __tablename__ = 'show_summary_checkpoint'
+    id = db.Column(db.Integer, primary_key=True)
+    rolled_over_at = db.Column(db.DateTime, nullable=False)
+
+
+class ImportCheckpoint(db.Model):
+    """Records of a file consumed by `flask import-catalog`, committed with the rows they imported."""
+    __tablename__ = 'import_checkpoints'
+    path = db.Column(db.String(500), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    records = db.Column(db.Integer, nullable=False, default=0)
+    imported = db.Column(db.Integer, nullable=False, default=0)
+    rejected = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class GenreFacet(db.Model):
+    """Number of venues or artists (kind) per state, city and genre, maintained by facets.py.
+
+    The rows with an empty genre count every venue/artist of the city.
+    """
+    __tablename__ = 'genre_facets'
+    kind = db.Column(db.String(20), primary_key=True)
+    state = db.Column(db.String(120), primary_key=True)
+    city = db.Column(db.String(120), primary_key=True)
+    genre = db.Column(db.String(120), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class DetailDocument(db.Model):
+    """The page of a venue or artist (kind) with its shows as one JSON document, maintained by readmodel.py."""
+    __tablename__ = 'detail_documents'
+    kind = db.Column(db.String(20), primary_key=True)
+    id = db.Column(db.Integer, primary_key=True)
+    document = db.Column(db.JSON, nullable=False)
+
+
+class OutboxEvent(db.Model):
+    """A change to a venue, artist or show, written in its transaction and published by outbox.py."""
+    __tablename__ = 'outbox'
+    # the offset of the event; BIGINT on Postgres, SQLite only autoincrements INTEGER keys
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer)
+    op = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class OutboxOffset(db.Model):
+    """Offset of the last outbox event published to a consumer."""
+    __tablename__ = 'outbox_offsets'
+    consumer = db.Column(db.String(120), primary_key=True)
+    position = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # since when the relay has found the event after position missing while later ones are there
+    waiting_since = db.Column(db.DateTime)
+
+
+class Submission(db.Model):
+    """A form submission written by the write-behind queue: the row it wrote (result_id) or why it failed."""
+    __tablename__ = 'submissions'
+    id = db.Column(db.String(32), primary_key=True)
+    writer = db.Column(db.String(60), nullable=False)
+    result_id = db.Column(db.Integer)
+    error = db.Column(db.String(500))
+    written_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# The trigram indexes on venue and artist names need pg_trgm, so make sure it exists before create_all()
+event.listen(db.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
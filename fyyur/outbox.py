@@ -0,0 +1,244 @@
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy import event, insert, select
+from sqlalchemy.orm import Session
+
+from models import db, Venue, Artist, Show, OutboxEvent, OutboxOffset
+
+# ----------------------------------------------------------------------------#
+# Change events of venues, artists and shows.
+#
+# Every transaction that creates, edits or deletes one writes a row per change
+# to the outbox table before it commits, so an event exists exactly when its
+# change does. A relay (`flask relay-events SINK`) publishes them in batches,
+# in offset (outbox id) order, to a sink: a JSON lines file, a SQLite queue or
+# a Redis stream. Each consumer's position is kept in outbox_offsets and only
+# moves once a batch is published, so a crashed relay publishes the batch
+# again (consumers see every event at least once) and --replay-from moves it
+# back to publish old events again. An offset missing between published ones
+# holds the relay up until its transaction commits, or for GAP_TIMEOUT from
+# when the relay first missed it if that transaction rolled back.
+# ----------------------------------------------------------------------------#
+
+ENTITIES = {Venue: 'venue', Artist: 'artist', Show: 'show'}
+
+# an id the relay has been waiting for this long, with later ones published, belongs to a rolled back
+# transaction rather than one yet to commit
+GAP_TIMEOUT = timedelta(seconds=60)
+
+
+def payload(obj):
+    if isinstance(obj, Show):
+        return {'id': obj.id, 'artist_id': int(obj.artist_id), 'venue_id': int(obj.venue_id),
+                'start_time': obj.start_time.isoformat()}
+    return obj.to_dict()
+
+
+def change(entity, op, entity_id, data=None):
+    return {'entity': entity, 'entity_id': entity_id, 'op': op, 'payload': data}
+
+
+def record(session, model, op, ids):
+    """Add events for changes made with set-based statements, written when session commits."""
+    session.info.setdefault('outbox_events', []).extend(
+        change(ENTITIES[model], op, id, {'id': id} if op == 'deleted' else None) for id in ids)
+
+
+def shows_deleted(session, model, ids):
+    """Add one event per venue/artist whose shows were all deleted with a set-based statement, rather than one
+    per show."""
+    key = ENTITIES[model] + '_id'
+    session.info.setdefault('outbox_events', []).extend(
+        change('show', ENTITIES[model] + '_shows_deleted', None, {key: id}) for id in ids)
+
+
+def reloaded(session, model):
+    """Tell consumers that rows of model were bulk loaded without events, so they should resync them."""
+    session.info.setdefault('outbox_events', []).append(change(ENTITIES[model], 'reloaded', None))
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_events(session, flush_context):
+    events = session.info.setdefault('outbox_events', [])
+    for model, entity in ENTITIES.items():
+        for obj in session.new:
+            if type(obj) is model:
+                events.append(change(entity, 'created', obj.id, payload(obj)))
+        for obj in session.dirty:
+            if type(obj) is model and session.is_modified(obj, include_collections=False):
+                events.append(change(entity, 'updated', obj.id, payload(obj)))
+        for obj in session.deleted:
+            if type(obj) is model:
+                events.append(change(entity, 'deleted', obj.id, {'id': obj.id}))
+
+
+@event.listens_for(Session, 'before_commit')
+def write_events(session):
+    session.flush()
+    events = session.info.pop('outbox_events', None)
+    if events:
+        now = datetime.utcnow()
+        session.execute(insert(OutboxEvent), [dict(event, created_at=now) for event in events])
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_events(session):
+    session.info.pop('outbox_events', None)
+
+
+#  Sinks
+#  ----------------------------------------------------------------
+
+class FileSink:
+    """Appends the events to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def publish(self, events):
+        self.file.write(''.join(json.dumps(event) + '\n' for event in events))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class SQLiteSink:
+    """A queue table in a SQLite file, keyed by offset, so events published again aren't queued twice."""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS events (offset INTEGER PRIMARY KEY, event TEXT NOT NULL)')
+
+    def publish(self, events):
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO events (offset, event) VALUES (?, ?)',
+                                        [(event['offset'], json.dumps(event)) for event in events])
+
+    def close(self):
+        self.connection.close()
+
+
+class RedisSink:
+    """Appends the events to a stream (?stream=, default fyyur-events) on a Redis-compatible server, with the
+    offset as the entry id, so events published again are refused rather than added twice."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('a redis:// sink needs the redis package (pip install redis)')
+        parsed = urlparse(url)
+        self.stream = parse_qs(parsed.query).get('stream', ['fyyur-events'])[0]
+        self.client = redis.Redis.from_url(parsed._replace(query='').geturl())
+
+    def publish(self, events):
+        pipeline = self.client.pipeline(transaction=False)
+        for event in events:
+            pipeline.xadd(self.stream, {'event': json.dumps(event)}, id='{}-0'.format(event['offset']))
+        for result in pipeline.execute(raise_on_error=False):
+            # an entry at or below the last id of the stream was published before
+            if isinstance(result, Exception) and 'equal or smaller' not in str(result):
+                raise result
+
+    def close(self):
+        self.client.close()
+
+
+def open_sink(url):
+    """The sink of file:PATH (or just PATH), sqlite:PATH or redis://HOST:PORT/DB?stream=NAME."""
+    scheme, _, rest = url.partition(':')
+    if scheme == 'redis' or scheme == 'rediss':
+        return RedisSink(url)
+    if scheme == 'sqlite':
+        return SQLiteSink(urlparse(url).path if rest.startswith('//') else rest)
+    if scheme == 'file':
+        return FileSink(urlparse(url).path if rest.startswith('//') else rest)
+    return FileSink(url)
+
+
+#  Relay
+#  ----------------------------------------------------------------
+
+def as_event(row):
+    return {
+        'offset': row.id,
+        'entity': row.entity,
+        'id': row.entity_id,
+        'op': row.op,
+        'data': row.payload,
+        'at': row.created_at.isoformat(),
+    }
+
+
+def consumer_offset(consumer):
+    """The consumer's position, locked until commit so two relays of one consumer don't publish a batch twice."""
+    offset = db.session.get(OutboxOffset, consumer, with_for_update=True)
+    if offset is None:
+        offset = OutboxOffset(consumer=consumer, position=0)
+        db.session.add(offset)
+    return offset
+
+
+def relay_batch(sink, consumer, batch_size=500):
+    """Publish the next batch of events to sink and move the consumer past it. Returns the number published."""
+    offset = consumer_offset(consumer)
+    rows = db.session.execute(select(OutboxEvent).where(OutboxEvent.id > offset.position)
+                              .order_by(OutboxEvent.id).limit(batch_size)).scalars().all()
+    # stop at an id not committed yet, or events committing out of order would be skipped; the wait is timed
+    # from when the relay first found the id missing, however long its transaction has been open
+    now = datetime.utcnow()
+    expected, batch, gap = offset.position + 1, [], False
+    for row in rows:
+        if row.id != expected:
+            if batch or offset.waiting_since is None:
+                offset.waiting_since, gap = now, True
+                break
+            if now - offset.waiting_since < GAP_TIMEOUT:
+                gap = True
+                break
+        batch.append(as_event(row))
+        expected = row.id + 1
+    if not gap:
+        offset.waiting_since = None
+    if batch:
+        sink.publish(batch)
+        offset.position = batch[-1]['offset']
+        offset.updated_at = now
+    db.session.commit()
+    return len(batch)
+
+
+def relay(sink, consumer, batch_size=500, interval=1.0, once=False):
+    """Publish events as they come, polling every interval seconds when caught up. Returns the number published
+    (with once, after publishing what is there now)."""
+    published = 0
+    while True:
+        count = relay_batch(sink, consumer, batch_size)
+        published += count
+        if count < batch_size:
+            if once:
+                return published
+            time.sleep(interval)
+
+
+def replay_from(consumer, offset):
+    """Move the consumer back (or forward) so the next relay publishes from offset on. The caller commits."""
+    position = consumer_offset(consumer)
+    position.position, position.waiting_since = max(offset - 1, 0), None
+
+
+def prune(before):
+    """Delete the events created before the given time that every consumer has been sent. The caller commits.
+
+    Returns the number deleted.
+    """
+    consumed = db.session.query(db.func.min(OutboxOffset.position)).scalar() or 0
+    return db.session.execute(OutboxEvent.__table__.delete().where(
+        OutboxEvent.id <= consumed, OutboxEvent.created_at < before)).rowcount
@@ -0,0 +1,192 @@
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+import summaries
+from models import db, Venue, Artist, Show, DetailDocument
+
+# ----------------------------------------------------------------------------#
+# Read model of the venue and artist pages.
+#
+# detail_documents holds the page of every venue and artist as one JSON
+# document, its shows embedded, so /venues/<id> and /artists/<id> are a single
+# primary key fetch. The documents a transaction makes stale are rewritten in
+# that transaction just before it commits: those of the venues/artists it
+# inserted, edited or deleted, of both ends of the shows it touched, and of
+# the venues/artists playing with a venue/artist whose name or image changed.
+# Set-based writes mark what they change with mark_stale(); bulk loads call
+# rebuild() (`flask rebuild-documents`). A page without a document yet is
+# built from the tables.
+# ----------------------------------------------------------------------------#
+
+DOCUMENTED = (Venue, Artist)
+
+# model -> (foreign key of its shows, the model at the other end of them, foreign key to that one)
+SHOW_SIDES = {
+    Venue: (Show.venue_id, Artist, Show.artist_id),
+    Artist: (Show.artist_id, Venue, Show.venue_id),
+}
+
+# the fields of a venue/artist embedded in the documents of the artists/venues it has shows with
+EMBEDDED = ('name', 'image_link')
+
+SEEKING_TALENT_DESCRIPTION = "We are on the lookout for a local artist to play every two weeks. Please call us."
+
+# ids per statement when rewriting documents
+CHUNK_SIZE = 1000
+
+
+def venue_document(venue, past_shows, upcoming_shows):
+    return {
+        "id": venue.id,
+        "name": venue.name,
+        "genres": list(venue.genres or []),
+        "address": venue.address,
+        "city": venue.city,
+        "state": venue.state,
+        "phone": venue.phone,
+        "website": venue.website,
+        "facebook_link": venue.facebook_link,
+        "seeking_talent": venue.seeking_talent,
+        "seeking_description": SEEKING_TALENT_DESCRIPTION if venue.seeking_talent else '',
+        "image_link": venue.image_link,
+        "past_shows": past_shows,
+        "upcoming_shows": upcoming_shows,
+        "past_shows_count": venue.past_shows_count,
+        "upcoming_shows_count": venue.upcoming_shows_count,
+    }
+
+
+def artist_document(artist, past_shows, upcoming_shows):
+    return {
+        "id": artist.id,
+        "name": artist.name,
+        "genres": list(artist.genres or []),
+        "city": artist.city,
+        "state": artist.state,
+        "phone": artist.phone,
+        "website": artist.website,
+        "facebook_link": artist.facebook_link,
+        "seeking_venue": artist.seeking_venue,
+        "seeking_description": artist.seeking_description,
+        "image_link": artist.image_link,
+        "past_shows": past_shows,
+        "upcoming_shows": upcoming_shows,
+        "past_shows_count": artist.past_shows_count,
+        "upcoming_shows_count": artist.upcoming_shows_count,
+    }
+
+
+DOCUMENTS = {Venue: venue_document, Artist: artist_document}
+
+
+def build(session, model, ids, boundary):
+    """The documents of the given venues or artists, {id: document}, with shows split at the summary boundary."""
+    foreign_key, other, other_key = SHOW_SIDES[model]
+    prefix = other.__tablename__[:-1] + '_'
+    past, upcoming = {id: [] for id in ids}, {id: [] for id in ids}
+    for show in session.execute(
+            select(foreign_key.label('owner_id'), other_key.label('other_id'), Show.start_time, other.name,
+                   other.image_link)
+            .join(other, other.id == other_key)
+            .where(foreign_key.in_(ids))
+            .order_by(db.desc(Show.start_time))):
+        (upcoming if show.start_time > boundary else past)[show.owner_id].append({
+            prefix + 'id': show.other_id,
+            prefix + 'name': show.name,
+            prefix + 'image_link': show.image_link,
+            'start_time': show.start_time.isoformat()
+        })
+    rows = session.execute(select(*model.__table__.c).where(model.id.in_(ids)))
+    return {row.id: DOCUMENTS[model](row, past[row.id], upcoming[row.id]) for row in rows}
+
+
+def write(session, model, ids, boundary):
+    """Rewrite the documents of the given venues or artists, deleting those of rows that are gone."""
+    connection = session.connection()
+    insert = (postgresql if connection.dialect.name == 'postgresql' else sqlite).insert
+    table = DetailDocument.__table__
+    ids = sorted(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[start:start + CHUNK_SIZE]
+        documents = build(session, model, chunk, boundary)
+        gone = [id for id in chunk if id not in documents]
+        if gone:
+            session.execute(table.delete().where(table.c.kind == model.__tablename__, table.c.id.in_(gone)))
+        if documents:
+            statement = insert(table).values([{'kind': model.__tablename__, 'id': id, 'document': document}
+                                              for id, document in documents.items()])
+            session.execute(statement.on_conflict_do_update(
+                index_elements=['kind', 'id'], set_={'document': statement.excluded.document}))
+
+
+def document_statement(model, id):
+    return select(DetailDocument.document).where(DetailDocument.kind == model.__tablename__, DetailDocument.id == id)
+
+
+def build_document(connection, model, id):
+    """The page of a venue or artist built from the tables, for one without a document yet."""
+    return build(connection, model, [id], summaries.rolled_over_at(connection)).get(id)
+
+
+def document(model, id):
+    """The page of a venue or artist, None if there is no such row."""
+    data = db.session.execute(document_statement(model, id)).scalar()
+    if data is None:
+        data = build_document(db.session, model, id)
+    return data
+
+
+def mark_stale(session, model, ids, counterparts=False):
+    """Have the documents of the given venues or artists rewritten when session commits; with counterparts,
+    also those of the artists/venues they have shows with."""
+    session.info.setdefault('stale_documents', set()).update((model, id, counterparts) for id in ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_stale_documents(session, flush_context):
+    stale = session.info.setdefault('stale_documents', set())
+    for obj in session.new | session.dirty | session.deleted:
+        if type(obj) in DOCUMENTED:
+            attrs = inspect(obj).attrs
+            renamed = obj in session.dirty and any(attrs[field].history.has_changes() for field in EMBEDDED)
+            stale.add((type(obj), obj.id, renamed))
+        elif isinstance(obj, Show):
+            stale.add((Venue, int(obj.venue_id), False))
+            stale.add((Artist, int(obj.artist_id), False))
+
+
+@event.listens_for(Session, 'before_commit')
+def write_stale_documents(session):
+    session.flush()
+    entries = session.info.pop('stale_documents', None)
+    if not entries:
+        return
+    stale = {model: set() for model in DOCUMENTED}
+    for model, id, counterparts in entries:
+        stale[model].add(id)
+    for model in DOCUMENTED:
+        ids = [id for kind, id, counterparts in entries if kind is model and counterparts]
+        if ids:
+            foreign_key, other, other_key = SHOW_SIDES[model]
+            stale[other].update(id for id, in session.execute(
+                select(other_key).where(foreign_key.in_(ids)).distinct()))
+    boundary = summaries.rolled_over_at(session)
+    for model, ids in stale.items():
+        if ids:
+            write(session, model, ids, boundary)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_stale_documents(session):
+    session.info.pop('stale_documents', None)
+
+
+def rebuild(models=DOCUMENTED):
+    """Rewrite every document of models from the tables, after bulk writes that bypass the ORM. The caller
+    commits."""
+    boundary = summaries.rolled_over_at()
+    for model in models:
+        db.session.execute(DetailDocument.__table__.delete().where(DetailDocument.kind == model.__tablename__))
+        ids = db.session.scalars(select(model.id).order_by(model.id)).all()
+        write(db.session, model, ids, boundary)
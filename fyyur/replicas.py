@@ -0,0 +1,106 @@
+import functools
+import math
+import random
+import time
+
+import sqlalchemy as sa
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+# ----------------------------------------------------------------------------#
+# Read replicas.
+#
+# Views marked with @replicas.reads run their SELECTs on one of the replica
+# engines (picked once per request); everything else, and every statement of
+# a request that has written, goes to the primary. A client that wrote gets a
+# cookie sending its reads to the primary for REPLICA_MAX_LAG seconds, so it
+# reads back its own changes however far behind the replicas are. The process
+# that wrote does the same for all its clients for that long. Other processes
+# only know from the page cache, which holds off storing pages under freshly
+# invalidated tags for REPLICA_MAX_LAG (CACHE_HOLD_AFTER_INVALIDATE), so a
+# page rendered from a lagging replica is served but not cached. The async
+# views of asgi.py pick their replica with replica_allowed() too.
+# ----------------------------------------------------------------------------#
+
+PRIMARY_COOKIE = 'fyyur_primary_until'
+
+
+class Replicas:
+    def __init__(self, app=None):
+        self.engines = []
+        self.max_lag = 0
+        self.primary_until = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_MAX_LAG', 5)
+        options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        self.engines = [sa.create_engine(uri, **options) for uri in app.config['SQLALCHEMY_REPLICA_URIS']]
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        app.after_request(self.remember_write)
+        app.extensions['replicas'] = self
+
+    def reads(self, view):
+        """Let the SELECTs of a read-only view go to a replica."""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.replica_reads = True
+            return view(*args, **kwargs)
+        return wrapper
+
+    def engine_for(self, clause):
+        """The replica engine clause should run on, None for the primary."""
+        if not self.engines or not has_request_context() or not g.get('replica_reads') or g.get('wrote'):
+            return None
+        if not isinstance(clause, sa.Select) or clause._for_update_arg is not None:
+            return None
+        if not self.replica_allowed():
+            return None
+        if 'replica' not in g:
+            g.replica = random.choice(self.engines)
+        return g.replica
+
+    def replica_allowed(self):
+        """Whether the current request may read from a replica: neither it nor this process wrote within
+        REPLICA_MAX_LAG."""
+        now = time.time()
+        if g.get('wrote') or now < self.primary_until:
+            return False
+        return now >= request.cookies.get(PRIMARY_COOKIE, 0.0, type=float)
+
+    def wrote(self):
+        self.primary_until = time.time() + self.max_lag
+        if has_request_context():
+            g.wrote = True
+
+    def remember_write(self, response):
+        if self.engines and g.get('wrote'):
+            response.set_cookie(PRIMARY_COOKIE, str(time.time() + self.max_lag),
+                                max_age=math.ceil(self.max_lag), httponly=True)
+        return response
+
+
+replicas = Replicas()
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing:
+            engine = replicas.engine_for(clause)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def flushed(session, flush_context):
+    replicas.wrote()
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def executed(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        replicas.wrote()
@@ -0,0 +1,127 @@
+from datetime import datetime
+
+import dateutil.parser
+from flask import abort, request
+from sqlalchemy import select
+
+from availability import SHOW_LENGTH
+from models import db, Venue, Artist, Show
+
+# ----------------------------------------------------------------------------#
+# Time-range queries over shows and iCalendar feeds.
+#
+# "Shows in NY next weekend" is a range scan of the (start_time, id) show
+# index joined to the venues by primary key, or for one city a scan of the
+# (state, city) venue index joined to the (venue_id, start_time) show index.
+# Either way rows come back in start time order and are streamed out a batch
+# at a time from a server-side cursor instead of being loaded all at once;
+# the .ics feeds of venues and artists are written the same way.
+# ----------------------------------------------------------------------------#
+
+# query arguments of a time range, as passed to in_range()
+RANGE_ARGS = ('from', 'to', 'city', 'state', 'genre')
+
+SCHEDULE_COLUMNS = (Show.id, Show.start_time, Show.venue_id, Venue.name.label('venue_name'), Venue.address,
+                    Venue.city, Venue.state, Show.artist_id, Artist.name.label('artist_name'))
+
+# rows fetched from the cursor per chunk of a streamed response
+BATCH_SIZE = 500
+
+ICAL_TIME = '%Y%m%dT%H%M%SZ'
+
+
+def range_filters():
+    """The ?from=, ?to= (exclusive), ?city=, ?state= and ?genre= (of the artist) of the request; 400 if a time
+    doesn't parse."""
+    filters = {name: request.args[name] for name in RANGE_ARGS if request.args.get(name)}
+    for name in ('from', 'to'):
+        if name in filters:
+            try:
+                filters[name] = dateutil.parser.parse(filters[name])
+            except (ValueError, OverflowError):
+                abort(400)
+    return filters
+
+
+def in_range(statement, **filters):
+    """Narrow a select of shows joined to their venue and artist to the range_filters()."""
+    if filters.get('from'):
+        statement = statement.where(Show.start_time >= filters['from'])
+    if filters.get('to'):
+        statement = statement.where(Show.start_time < filters['to'])
+    if filters.get('state'):
+        statement = statement.where(Venue.state == filters['state'])
+    if filters.get('city'):
+        statement = statement.where(Venue.city == filters['city'])
+    if filters.get('genre'):
+        statement = statement.where(Artist.genres.contains([filters['genre']]))
+    return statement
+
+
+def schedule(venue_id=None, artist_id=None, **filters):
+    """Select the shows in range, optionally of one venue or artist, in start time order."""
+    statement = select(*SCHEDULE_COLUMNS) \
+        .join(Venue, Venue.id == Show.venue_id) \
+        .join(Artist, Artist.id == Show.artist_id)
+    if venue_id is not None:
+        statement = statement.where(Show.venue_id == venue_id)
+    if artist_id is not None:
+        statement = statement.where(Show.artist_id == artist_id)
+    return in_range(statement, **filters).order_by(Show.start_time, Show.id)
+
+
+def batches(statement, batch_size=BATCH_SIZE):
+    """The rows of statement in lists of batch_size, fetched lazily from a server-side cursor."""
+    return db.session.execute(statement, execution_options={'yield_per': batch_size}).partitions()
+
+
+#  iCalendar
+#  ----------------------------------------------------------------
+
+def ical_text(value):
+    return (value or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def ical_line(line):
+    """A content line folded to 75 octets (RFC 5545 3.1), continuation lines starting with a space."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts = []
+    while encoded:
+        size = 75 if not parts else 74
+        # don't split a multi-byte character
+        while size < len(encoded) and (encoded[size] & 0xC0) == 0x80:
+            size -= 1
+        parts.append(encoded[:size].decode('utf-8'))
+        encoded = encoded[size:]
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def ical_event(row, stamp):
+    return ''.join(ical_line(line) for line in (
+        'BEGIN:VEVENT',
+        'UID:show-{}@fyyur'.format(row.id),
+        'DTSTAMP:' + stamp,
+        'DTSTART:' + row.start_time.strftime(ICAL_TIME),
+        'DTEND:' + (row.start_time + SHOW_LENGTH).strftime(ICAL_TIME),
+        'SUMMARY:' + ical_text('{} at {}'.format(row.artist_name, row.venue_name)),
+        'LOCATION:' + ical_text(', '.join(part for part in (row.venue_name, row.address, row.city, row.state)
+                                          if part)),
+        'END:VEVENT',
+    ))
+
+
+def ical(name, statement):
+    """Write the shows selected by schedule() as an iCalendar feed called name, a batch of events at a time."""
+    stamp = datetime.utcnow().strftime(ICAL_TIME)
+    yield ''.join(ical_line(line) for line in (
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Fyyur//Shows//EN',
+        'CALSCALE:GREGORIAN',
+        'X-WR-CALNAME:' + ical_text(name),
+    ))
+    for rows in batches(statement):
+        yield ''.join(ical_event(row, stamp) for row in rows)
+    yield ical_line('END:VCALENDAR')
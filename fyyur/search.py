@@ -0,0 +1,276 @@
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from datetime import datetime
+
+from sqlalchemy import DDL, event
+from sqlalchemy.orm import Session
+
+from models import db, Venue, Artist, OutboxEvent
+from outbox import ENTITIES, GAP_TIMEOUT
+
+# ----------------------------------------------------------------------------#
+# Full-text search over the __searchable__ columns of venues and artists.
+#
+# The document is a weighted tsvector expression backed by a GIN expression
+# index, so the database keeps it up to date on every write. A search counts
+# and ranks at most max_matches of the rows the index finds, so a broad term
+# costs the same as a narrow one however large the tables grow.
+#
+# Name completion for the show form's pickers uses an in-process sorted name
+# index, built on first use and patched from committed ORM changes. Changes
+# committed by other processes (other workers, imports, bulk deletes) reach
+# it through the outbox: at most every SYNC_INTERVAL seconds the index reads
+# the change events since the last offset it applied and re-reads the names
+# of the rows they name, or rebuilds itself after a bulk load.
+# ----------------------------------------------------------------------------#
+
+SEARCHABLE_MODELS = (Venue, Artist)
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+# seconds between reads of the outbox for names changed by other processes
+SYNC_INTERVAL = 1.0
+# an index not synced for this long is rebuilt instead, as the events it missed may have been pruned
+REBUILD_AFTER = 3600
+# outbox events read per query
+SYNC_BATCH_SIZE = 10000
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def field_weights(model):
+    # the first searchable column (the name) ranks above the location columns
+    return [2 if i == 0 else 1 for i in range(len(model.__searchable__))]
+
+
+def document_sql(model):
+    """The weighted tsvector over the model's searchable columns, shared by the index and the queries."""
+    return ' || '.join(
+        "setweight(to_tsvector('simple', coalesce({}, '')), '{}')".format(column, 'A' if weight == 2 else 'B')
+        for column, weight in zip(model.__searchable__, field_weights(model)))
+
+
+for searchable in SEARCHABLE_MODELS:
+    event.listen(searchable.__table__, 'after_create', DDL(
+        'CREATE INDEX ix_{0}_search ON {0} USING gin (({1}))'.format(searchable.__tablename__, document_sql(searchable))
+    ).execute_if(dialect='postgresql'))
+
+
+# ----------------------------------------------------------------------------#
+# In-process index.
+# ----------------------------------------------------------------------------#
+
+class NameIndex:
+    """Sorted names of a model's rows, for completing a typed prefix of the name or of any later word in it."""
+
+    def __init__(self, model):
+        self.model = model
+        # sorted (lowercased key, id) pairs: whole names, then the names from their second, third... word on
+        self.entries = ([], [])
+        self.names = {}  # id -> name
+        self.built = False
+        self.position = 0  # outbox offset up to which every change has been applied
+        self.synced_at = 0.0  # time.monotonic() of the last build or sync
+        self.gap = None  # (position, time.monotonic()) the outbox event after position was first found missing
+        self.lock = threading.RLock()
+
+    def keys(self, name):
+        lowered = name.lower()
+        return [lowered[match.start():] for match in TOKEN_PATTERN.finditer(lowered)] or [lowered]
+
+    def build(self):
+        with self.lock:
+            self.clear()
+            # events of the last GAP_TIMEOUT may belong to transactions not committed yet, so sync them again
+            self.position = db.session.query(OutboxEvent.id) \
+                .filter(OutboxEvent.created_at < datetime.utcnow() - GAP_TIMEOUT) \
+                .order_by(OutboxEvent.id.desc()).limit(1).scalar() or 0
+            for id, name in db.session.query(self.model.id, self.model.name).yield_per(10000):
+                self.add(id, name, keep_sorted=False)
+            self.sort()
+            self.built = True
+            self.synced_at = time.monotonic()
+
+    def refresh(self):
+        """Build the index on first use, then bring it up to date with the outbox every SYNC_INTERVAL seconds."""
+        with self.lock:
+            elapsed = time.monotonic() - self.synced_at
+            if not self.built or elapsed > REBUILD_AFTER:
+                self.build()
+            elif elapsed >= SYNC_INTERVAL:
+                self.sync()
+
+    def sync(self):
+        """Apply the changes to names committed since the last sync, by any process, as the outbox records them.
+
+        The position only moves past an offset missing from the outbox (a transaction still committing) once
+        it has been missing for GAP_TIMEOUT; the events after it are applied now and again on every sync until
+        then, which is harmless as each one just re-reads the current names.
+        """
+        entity = ENTITIES[self.model]
+        with self.lock:
+            now, changed, reload, blocked, last = time.monotonic(), set(), False, False, self.position
+            while True:
+                events = db.session.query(OutboxEvent.id, OutboxEvent.entity, OutboxEvent.entity_id, OutboxEvent.op) \
+                    .filter(OutboxEvent.id > last).order_by(OutboxEvent.id).limit(SYNC_BATCH_SIZE).all()
+                for event in events:
+                    if not blocked and event.id != self.position + 1:
+                        if self.gap is None or self.gap[0] != self.position:
+                            self.gap = (self.position, now)
+                        blocked = now - self.gap[1] < GAP_TIMEOUT.total_seconds()
+                    if not blocked:
+                        self.position = event.id
+                    if event.entity == entity:
+                        if event.op == 'reloaded':
+                            reload = True
+                        elif event.entity_id is not None:
+                            changed.add(event.entity_id)
+                if len(events) < SYNC_BATCH_SIZE:
+                    break
+                last = events[-1].id
+            if not blocked:
+                self.gap = None
+            if reload:
+                self.build()
+                return
+            changed = sorted(changed)
+            for start in range(0, len(changed), SYNC_BATCH_SIZE):
+                ids = changed[start:start + SYNC_BATCH_SIZE]
+                names = dict(db.session.query(self.model.id, self.model.name).filter(self.model.id.in_(ids)))
+                for id in ids:
+                    if id in names:
+                        if self.names.get(id) != names[id]:
+                            self.add(id, names[id])
+                    else:
+                        self.remove(id)
+            self.synced_at = now
+
+    def sort(self):
+        with self.lock:
+            for entries in self.entries:
+                entries.sort()
+
+    def clear(self):
+        with self.lock:
+            for entries in self.entries:
+                del entries[:]
+            self.names.clear()
+            self.built = False
+            self.position, self.synced_at, self.gap = 0, 0.0, None
+
+    def add(self, id, name, keep_sorted=True):
+        with self.lock:
+            self.remove(id)
+            self.names[id] = name
+            keys = self.keys(name)
+            for entries, entry_keys in zip(self.entries, (keys[:1], keys[1:])):
+                for key in entry_keys:
+                    if keep_sorted:
+                        insort(entries, (key, id))
+                    else:
+                        entries.append((key, id))
+
+    def remove(self, id):
+        with self.lock:
+            name = self.names.pop(id, None)
+            if name is None:
+                return
+            keys = self.keys(name)
+            for entries, entry_keys in zip(self.entries, (keys[:1], keys[1:])):
+                for key in entry_keys:
+                    i = bisect_left(entries, (key, id))
+                    if i < len(entries) and entries[i] == (key, id):
+                        del entries[i]
+
+    def complete(self, prefix, limit):
+        """Up to limit {'id', 'name'} dicts, whole-name matches before matches on a later word."""
+        prefix = prefix.lower().lstrip()
+        results, seen = [], set()
+        with self.lock:
+            for entries in self.entries:
+                i = bisect_left(entries, (prefix,))
+                while i < len(entries) and len(results) < limit and entries[i][0].startswith(prefix):
+                    id = entries[i][1]
+                    if id not in seen:
+                        seen.add(id)
+                        results.append({'id': id, 'name': self.names[id]})
+                    i += 1
+        return results
+
+
+name_indexes = {model: NameIndex(model) for model in SEARCHABLE_MODELS}
+
+
+def clear_indexes():
+    for index in name_indexes.values():
+        index.clear()
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_search_changes(session, flush_context):
+    changes = session.info.setdefault('search_changes', [])
+    for obj in session.new | session.dirty:
+        if type(obj) in name_indexes:
+            changes.append((type(obj), obj.id, obj.name))
+    for obj in session.deleted:
+        if type(obj) in name_indexes:
+            changes.append((type(obj), obj.id, None))
+
+
+def forget(session, model, ids):
+    """Drop rows deleted with a set-based DELETE from the in-process name index once session commits."""
+    session.info.setdefault('search_changes', []).extend((model, id, None) for id in ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_search_changes(session):
+    for model, id, name in session.info.pop('search_changes', []):
+        names = name_indexes[model]
+        if not names.built:
+            continue
+        if name is None:
+            names.remove(id)
+        else:
+            names.add(id, name)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_search_changes(session):
+    session.info.pop('search_changes', None)
+
+
+# ----------------------------------------------------------------------------#
+# Search.
+# ----------------------------------------------------------------------------#
+
+def search(model, search_term, page=1, per_page=20, max_matches=1000):
+    """Rank the rows of model matching every word of search_term as a prefix.
+
+    Returns the number of matches, up to max_matches + 1 (more than max_matches), and the requested page of
+    {'id', 'name'} dicts. When there are more, only the max_matches + 1 matches with the lowest ids are ranked,
+    the same ones for every page.
+    """
+    terms = tokenize(search_term)
+    if not terms:
+        return 0, []
+    document = db.literal_column('(' + document_sql(model) + ')')
+    query = db.func.to_tsquery(db.literal_column("'simple'"), ' & '.join(term + ':*' for term in terms))
+    matches = db.session.query(model.id).filter(document.op('@@')(query)) \
+        .order_by(model.id).limit(max_matches + 1).subquery()
+    count = db.session.query(db.func.count()).select_from(matches).scalar()
+    results = db.session.query(model.id, model.name).join(matches, matches.c.id == model.id) \
+        .order_by(db.desc(db.func.ts_rank(document, query)), model.id).offset((page - 1) * per_page).limit(per_page)
+    return count, [{'id': row.id, 'name': row.name} for row in results]
+
+
+def complete(model, prefix, limit=10):
+    """Names of model completing prefix, for the artist and venue pickers. Served from memory on every database."""
+    if not prefix.strip():
+        return []
+    names = name_indexes[model]
+    names.refresh()
+    return names.complete(prefix, limit)
@@ -0,0 +1,122 @@
+import random
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import insert
+
+import facets
+import geo
+import outbox
+import readmodel
+import summaries
+from availability import SHOW_LENGTH
+from models import db, Venue, Artist, Show
+
+# ----------------------------------------------------------------------------#
+# Synthetic catalog for benchmarks and load tests.
+#
+# The same arguments always generate the same venues, artists and shows, so
+# benchmark runs on different commits see the same data. Shows are laid out
+# in SHOW_LENGTH slots around now, half of them past, with every venue and
+# artist in a slot at most once, so none of them are double-booked. Venues
+# are spread over some 20 km around the gazetteer point of their city.
+# ----------------------------------------------------------------------------#
+
+CITIES = [
+    ('New York', 'NY'), ('Brooklyn', 'NY'), ('Los Angeles', 'CA'), ('San Francisco', 'CA'), ('Oakland', 'CA'),
+    ('Chicago', 'IL'), ('Austin', 'TX'), ('Houston', 'TX'), ('Nashville', 'TN'), ('Memphis', 'TN'),
+    ('New Orleans', 'LA'), ('Seattle', 'WA'), ('Portland', 'OR'), ('Denver', 'CO'), ('Atlanta', 'GA'),
+    ('Miami', 'FL'), ('Boston', 'MA'), ('Philadelphia', 'PA'), ('Detroit', 'MI'), ('Minneapolis', 'MN'),
+]
+GENRES = ['Alternative', 'Blues', 'Classical', 'Country', 'Electronic', 'Folk', 'Funk', 'Hip-Hop', 'Heavy Metal',
+          'Instrumental', 'Jazz', 'Musical Theatre', 'Pop', 'Punk', 'R&B', 'Reggae', 'Rock n Roll', 'Soul', 'Other']
+WORDS = ['Blue', 'Golden', 'Velvet', 'Electric', 'Midnight', 'Silver', 'Crimson', 'Wild', 'Lucky', 'Broken',
+         'Rolling', 'Hidden', 'Neon', 'Paper', 'Iron', 'Little', 'Royal', 'Secret', 'Lonely', 'Dusty']
+VENUE_NOUNS = ['Hall', 'Room', 'Lounge', 'Club', 'Theater', 'Tavern', 'Garden', 'Cellar', 'Stage', 'Den']
+ARTIST_NOUNS = ['Band', 'Trio', 'Quartet', 'Orchestra', 'Collective', 'Brothers', 'Sisters', 'Ensemble', 'Kids',
+                'Project']
+
+
+def venue_row(rng, i):
+    city, state = rng.choice(CITIES)
+    return {
+        'name': 'The {} {} {} {}'.format(rng.choice(WORDS), rng.choice(WORDS), rng.choice(VENUE_NOUNS), i),
+        'city': city, 'state': state, 'address': '{} {} St'.format(rng.randint(1, 9999), rng.choice(WORDS)),
+        'phone': '{:03}-{:03}-{:04}'.format(rng.randint(200, 999), rng.randint(0, 999), rng.randint(0, 9999)),
+        'genres': rng.sample(GENRES, rng.randint(1, 3)), 'seeking_talent': rng.random() < 0.3,
+        'website': 'https://venue{}.example.com'.format(i),
+        'facebook_link': 'https://www.facebook.com/venue{}'.format(i),
+        'image_link': 'https://images.example.com/venues/{}.jpg'.format(i),
+    }
+
+
+def artist_row(rng, i):
+    city, state = rng.choice(CITIES)
+    return {
+        'name': 'The {} {} {} {}'.format(rng.choice(WORDS), rng.choice(WORDS), rng.choice(ARTIST_NOUNS), i),
+        'city': city, 'state': state,
+        'phone': '{:03}-{:03}-{:04}'.format(rng.randint(200, 999), rng.randint(0, 999), rng.randint(0, 9999)),
+        'genres': rng.sample(GENRES, rng.randint(1, 3)), 'seeking_venue': rng.random() < 0.3,
+        'website': 'https://artist{}.example.com'.format(i),
+        'facebook_link': 'https://www.facebook.com/artist{}'.format(i),
+        'image_link': 'https://images.example.com/artists/{}.jpg'.format(i),
+    }
+
+
+def locate(rows, places, rng):
+    """Place the venues of rows around the gazetteer point of their city."""
+    for row in rows:
+        point = places.get((geo.normalize(row['city']), geo.normalize(row['state'])))
+        row['latitude'] = row['longitude'] = row['geohash'] = None
+        if point is not None:
+            row['latitude'] = point[0] + rng.uniform(-0.1, 0.1)
+            row['longitude'] = point[1] + rng.uniform(-0.1, 0.1)
+            row['geohash'] = geo.encode(row['latitude'], row['longitude'])
+    return rows
+
+
+def insert_rows(model, rows):
+    return db.session.scalars(insert(model).returning(model.id, sort_by_parameter_order=True), rows).all()
+
+
+def seed(venues, artists, shows, random_seed=0, batch_size=10000, now=None, places=None):
+    """Bulk insert a synthetic catalog and rebuild what is derived from it. The caller commits.
+
+    Venues are located around their city in places, a geo.load_gazetteer() (by default of GAZETTEER_PATH).
+    Returns the ids of the new venues and artists.
+    """
+    if shows and not (venues and artists):
+        raise ValueError('shows need venues and artists')
+    rng = random.Random(random_seed)
+    # locations come from a generator of their own, so they don't change the rest of the catalog
+    location_rng = random.Random('{}:locations'.format(random_seed))
+    if places is None:
+        places = geo.load_gazetteer(current_app.config['GAZETTEER_PATH'])
+    now = now or datetime.utcnow()
+    venue_ids, artist_ids = [], []
+    for start in range(0, venues, batch_size):
+        rows = [venue_row(rng, i) for i in range(start, min(start + batch_size, venues))]
+        venue_ids += insert_rows(Venue, locate(rows, places, location_rng))
+    for start in range(0, artists, batch_size):
+        artist_ids += insert_rows(Artist, [artist_row(rng, i) for i in range(start, min(start + batch_size, artists))])
+
+    # a slot holds up to one show per venue and per artist, each slot shuffled differently
+    per_slot = min(venues, artists)
+    slots = -(-shows // per_slot) if shows else 0
+    for start in range(0, shows, batch_size):
+        rows = []
+        for i in range(start, min(start + batch_size, shows)):
+            slot, j = divmod(i, per_slot)
+            rows.append({
+                'venue_id': venue_ids[(j + slot) % venues],
+                'artist_id': artist_ids[(j + slot * 7) % artists],
+                'start_time': now + (slot - slots // 2) * SHOW_LENGTH,
+            })
+        db.session.execute(Show.__table__.insert(), rows)
+
+    summaries.rebuild(now)
+    facets.rebuild()
+    readmodel.rebuild()
+    for model in (Venue, Artist, Show):
+        outbox.reloaded(db.session, model)
+    return venue_ids, artist_ids
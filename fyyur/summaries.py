@@ -0,0 +1,168 @@
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import event, select, update
+
+import readmodel
+from models import db, Venue, Artist, Show, ShowSummaryCheckpoint
+
+# ----------------------------------------------------------------------------#
+# Per venue/artist show summaries.
+#
+# Venue and Artist carry upcoming_shows_count, past_shows_count and
+# next_show_time, classified against the checkpoint time stored in
+# show_summary_checkpoint. Inserting or deleting a show adjusts the two rows it
+# belongs to; rollover() moves the shows that started since the last
+# checkpoint from upcoming to past, touching only those shows. Writers read the
+# checkpoint FOR SHARE and rollover() locks it FOR UPDATE, so a show is never
+# counted against a boundary that a running rollover has already moved past.
+# ----------------------------------------------------------------------------#
+
+CHECKPOINT_ID = 1
+
+# (summarized model, the foreign key of Show pointing at it)
+SUMMARIZED = ((Venue, Show.venue_id), (Artist, Show.artist_id))
+
+
+def rolled_over_at(connection=None, lock=False):
+    """Boundary between past and upcoming shows as of the last rollover.
+
+    With lock, the checkpoint row is share locked until commit: a rollover() in progress is waited for, and
+    one starting later waits for the caller, so the caller's shows are counted against the boundary they stay
+    under.
+    """
+    query = select(ShowSummaryCheckpoint.rolled_over_at).where(ShowSummaryCheckpoint.id == CHECKPOINT_ID)
+    if lock:
+        query = query.with_for_update(read=True)
+    boundary = (connection or db.session).execute(query).scalar()
+    # before the first rollover every show counts as upcoming, the first rollover sorts them out
+    return boundary or datetime.min
+
+
+def lock_checkpoint():
+    """The checkpoint row, locked until commit so concurrent rollovers don't move the same shows twice."""
+    checkpoint = db.session.get(ShowSummaryCheckpoint, CHECKPOINT_ID, with_for_update=True)
+    if checkpoint is None:
+        checkpoint = ShowSummaryCheckpoint(id=CHECKPOINT_ID, rolled_over_at=datetime.min)
+        db.session.add(checkpoint)
+    return checkpoint
+
+
+def next_show_time(model, foreign_key, after):
+    return select(db.func.min(Show.start_time)) \
+        .where(foreign_key == model.id, Show.start_time > after) \
+        .scalar_subquery()
+
+
+@event.listens_for(Show, 'after_insert')
+def count_inserted_show(mapper, connection, show):
+    boundary = rolled_over_at(connection, lock=True)
+    for model, foreign_key in SUMMARIZED:
+        row = model.id == getattr(show, foreign_key.key)
+        if show.start_time > boundary:
+            earlier = db.or_(model.next_show_time.is_(None), model.next_show_time > show.start_time)
+            connection.execute(update(model).where(row).values(
+                upcoming_shows_count=model.upcoming_shows_count + 1,
+                next_show_time=db.case((earlier, show.start_time), else_=model.next_show_time)))
+        else:
+            connection.execute(update(model).where(row).values(past_shows_count=model.past_shows_count + 1))
+
+
+@event.listens_for(Show, 'after_delete')
+def count_deleted_show(mapper, connection, show):
+    boundary = rolled_over_at(connection, lock=True)
+    for model, foreign_key in SUMMARIZED:
+        row = model.id == getattr(show, foreign_key.key)
+        if show.start_time > boundary:
+            connection.execute(update(model).where(row).values(
+                upcoming_shows_count=model.upcoming_shows_count - 1,
+                next_show_time=next_show_time(model, foreign_key, boundary)))
+        else:
+            connection.execute(update(model).where(row).values(past_shows_count=model.past_shows_count - 1))
+
+
+def rollover(now=None):
+    """Reclassify the shows that started since the last checkpoint as past.
+
+    Returns the ids of the venues and artists whose summary changed. The caller commits.
+    """
+    now = now or datetime.utcnow()
+    checkpoint = lock_checkpoint()
+    boundary = checkpoint.rolled_over_at
+    if now <= boundary:
+        return [], []
+    checkpoint.rolled_over_at = now
+    db.session.flush()
+
+    started = db.and_(Show.start_time > boundary, Show.start_time <= now)
+    changed = []
+    for model, foreign_key in SUMMARIZED:
+        ids = [row[0] for row in db.session.query(foreign_key).filter(started).distinct()]
+        if ids:
+            moved = select(db.func.count(Show.id)).where(foreign_key == model.id, started).scalar_subquery()
+            db.session.execute(update(model).where(model.id.in_(ids)).values(
+                upcoming_shows_count=model.upcoming_shows_count - moved,
+                past_shows_count=model.past_shows_count + moved,
+                next_show_time=next_show_time(model, foreign_key, now)
+            ), execution_options={'synchronize_session': False})
+            readmodel.mark_stale(db.session, model, ids)
+        changed.append(ids)
+    return tuple(changed)
+
+
+def counted(model, foreign_key, boundary):
+    """The summary columns of model recomputed from the shows table."""
+    def count(*criteria):
+        return select(db.func.count(Show.id)).where(foreign_key == model.id, *criteria).scalar_subquery()
+    return {
+        'upcoming_shows_count': count(Show.start_time > boundary),
+        'past_shows_count': count(Show.start_time <= boundary),
+        'next_show_time': next_show_time(model, foreign_key, boundary),
+    }
+
+
+def rebuild(now=None):
+    """Recompute every summary from the shows table. The caller commits."""
+    now = now or datetime.utcnow()
+    lock_checkpoint().rolled_over_at = now
+    db.session.flush()
+    for model, foreign_key in SUMMARIZED:
+        db.session.execute(update(model).values(**counted(model, foreign_key, now)),
+                           execution_options={'synchronize_session': False})
+
+
+def recount(model, ids):
+    """Recompute the summaries of the given venues or artists after set-based changes to their shows.
+
+    The caller commits.
+    """
+    if not ids:
+        return
+    foreign_key = dict(SUMMARIZED)[model]
+    boundary = rolled_over_at(lock=True)
+    db.session.execute(update(model).where(model.id.in_(ids)).values(**counted(model, foreign_key, boundary)),
+                       execution_options={'synchronize_session': False})
+    readmodel.mark_stale(db.session, model, ids)
+
+
+def start_rollover_job(app, interval, on_rollover=None):
+    """Run rollover() every interval seconds on a daemon thread, calling on_rollover(venue_ids, artist_ids)."""
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    venue_ids, artist_ids = rollover()
+                    db.session.commit()
+                    if on_rollover is not None:
+                        on_rollover(venue_ids, artist_ids)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('show summary rollover failed')
+                finally:
+                    db.session.remove()
+
+    thread = threading.Thread(target=run, name='show-summary-rollover', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,1478 @@
+import asyncio
+import csv
+import gzip
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+
+import babel.dates
+import dateutil.parser
+from flask import render_template
+from sqlalchemy import create_engine, event
+
+os.environ.setdefault('DATABASE_URL', 'postgresql://mnm@localhost:5432/fyyur_test')
+os.environ.setdefault('SUMMARY_ROLLOVER_INTERVAL', '0')
+
+from app import app, format_datetime, page_cache, metrics
+from availability import SHOW_LENGTH, Bookings
+from replicas import replicas, PRIMARY_COOKIE
+from writebehind import fcntl, write_behind
+from models import db, Venue, Artist, Show, DetailDocument, ImportCheckpoint, OutboxEvent, OutboxOffset
+from search import NameIndex, clear_indexes, search
+import summaries
+import facets
+import geo
+import importer
+import outbox
+import readmodel
+import seed
+import benchmark
+
+try:
+    import asgi
+except ImportError:  # the ASGI mode needs asgiref and an async database driver
+    asgi = None
+
+
+class FyyurTestCase(unittest.TestCase):
+    """This class represents the fyyur test case"""
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = app
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.client = self.app.test_client
+        clear_indexes()
+        page_cache.clear()
+        metrics.reset()
+
+        # binds the app to the current context
+        with self.app.app_context():
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def seed(self, venues, artists, shows, batch_size=10000):
+        """Bulk insert synthetic venues, artists and shows, one SHOW_LENGTH apart, half of them upcoming."""
+        now = datetime.utcnow()
+        with self.app.app_context():
+            db.session.execute(Venue.__table__.insert(), [{
+                'name': 'Venue {}'.format(i), 'city': 'City {}'.format(i % 50), 'state': 'NY',
+                'address': '{} Main St'.format(i), 'genres': ['Jazz'], 'seeking_talent': False
+            } for i in range(venues)])
+            db.session.execute(Artist.__table__.insert(), [{
+                'name': 'Artist {}'.format(i), 'city': 'City {}'.format(i % 50), 'state': 'NY',
+                'phone': '123-123-1234', 'genres': ['Jazz'], 'seeking_venue': False
+            } for i in range(artists)])
+            for start in range(0, shows, batch_size):
+                db.session.execute(Show.__table__.insert(), [{
+                    'artist_id': i % artists + 1, 'venue_id': i % venues + 1,
+                    'start_time': now + (i - shows // 2) * SHOW_LENGTH
+                } for i in range(start, min(start + batch_size, shows))])
+            summaries.rebuild(now)
+            facets.rebuild()
+            readmodel.rebuild()
+            db.session.commit()
+
+    def capture_queries(self, path, method='get', data=None):
+        """Request the given path and return the response and the (statement, parameters) pairs it issued."""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = getattr(self.client(), method)(path, data=data)
+            res.get_data()  # streamed bodies query the database while they're read
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return res, statements
+
+    def count_queries(self, path):
+        """Request the given path and return the response and the number of SQL statements it issued."""
+        res, statements = self.capture_queries(path)
+        return res, len(statements)
+
+    def require_postgresql(self, reason):
+        with self.app.app_context():
+            if db.engine.dialect.name != 'postgresql':
+                self.skipTest(reason)
+
+    def assert_no_sequential_scans(self, path, method='get', data=None, expected=None):
+        """EXPLAIN every statement issued by the given request and fail if any of them scans a whole table,
+        or if none of them contains the expected SQL.
+
+        Sequential scans are disabled for the EXPLAIN so the planner picks an index whenever one can
+        serve the query, even on the small tables used by the tests.
+        """
+        res, statements = self.capture_queries(path, method, data)
+        self.assertLess(res.status_code, 400)
+        if expected is not None:
+            self.assertTrue(any(expected in statement for statement, parameters in statements),
+                            '{} issued no statement with {!r}'.format(path, expected))
+        with self.app.app_context():
+            with db.engine.connect() as conn:
+                conn.exec_driver_sql('SET enable_seqscan = off')
+                for statement, parameters in statements:
+                    plan = '\n'.join(row[0] for row in conn.exec_driver_sql('EXPLAIN ' + statement, parameters))
+                    self.assertNotIn('Seq Scan', plan, statement)
+
+    def test_get_venues(self):
+        self.seed(venues=10, artists=5, shows=40)
+        res = self.client().get('/venues')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Venue 9', res.data)
+
+    def test_venues_query_count_is_constant(self):
+        self.seed(venues=100, artists=50, shows=2000)
+        res, small_count = self.count_queries('/venues')
+        self.assertEqual(res.status_code, 200)
+
+        self.tearDown()
+        self.setUp()
+        self.seed(venues=10000, artists=1000, shows=200000)
+        res, large_count = self.count_queries('/venues')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(small_count, large_count)
+
+    def test_show_venue_query_count_is_bounded(self):
+        self.seed(venues=1, artists=10, shows=1)
+        res, single_show_count = self.count_queries('/venues/1')
+        self.assertEqual(res.status_code, 200)
+
+        self.tearDown()
+        self.setUp()
+        self.seed(venues=1, artists=10, shows=1000)
+        res, many_shows_count = self.count_queries('/venues/1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(single_show_count, many_shows_count)
+
+    def test_show_artist_query_count_is_bounded(self):
+        self.seed(venues=10, artists=1, shows=1)
+        res, single_show_count = self.count_queries('/artists/1')
+        self.assertEqual(res.status_code, 200)
+
+        self.tearDown()
+        self.setUp()
+        self.seed(venues=10, artists=1, shows=1000)
+        res, many_shows_count = self.count_queries('/artists/1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(single_show_count, many_shows_count)
+
+    def test_shows_are_paginated_with_cursors(self):
+        self.seed(venues=3, artists=3, shows=25)
+        res, page_count = self.count_queries('/shows?per_page=10')
+        pages = [res.data]
+        while b'Older' in res.data:
+            cursor = re.search(rb'href="(/shows\?after=[^"]+)"', res.data).group(1)
+            res = self.client().get(cursor.decode().replace('&amp;', '&'))
+            pages.append(res.data)
+        previous = self.client().get(
+            re.search(rb'href="(/shows\?before=[^"]+)"', res.data).group(1).decode().replace('&amp;', '&'))
+
+        self.assertEqual(page_count, 1)
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(sum(page.count(b'tile-show') for page in pages), 25)
+        self.assertEqual(previous.data, pages[1])
+
+    def test_400_sent_requesting_malformed_shows_cursor(self):
+        res = self.client().get('/shows?after=yesterday')
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_hot_queries_use_indexes(self):
+        self.require_postgresql('query plans are only checked on PostgreSQL')
+        self.seed(venues=200, artists=200, shows=5000)
+        with self.app.app_context():
+            db.session.execute(db.text('ANALYZE'))
+            db.session.commit()
+
+        self.assert_no_sequential_scans('/venues/1')
+        self.assert_no_sequential_scans('/artists/1')
+        self.assert_no_sequential_scans('/shows')
+        self.assert_no_sequential_scans('/api/v1/calendar?from=2020-01-01&to=2020-01-03&state=NY&city=City+1',
+                                        expected='shows.start_time >=')
+        self.assert_no_sequential_scans('/venues/1/shows.ics', expected='shows.venue_id =')
+        self.assert_no_sequential_scans('/venues/search', 'post', {'search_term': 'Venue 12'})
+        self.assert_no_sequential_scans('/artists/search', 'post', {'search_term': 'Artist 12'})
+
+    def test_search_venues_ranks_prefix_matches(self):
+        self.require_postgresql('search runs on PostgreSQL full-text indexes')
+        self.seed(venues=30, artists=1, shows=0)
+        with self.app.app_context():
+            db.session.add(Venue(name='Park Square Live Music', city='San Francisco', state='CA',
+                                 seeking_talent=False))
+            db.session.add(Venue(name='The Dueling Pianos', city='Music City', state='TN', seeking_talent=False))
+            db.session.commit()
+
+        res = self.client().post('/venues/search', data={'search_term': 'mus'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'results for "mus": 2', res.data)
+        self.assertLess(res.data.index(b'Park Square'), res.data.index(b'Dueling Pianos'))
+
+    def test_search_venues_is_paginated(self):
+        self.require_postgresql('search runs on PostgreSQL full-text indexes')
+        self.seed(venues=30, artists=1, shows=0)
+        first = self.client().post('/venues/search', data={'search_term': 'venue'})
+        second = self.client().post('/venues/search', data={'search_term': 'venue', 'page': 2})
+
+        self.assertIn(b'results for "venue": 30', first.data)
+        self.assertEqual(first.data.count(b'<h5>'), 20)
+        self.assertEqual(second.data.count(b'<h5>'), 10)
+
+    def test_search_artists_follows_edits(self):
+        self.require_postgresql('search runs on PostgreSQL full-text indexes')
+        self.seed(venues=1, artists=3, shows=0)
+        self.client().post('/artists/search', data={'search_term': 'artist'})
+        self.client().post('/artists/1/edit', data={
+            'name': 'The Wild Sax Band', 'city': 'San Francisco', 'state': 'CA', 'phone': '432-325-5432',
+            'genres': ['Jazz'], 'facebook_link': 'https://www.facebook.com/sax', 'website': 'https://sax.com',
+            'seeking_venue': 'True'})
+
+        res = self.client().post('/artists/search', data={'search_term': 'band'})
+
+        self.assertIn(b'results for "band": 1', res.data)
+        self.assertIn(b'The Wild Sax Band', res.data)
+
+    def test_search_latency(self):
+        self.require_postgresql('search runs on PostgreSQL full-text indexes')
+        rows = int(os.environ.get('SEARCH_BENCHMARK_ROWS', 1000000))
+        with self.app.app_context():
+            db.session.execute(db.text(
+                "INSERT INTO venues (name, city, state, address, genres, seeking_talent) "
+                "SELECT 'Venue ' || i || ' Hall', 'City ' || (i % 1000), 'NY', i || ' Main St', ARRAY['Jazz'], false "
+                "FROM generate_series(1, :rows) AS i"), {'rows': rows})
+            db.session.commit()
+            db.session.execute(db.text('ANALYZE venues'))
+            db.session.commit()
+
+            # the words are prefixes, so 'venue 4242' also finds Venue 42420 Hall, Venue 424200 Hall, ...
+            prefixed = sum(1 for i in range(1, rows + 1) if str(i).startswith('4242'))
+            for term, expected in (('venue 4242', min(prefixed, 1001)), ('venue hall', min(rows, 1001))):
+                search(Venue, term, max_matches=1000)
+                start = time.perf_counter()
+                count, results = search(Venue, term, max_matches=1000)
+                elapsed = time.perf_counter() - start
+
+                self.assertEqual(count, expected)
+                self.assertLess(elapsed, 0.05, term)
+            self.assertEqual(search(Venue, 'venue 4242')[1][0]['name'], 'Venue 4242 Hall')
+
+    def test_search_venues_caps_the_count(self):
+        self.require_postgresql('search runs on PostgreSQL full-text indexes')
+        self.seed(venues=30, artists=1, shows=0)
+        self.app.config['SEARCH_MAX_MATCHES'] = 25
+        self.addCleanup(self.app.config.__setitem__, 'SEARCH_MAX_MATCHES', 1000)
+
+        res = self.client().post('/venues/search', data={'search_term': 'venue', 'page': 2})
+
+        self.assertIn(b'results for "venue": 25+', res.data)
+        self.assertIn(b'Only the first 25 matches found are ranked', res.data)
+        self.assertEqual(res.data.count(b'<h5>'), 5)
+
+    def test_autocomplete_artists_follows_edits(self):
+        self.seed(venues=1, artists=3, shows=0)
+        self.client().get('/artists/autocomplete?q=art')
+        self.client().post('/artists/1/edit', data={
+            'name': 'The Wild Sax Band', 'city': 'San Francisco', 'state': 'CA', 'phone': '432-325-5432',
+            'genres': ['Jazz'], 'facebook_link': 'https://www.facebook.com/sax', 'website': 'https://sax.com',
+            'seeking_venue': 'True'})
+
+        res = self.client().get('/artists/autocomplete?q=wild')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['artists'], [{'id': 1, 'name': 'The Wild Sax Band'}])
+        data = json.loads(self.client().get('/artists/autocomplete?q=art').data)
+        self.assertEqual([artist['id'] for artist in data['artists']], [2, 3])
+
+    def test_autocomplete_follows_other_processes_through_the_outbox(self):
+        self.seed(venues=1, artists=3, shows=0)
+        self.assertEqual(len(json.loads(self.client().get('/artists/autocomplete?q=art').data)['artists']), 3)
+        # writes that bypass this process's ORM session, as another worker's or a bulk delete's would
+        with self.app.app_context():
+            db.session.execute(Artist.__table__.insert(), [{
+                'name': 'Artful Dodgers', 'city': 'Austin', 'state': 'TX', 'phone': '326-123-5000',
+                'genres': ['Jazz'], 'seeking_venue': False}])
+            db.session.execute(Artist.__table__.delete().where(Artist.id == 2))
+            outbox.record(db.session, Artist, 'created', [4])
+            outbox.record(db.session, Artist, 'deleted', [2])
+            db.session.commit()
+
+        with mock.patch('search.SYNC_INTERVAL', 0):
+            data = json.loads(self.client().get('/artists/autocomplete?q=art').data)
+            self.assertEqual([artist['id'] for artist in data['artists']], [4, 1, 3])
+
+            # a bulk load is announced with a single event, which rebuilds the index
+            with self.app.app_context():
+                db.session.execute(Artist.__table__.update().where(Artist.id == 1).values(name='Artemis'))
+                outbox.reloaded(db.session, Artist)
+                db.session.commit()
+            data = json.loads(self.client().get('/artists/autocomplete?q=artem').data)
+            self.assertEqual(data['artists'], [{'id': 1, 'name': 'Artemis'}])
+
+    def test_name_index_waits_at_outbox_gaps(self):
+        self.seed(venues=1, artists=3, shows=0)
+        with self.app.app_context():
+            index = NameIndex(Artist)
+            index.build()
+            # event 2 belongs to a transaction still committing
+            for id in (1, 3):
+                db.session.add(OutboxEvent(id=id, entity='artist', entity_id=id, op='updated'))
+            db.session.execute(Artist.__table__.update().values(name=Artist.name + ' Band'))
+            db.session.commit()
+
+            index.sync()
+            self.assertEqual((index.position, index.names[3]), (1, 'Artist 2 Band'))
+            db.session.add(OutboxEvent(id=2, entity='artist', entity_id=2, op='updated'))
+            db.session.commit()
+            index.sync()
+            self.assertEqual((index.position, index.names[2]), (3, 'Artist 1 Band'))
+
+    def test_autocomplete_latency(self):
+        rows = int(os.environ.get('AUTOCOMPLETE_BENCHMARK_ROWS', 500000))
+        index = NameIndex(Venue)
+        for i in range(rows):
+            index.add(i, 'The {} Music Hall'.format(i), keep_sorted=False)
+        index.sort()
+
+        start = time.perf_counter()
+        results = index.complete('music h', 10)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(len(results), 10)
+        self.assertLess(elapsed, 0.005)
+        self.assertEqual(index.complete('the 4242 ', 10), [{'id': 4242, 'name': 'The 4242 Music Hall'}])
+
+    def test_capture_queries_includes_streamed_bodies(self):
+        self.seed(venues=2, artists=1, shows=4)
+
+        res, statements = self.capture_queries('/venues/1/shows.ics')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(any('shows.venue_id =' in statement for statement, parameters in statements))
+        res, statements = self.capture_queries('/api/v1/calendar?from=2020-01-01&state=NY')
+        self.assertTrue(any('shows.start_time >=' in statement for statement, parameters in statements))
+
+    def test_calendar_streams_shows_in_range(self):
+        self.seed(venues=4, artists=2, shows=40)
+        with self.app.app_context():
+            starts = [start_time for start_time, in db.session.query(Show.start_time).order_by(Show.start_time)]
+            expected = [id for id, in db.session.query(Show.id).filter(
+                Show.venue_id == 2, Show.start_time >= starts[10], Show.start_time < starts[30])
+                .order_by(Show.start_time)]
+
+        res = self.client().get('/api/v1/calendar', query_string={
+            'from': starts[10].isoformat(), 'to': starts[30].isoformat(), 'city': 'City 1', 'state': 'NY'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertEqual([show['id'] for show in data['shows']], expected)
+        self.assertEqual(data['shows'][0]['venue_name'], 'Venue 1')
+
+    def test_shows_page_filtered_by_time_and_genre(self):
+        self.seed(venues=2, artists=2, shows=10)
+        with self.app.app_context():
+            db.session.get(Artist, 2).genres = ['Folk']
+            db.session.commit()
+
+        res = self.client().get('/shows?per_page=2&genre=Folk&from=2000-01-01')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(b'Artist 0', res.data)
+        self.assertIn(b'Artist 1', res.data)
+        self.assertIn(b'genre=Folk', res.data)
+
+    def test_400_calendar_with_bad_time(self):
+        res = self.client().get('/api/v1/calendar?from=next+weekend')
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_venue_ical_feed(self):
+        self.seed(venues=2, artists=1, shows=6)
+        with self.app.app_context():
+            db.session.get(Venue, 1).name = 'The Musical Hop; Main Hall, ' + 'x' * 80
+            db.session.commit()
+
+        res = self.client().get('/venues/1/shows.ics')
+        body = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/calendar')
+        self.assertTrue(body.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertTrue(body.endswith('END:VCALENDAR\r\n'))
+        self.assertEqual(body.count('BEGIN:VEVENT'), 3)
+        self.assertIn('The Musical Hop\\; Main Hall\\,', body)
+        self.assertTrue(all(len(line.encode('utf-8')) <= 75 for line in body.split('\r\n')))
+        self.assertEqual(self.client().get('/artists/5/shows.ics').status_code, 404)
+
+    def test_format_datetime_per_row_cost(self):
+        now = datetime.utcnow()
+        rows = [now + timedelta(minutes=i) for i in range(10000)]
+
+        start = time.perf_counter()
+        reparsed = [babel.dates.format_datetime(dateutil.parser.parse(str(row)), "EEEE MMMM, d, y 'at' h:mma")
+                    for row in rows]
+        reparse_cost = (time.perf_counter() - start) / len(rows)
+
+        format_datetime.cache_clear()
+        start = time.perf_counter()
+        formatted = [format_datetime(row, 'full') for row in rows]
+        per_row_cost = (time.perf_counter() - start) / len(rows)
+
+        self.assertEqual(formatted, reparsed)
+        self.assertLess(per_row_cost, reparse_cost)
+
+    def test_synthetic_catalog_is_reproducible_without_double_bookings(self):
+        with self.app.app_context():
+            seed.seed(venues=5, artists=7, shows=60, random_seed=3)
+            db.session.commit()
+            names = [name for name, in db.session.query(Artist.name).order_by(Artist.id)]
+            shows = db.session.query(Show.artist_id, Show.venue_id, Show.start_time).order_by(Show.start_time).all()
+            summarized = db.session.query(db.func.sum(Venue.upcoming_shows_count + Venue.past_shows_count)).scalar()
+
+        bookings = Bookings()
+        for show in shows:
+            self.assertFalse(bookings.conflicts(*show))
+            bookings.add(*show)
+        self.assertEqual(len(shows), 60)
+        self.assertEqual(summarized, 60)
+        self.tearDown()
+        self.setUp()
+        with self.app.app_context():
+            seed.seed(venues=5, artists=7, shows=0, random_seed=3)
+            self.assertEqual([name for name, in db.session.query(Artist.name).order_by(Artist.id)], names)
+
+    def test_benchmark_scenarios_cover_every_route(self):
+        with self.app.app_context():
+            seed.seed(venues=3, artists=3, shows=12)
+            db.session.commit()
+            catalog = benchmark.Catalog(random_seed=0)
+        runner = benchmark.Runner(self.app, concurrency=1)
+        try:
+            for method, rule in benchmark.routes(self.app):
+                status, elapsed, statements = runner.execute(method, benchmark.SCENARIOS[rule.endpoint](catalog))
+                self.assertLess(status, 400, '{} {}'.format(method, rule))
+        finally:
+            runner.close()
+
+    def start_write_behind(self, journal):
+        self.app.config['WRITE_BEHIND_INTERVAL'] = 3600
+        write_behind.start(self.app, journal)
+        self.addCleanup(write_behind.stop)
+
+    def submission(self, ticket):
+        res = self.client().get('/submissions?id=' + ticket)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['submissions'][0]
+
+    def test_write_behind_writes_submissions_in_batches(self):
+        venue = {'name': 'The Dueling Pianos Bar', 'city': 'New York', 'state': 'NY',
+                 'address': '335 Delancey Street', 'phone': '914-003-1132', 'genres': ['Classical', 'R&B'],
+                 'facebook_link': 'https://www.facebook.com/dp'}
+        with tempfile.TemporaryDirectory() as directory:
+            self.start_write_behind(os.path.join(directory, 'journal'))
+            tickets = []
+            for data in (venue, dict(venue, name='The Musical Hop')):
+                res = self.client().post('/venues/create', data=data)
+                tickets += re.findall(r'/submissions\?id=([0-9a-f]{32})', res.get_data(as_text=True))
+            client = self.client()
+            client.post('/venues/99/edit', data=venue)
+            # flashed on the page the edit redirects to
+            tickets += re.findall(r'/submissions\?id=([0-9a-f]{32})', client.get('/').get_data(as_text=True))
+
+            self.assertEqual(len(tickets), 3)
+            self.assertEqual([self.submission(ticket)['status'] for ticket in tickets], ['pending'] * 3)
+            with self.app.app_context():
+                self.assertEqual(Venue.query.count(), 0)
+                write_behind.flush()
+                self.assertEqual([name for name, in db.session.query(Venue.name).order_by(Venue.id)],
+                                 ['The Dueling Pianos Bar', 'The Musical Hop'])
+
+            written, failed = self.submission(tickets[1]), self.submission(tickets[2])
+            self.assertEqual((written['status'], written['url']), ('written', '/venues/2'))
+            # the edit of a missing venue fails on its own, without taking the new venues down with it
+            self.assertEqual((failed['status'], failed['error']), ('failed', 'Venue 99 does not exist'))
+            self.assertEqual(os.path.getsize(os.path.join(directory, 'journal')), 0)
+
+    def test_write_behind_replays_its_journal_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = os.path.join(directory, 'journal')
+            self.start_write_behind(journal)
+            res = self.client().post('/artists/create', data={
+                'name': 'Guns N Petals', 'city': 'San Francisco', 'state': 'CA', 'phone': '326-123-5000',
+                'genres': ['Rock n Roll'], 'facebook_link': 'https://www.facebook.com/GunsNPetals'})
+            ticket, = re.findall(r'/submissions\?id=([0-9a-f]{32})', res.get_data(as_text=True))
+            write_behind.stop()
+            with open(journal) as f:
+                journaled = f.read()
+
+            # the next start picks up what was left in the journal
+            self.start_write_behind(journal)
+            self.assertEqual(self.submission(ticket)['status'], 'pending')
+            with self.app.app_context():
+                write_behind.flush()
+            write_behind.stop()
+            # and a crash between the commit and the truncation of the journal doesn't write it twice
+            with open(journal, 'w') as f:
+                f.write(journaled)
+            self.start_write_behind(journal)
+            with self.app.app_context():
+                write_behind.flush()
+                self.assertEqual(Artist.query.filter_by(name='Guns N Petals').count(), 1)
+            self.assertEqual(self.submission(ticket)['status'], 'written')
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, 'timed out')
+            time.sleep(0.01)
+
+    def test_write_behind_survives_unexpected_errors(self):
+        artist = {'name': 'Guns N Petals', 'city': 'San Francisco', 'state': 'CA', 'phone': '326-123-5000',
+                  'genres': ['Rock n Roll'], 'facebook_link': 'https://www.facebook.com/GunsNPetals'}
+        self.app.config['WRITE_BEHIND_BATCH_SIZE'] = 1
+        self.addCleanup(self.app.config.__setitem__, 'WRITE_BEHIND_BATCH_SIZE', 100)
+        with tempfile.TemporaryDirectory() as directory, mock.patch('writebehind.RETRY_DELAY', 0):
+            self.start_write_behind(os.path.join(directory, 'journal'))
+
+            # a failing lookup of the written submissions falls back to writing them one by one
+            with mock.patch.object(db.session, 'query', side_effect=RuntimeError('lookup failed')):
+                res = self.client().post('/artists/create', data=artist)
+                written, = re.findall(r'/submissions\?id=([0-9a-f]{32})', res.get_data(as_text=True))
+                self.wait_for(lambda: self.submission(written)['status'] != 'pending')
+            self.assertEqual(self.submission(written)['status'], 'written')
+
+            # a batch that can't even be recorded as failed is retried, then given up on
+            with mock.patch.object(db.session, 'commit', side_effect=RuntimeError('commit failed')):
+                res = self.client().post('/artists/create', data=dict(artist, name='The Wild Sax Band'))
+                failed, = re.findall(r'/submissions\?id=([0-9a-f]{32})', res.get_data(as_text=True))
+                self.wait_for(lambda: self.submission(failed)['status'] != 'pending')
+            self.assertEqual((self.submission(failed)['status'], self.submission(failed)['error']),
+                             ('failed', 'commit failed'))
+            self.assertTrue(write_behind.thread.is_alive())
+            self.assertTrue(write_behind.enabled)
+
+    @unittest.skipIf(fcntl is None, 'journal locking needs fcntl')
+    def test_write_behind_stops_cleanly_after_losing_the_journal(self):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = os.path.join(directory, 'journal')
+            with open(journal, 'a') as held:
+                # another process writing behind to the same journal
+                fcntl.flock(held, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                with self.assertLogs(self.app.logger, 'WARNING'):
+                    self.start_write_behind(journal)
+                self.assertFalse(write_behind.enabled)
+                write_behind.stop()
+
+    def test_forms_write_directly_once_the_write_behind_thread_dies(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(write_behind, 'next_batch', side_effect=RuntimeError('queue broken')):
+            self.start_write_behind(os.path.join(directory, 'journal'))
+            write_behind.thread.join(10)
+            self.assertFalse(write_behind.enabled)
+
+            self.client().post('/artists/create', data={
+                'name': 'Guns N Petals', 'city': 'San Francisco', 'state': 'CA', 'phone': '326-123-5000',
+                'genres': ['Rock n Roll'], 'facebook_link': 'https://www.facebook.com/GunsNPetals'})
+            write_behind.stop()
+
+        with self.app.app_context():
+            self.assertEqual(Artist.query.filter_by(name='Guns N Petals').count(), 1)
+
+    def test_listing_rerenders_only_edited_fragments(self):
+        self.seed(venues=1, artists=150, shows=0)
+        self.client().get('/artists')
+        self.client().post('/artists/2/edit', data={
+            'name': 'The Wild Sax Band', 'city': 'San Francisco', 'state': 'CA', 'phone': '432-325-5432',
+            'genres': ['Jazz'], 'facebook_link': 'https://www.facebook.com/sax', 'website': 'https://sax.com',
+            'seeking_venue': 'True'})
+
+        res = self.client().get('/artists')
+        stats = page_cache.stats()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'The Wild Sax Band', res.data)
+        self.assertNotIn(b'Artist 1<', res.data)
+        # the listing renders its artists in blocks of 100, only the edited one's block is rendered again
+        self.assertEqual((stats['fragment_hits'], stats['fragment_misses']), (1, 3))
+
+    def test_listing_render_time_with_fragment_cache(self):
+        rows = int(os.environ.get('TEMPLATE_BENCHMARK_ROWS', 10000))
+        areas = [{'city': 'City {}'.format(i), 'state': 'NY', 'venues': [
+            {'id': id, 'name': 'Venue {}'.format(id)} for id in range(i * 10, i * 10 + 10)]} for i in range(rows // 10)]
+        no_facets = {'genre': [], 'state': [], 'city': []}
+
+        with self.app.test_request_context('/venues'):
+            start = time.perf_counter()
+            rendered = render_template('pages/venues.html', areas=areas, filters={}, facets=no_facets)
+            uncached = time.perf_counter() - start
+            start = time.perf_counter()
+            reused = render_template('pages/venues.html', areas=areas, filters={}, facets=no_facets)
+            cached = time.perf_counter() - start
+
+        self.assertEqual(reused, rendered)
+        self.assertLess(cached, uncached)
+
+    def test_venues_page_is_cached_until_a_venue_is_created(self):
+        self.seed(venues=5, artists=1, shows=0)
+        self.client().get('/venues')
+        res, cached_count = self.count_queries('/venues')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(cached_count, 0)
+
+        self.client().post('/venues/create', data={
+            'name': 'The Musical Hop', 'city': 'San Francisco', 'state': 'CA', 'address': '1015 Folsom Street',
+            'phone': '123-123-1234', 'genres': ['Jazz'], 'facebook_link': 'https://www.facebook.com/hop',
+            'seeking_talent': 'True'})
+        res = self.client().get('/venues')
+
+        self.assertIn(b'The Musical Hop', res.data)
+        self.assertEqual(page_cache.stats()['hits'], 1)
+
+    def test_venue_page_is_invalidated_by_artist_edit(self):
+        self.seed(venues=1, artists=1, shows=3)
+        self.client().get('/venues/1')
+        self.client().post('/artists/1/edit', data={
+            'name': 'The Wild Sax Band', 'city': 'San Francisco', 'state': 'CA', 'phone': '432-325-5432',
+            'genres': ['Jazz'], 'facebook_link': 'https://www.facebook.com/sax', 'website': 'https://sax.com',
+            'seeking_venue': 'True'})
+        self.client().get('/artists/1')
+
+        res = self.client().get('/venues/1')
+
+        self.assertIn(b'The Wild Sax Band', res.data)
+
+    def test_get_cache_stats(self):
+        self.client().get('/artists')
+        self.client().get('/artists')
+        data = json.loads(self.client().get('/cache/stats').data)
+
+        self.assertEqual(data['hits'], 1)
+        self.assertEqual(data['misses'], 1)
+
+    def test_delete_venue_query_count_is_constant(self):
+        self.seed(venues=2, artists=10, shows=2)
+        res, few_shows_count = self.capture_queries('/venues/1', method='delete')
+        self.assertEqual(res.status_code, 302)
+
+        self.tearDown()
+        self.setUp()
+        self.seed(venues=2, artists=10, shows=1000)
+        res, many_shows_count = self.capture_queries('/venues/1', method='delete')
+
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(len(few_shows_count), len(many_shows_count))
+        with self.app.app_context():
+            self.assertIsNone(db.session.get(Venue, 1))
+            self.assertEqual(OutboxEvent.query.filter_by(entity='show').count(), 1)
+            self.assertEqual(Show.query.count(), 500)
+            self.assertEqual(db.session.query(db.func.sum(Artist.upcoming_shows_count + Artist.past_shows_count))
+                             .scalar(), 500)
+
+    def test_bulk_delete_artists(self):
+        self.seed(venues=2, artists=4, shows=8)
+        self.client().get('/venues/1')
+
+        res = self.client().delete('/artists', json={'ids': [1, 2, 1000]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 2)
+        with self.app.app_context():
+            self.assertEqual(Artist.query.count(), 2)
+            self.assertEqual(Show.query.count(), 4)
+            venue = db.session.get(Venue, 1)
+            self.assertEqual(venue.upcoming_shows_count + venue.past_shows_count, 2)
+        with self.app.test_request_context():
+            self.assertEqual(facets.facet_counts(Artist)['genre'], [('Jazz', 2)])
+        # the cached venue page no longer lists the deleted artists' shows
+        page = self.client().get('/venues/1').data
+        self.assertNotIn(b'href="/artists/1"', page)
+        self.assertNotIn(b'href="/artists/2"', page)
+
+    def test_500_bulk_delete_rolls_back(self):
+        self.seed(venues=2, artists=2, shows=4)
+        with mock.patch.object(db.session, 'commit', side_effect=RuntimeError('connection lost')), \
+                self.assertLogs(self.app.logger, 'ERROR'):
+            res = self.client().delete('/venues', json={'ids': [1]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(data['success'], False)
+        with self.app.app_context():
+            self.assertEqual(Venue.query.count(), 2)
+            self.assertEqual(Show.query.count(), 4)
+
+    def test_400_bulk_delete_without_ids(self):
+        res = self.client().delete('/venues', json={'ids': 'all'})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_venues_filtered_by_genre_with_facets(self):
+        self.seed(venues=3, artists=1, shows=0)
+        self.client().post('/venues/create', data={
+            'name': 'The Musical Hop', 'city': 'San Francisco', 'state': 'CA', 'address': '1015 Folsom Street',
+            'phone': '123-123-1234', 'genres': ['Jazz', 'Reggae'], 'facebook_link': 'https://www.facebook.com/hop',
+            'seeking_talent': 'True'})
+
+        res = self.client().get('/venues?genre=Reggae')
+
+        self.assertIn(b'The Musical Hop', res.data)
+        self.assertNotIn(b'Venue 1', res.data)
+        self.assertIn(b'Jazz (4)', res.data)
+        self.assertIn(b'<strong>Reggae (1)</strong>', res.data)
+        self.assertIn(b'CA (1)', res.data)
+        self.assertIn(b'San Francisco (1)', self.client().get('/venues?genre=Reggae&state=CA').data)
+
+    def test_genre_facets_follow_edits(self):
+        self.seed(venues=1, artists=2, shows=0)
+        self.client().post('/artists/1/edit', data={
+            'name': 'The Wild Sax Band', 'city': 'San Francisco', 'state': 'CA', 'phone': '432-325-5432',
+            'genres': ['Blues'], 'facebook_link': 'https://www.facebook.com/sax', 'website': 'https://sax.com',
+            'seeking_venue': 'True'})
+
+        with self.app.test_request_context():
+            counts = facets.facet_counts(Artist)
+            self.assertEqual(counts['genre'], [('Blues', 1), ('Jazz', 1)])
+            self.assertEqual(counts['state'], [('CA', 1), ('NY', 1)])
+            self.assertEqual(facets.facet_counts(Artist, genre='Jazz')['state'], [('NY', 1)])
+
+    def test_create_show_updates_summaries(self):
+        self.seed(venues=1, artists=1, shows=0)
+        start_time = datetime.utcnow() + timedelta(days=7)
+        self.client().post('/shows/create', data={
+            'artist_id': '1', 'venue_id': '1', 'start_time': start_time.strftime('%Y-%m-%d %H:%M:%S')})
+
+        with self.app.app_context():
+            venue = db.session.get(Venue, 1)
+            artist = db.session.get(Artist, 1)
+            self.assertEqual(venue.upcoming_shows_count, 1)
+            self.assertEqual(artist.upcoming_shows_count, 1)
+            self.assertEqual(venue.next_show_time, start_time.replace(microsecond=0))
+
+    def assert_documents_current(self, model, *ids):
+        with self.app.app_context():
+            built = readmodel.build(db.session, model, ids, summaries.rolled_over_at())
+            for id in ids:
+                self.assertEqual(db.session.get(DetailDocument, (model.__tablename__, id)).document, built[id])
+            return built
+
+    def test_documents_follow_writes(self):
+        self.seed(venues=1, artists=2, shows=0)
+        start_time = datetime.utcnow() + timedelta(days=7)
+        self.client().post('/shows/create', data={
+            'artist_id': '1', 'venue_id': '1', 'start_time': start_time.strftime('%Y-%m-%d %H:%M:%S')})
+        venue = self.assert_documents_current(Venue, 1)[1]
+        self.assert_documents_current(Artist, 1, 2)
+        self.assertEqual([show['artist_id'] for show in venue['upcoming_shows']], [1])
+
+        with self.app.app_context():
+            summaries.rollover(start_time + timedelta(hours=1))
+            db.session.commit()
+        venue = self.assert_documents_current(Venue, 1)[1]
+        self.assertEqual((len(venue['upcoming_shows']), venue['past_shows_count']), (0, 1))
+
+        self.client().delete('/artists/1')
+        self.assertEqual(self.assert_documents_current(Venue, 1)[1]['past_shows'], [])
+        with self.app.app_context():
+            self.assertIsNone(db.session.get(DetailDocument, ('artists', 1)))
+        res, statements = self.count_queries('/venues/1')
+        self.assertEqual((res.status_code, statements), (200, 1))
+
+    def test_rebuild_documents_command(self):
+        self.seed(venues=3, artists=4, shows=12)
+        with self.app.app_context():
+            db.session.query(DetailDocument).delete()
+            db.session.commit()
+        res, statements = self.count_queries('/artists/2')
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(statements, 1)
+
+        result = self.app.test_cli_runner().invoke(args=['rebuild-documents'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assert_documents_current(Venue, 1, 2, 3)
+        self.assert_documents_current(Artist, 1, 2, 3, 4)
+        self.assertEqual(self.count_queries('/artists/2')[1], 1)
+        self.assertEqual(self.client().get('/artists/5').status_code, 404)
+
+    def test_writes_are_recorded_in_the_outbox(self):
+        venue = {'name': 'The Musical Hop', 'city': 'San Francisco', 'state': 'CA', 'address': '1015 Folsom Street',
+                 'phone': '123-123-1234', 'genres': ['Jazz'], 'facebook_link': 'https://www.facebook.com/hop'}
+        artist = {'name': 'Guns N Petals', 'city': 'San Francisco', 'state': 'CA', 'phone': '326-123-5000',
+                  'genres': ['Rock n Roll'], 'facebook_link': 'https://www.facebook.com/GunsNPetals'}
+        self.client().post('/venues/create', data=venue)
+        self.client().post('/artists/create', data=artist)
+        self.client().post('/artists/1/edit', data=dict(artist, name='Guns N Roses'))
+        self.client().post('/shows/create', data={
+            'artist_id': '1', 'venue_id': '1', 'start_time': '2035-01-01 20:00:00'})
+        self.client().delete('/venues/1')
+
+        with self.app.app_context():
+            events = [(row.entity, row.entity_id, row.op) for row in OutboxEvent.query.order_by(OutboxEvent.id)]
+            updated = OutboxEvent.query.filter_by(op='updated').one().payload
+            shows_deleted = OutboxEvent.query.filter_by(op='venue_shows_deleted').one().payload
+        self.assertEqual(events, [('venue', 1, 'created'), ('artist', 1, 'created'), ('artist', 1, 'updated'),
+                                  ('show', 1, 'created'), ('show', None, 'venue_shows_deleted'),
+                                  ('venue', 1, 'deleted')])
+        self.assertEqual(updated['name'], 'Guns N Roses')
+        self.assertEqual(shows_deleted, {'venue_id': 1})
+
+    def test_relay_events_with_offsets_and_replay(self):
+        for i in range(5):
+            self.client().post('/artists/create', data={
+                'name': 'Artist {}'.format(i), 'city': 'Austin', 'state': 'TX', 'phone': '326-123-5000',
+                'genres': ['Jazz'], 'facebook_link': 'https://www.facebook.com/artist'})
+        runner = self.app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.jsonl')
+            queue = os.path.join(directory, 'events.db')
+
+            result = runner.invoke(args=['relay-events', path, '--batch-size', '2', '--once'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            runner.invoke(args=['relay-events', path, '--once'])
+            with open(path) as f:
+                events = [json.loads(line) for line in f]
+            self.assertEqual([event['offset'] for event in events], [1, 2, 3, 4, 5])
+            self.assertEqual(events[4]['data']['name'], 'Artist 4')
+
+            # a consumer of its own starts from the beginning, replaying moves it back
+            runner.invoke(args=['relay-events', 'sqlite:' + queue, '--consumer', 'search', '--once'])
+            runner.invoke(args=['relay-events', 'sqlite:' + queue, '--consumer', 'search', '--replay-from', '4',
+                                '--once'])
+            runner.invoke(args=['relay-events', path, '--replay-from', '4', '--once'])
+            with open(path) as f:
+                self.assertEqual([json.loads(line)['offset'] for line in f], [1, 2, 3, 4, 5, 4, 5])
+            with sqlite3.connect(queue) as connection:
+                self.assertEqual(connection.execute('SELECT offset FROM events').fetchall(),
+                                 [(1,), (2,), (3,), (4,), (5,)])
+
+        with self.app.app_context():
+            self.assertEqual({row.consumer: row.position for row in OutboxOffset.query},
+                             {'default': 5, 'search': 5})
+            self.assertEqual(outbox.prune(datetime.utcnow() + timedelta(seconds=1)), 5)
+
+    def locate_venues(self, points):
+        """Bulk insert a venue at each (latitude, longitude)."""
+        with self.app.app_context():
+            db.session.execute(Venue.__table__.insert(), [{
+                'name': 'Venue {}'.format(i), 'city': 'City', 'state': 'NY', 'address': '{} Main St'.format(i),
+                'genres': ['Jazz'], 'seeking_talent': False,
+                'latitude': lat, 'longitude': lng, 'geohash': geo.encode(lat, lng)
+            } for i, (lat, lng) in enumerate(points)])
+            db.session.commit()
+
+    def test_geohash_cells(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        cells = geo.covering_cells(40.7128, -74.0060, 5)
+        self.assertLessEqual(len(cells), geo.MAX_CELLS)
+        for lat, lng in [(40.7128, -74.0060), (40.7577, -74.0060), (40.7128, -73.9466), (40.6679, -74.0654)]:
+            self.assertTrue(any(geo.encode(lat, lng).startswith(cell) for cell in cells), (lat, lng))
+
+    def test_get_nearby_venues(self):
+        # roughly 0, 1.1, 3.3, 11 and 55 km north of the point, and one across the antimeridian
+        self.locate_venues([(40.05, -75.0), (40.0, -75.0), (40.5, -75.0), (40.01, -75.0), (40.03, -75.0),
+                            (40.1, 179.99)])
+
+        res = self.client().get('/venues/nearby', query_string={'lat': 40.0, 'lng': -75.0, 'radius': 12})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([venue['id'] for venue in data['venues']], [2, 4, 5, 1])
+        self.assertEqual(data['venues'][1]['distance_km'], 1.112)
+        data = json.loads(self.client().get('/venues/nearby', query_string={
+            'lat': 40.0, 'lng': -75.0, 'radius': 100, 'limit': 2}).data)
+        self.assertEqual([venue['id'] for venue in data['venues']], [2, 4])
+        data = json.loads(self.client().get('/venues/nearby', query_string={
+            'lat': 40.1, 'lng': -179.99, 'radius': 5}).data)
+        self.assertEqual([venue['id'] for venue in data['venues']], [6])
+
+    def test_400_nearby_venues_with_bad_location(self):
+        for args in [{}, {'lat': 40.0}, {'lat': 'north', 'lng': -75.0}, {'lat': 91, 'lng': -75.0},
+                     {'lat': 40.0, 'lng': -75.0, 'radius': 0}, {'lat': 40.0, 'lng': -75.0, 'radius': 100000},
+                     {'lat': 40.0, 'lng': -75.0, 'limit': 0}]:
+            res = self.client().get('/venues/nearby', query_string=args)
+            self.assertEqual(res.status_code, 400, args)
+
+    def test_geocode_venues_command(self):
+        self.seed(venues=4, artists=1, shows=0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'gazetteer.csv')
+            with open(path, 'w') as f:
+                f.write('city,state,latitude,longitude,address\n'
+                        'City 1,NY,40.5,-74.5,\n'
+                        'City 2,NY,41.0,-74.0,\n'
+                        'City 2,NY,41.1,-74.1,2 main st.\n'
+                        'City 3,NY,42.0,-75.0,\n')
+
+            result = self.app.test_cli_runner().invoke(args=['geocode-venues', '--gazetteer', path])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Located 3 venues, 1 not found', result.output)
+        with self.app.app_context():
+            venues = {venue.id: (venue.latitude, venue.longitude, venue.geohash) for venue in Venue.query}
+        self.assertEqual(venues[1], (None, None, None))
+        self.assertEqual(venues[2], (40.5, -74.5, geo.encode(40.5, -74.5)))
+        self.assertEqual(venues[3], (41.1, -74.1, geo.encode(41.1, -74.1)))
+
+    def test_moved_venue_forgets_its_location(self):
+        self.locate_venues([(40.0, -75.0), (40.01, -75.0)])
+        with self.app.app_context():
+            db.session.get(Venue, 1).city = 'Elsewhere'
+            db.session.get(Venue, 2).phone = '123-123-1234'
+            db.session.commit()
+
+        data = json.loads(self.client().get('/venues/nearby', query_string={'lat': 40.0, 'lng': -75.0}).data)
+
+        self.assertEqual([venue['id'] for venue in data['venues']], [2])
+
+    def test_nearby_venues_latency(self):
+        rows = int(os.environ.get('NEARBY_BENCHMARK_ROWS', 100000))
+        rng = random.Random(42)
+        # a dense city and a sparse country around it
+        self.locate_venues([(40.7 + rng.gauss(0, 0.1), -74.0 + rng.gauss(0, 0.1)) if i % 2 else
+                            (rng.uniform(25, 49), rng.uniform(-125, -67)) for i in range(rows)])
+        with self.app.app_context():
+            for lat, lng, radius in [(40.7, -74.0, 500), (40.7, -74.0, 5), (39.0, -100.0, 100)]:
+                geo.nearby(lat, lng, radius, 20)
+                start = time.perf_counter()
+                found = geo.nearby(lat, lng, radius, 20)
+                elapsed = time.perf_counter() - start
+
+                self.assertEqual(len(found), 20)
+                self.assertEqual(found, sorted(found, key=lambda pair: pair[0]))
+                self.assertLess(elapsed, 0.05, (lat, lng, radius))
+
+    def test_export_shows_csv_in_range(self):
+        self.seed(venues=4, artists=2, shows=40)
+        with self.app.app_context():
+            starts = [start_time for start_time, in db.session.query(Show.start_time).order_by(Show.start_time)]
+            expected = [str(id) for id, in db.session.query(Show.id).filter(
+                Show.start_time >= starts[10], Show.start_time < starts[30]).order_by(Show.start_time)]
+
+        res = self.client().get('/export/shows.csv', query_string={
+            'from': starts[10].isoformat(), 'to': starts[30].isoformat(), 'state': 'NY'})
+        rows = list(csv.DictReader(res.data.decode('utf-8').splitlines()))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Length', res.headers)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual([row['id'] for row in rows], expected)
+        self.assertEqual(rows[0]['venue_name'], 'Venue {}'.format(int(rows[0]['venue_id']) - 1))
+        self.assertEqual(self.client().get('/export/shows.csv', query_string={'state': 'CA'}).data,
+                         b'id,start_time,venue_id,venue_name,address,city,state,artist_id,artist_name\n')
+
+    def test_export_venues_ndjson_gzipped(self):
+        self.seed(venues=5, artists=1, shows=0)
+        res = self.client().get('/export/venues.ndjson', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        venues = [json.loads(line) for line in gzip.decompress(res.data).decode('utf-8').splitlines()]
+        self.assertEqual([venue['id'] for venue in venues], [1, 2, 3, 4, 5])
+        self.assertEqual(venues[2]['genres'], ['Jazz'])
+        self.assertEqual(self.client().get('/export/venues.xml').status_code, 404)
+        self.assertEqual(self.client().get('/export/venues.csv?from=soon').status_code, 400)
+
+    def test_export_catalog_command_writes_compressed_files(self):
+        self.seed(venues=1, artists=5, shows=0)
+        with self.app.app_context():
+            db.session.get(Artist, 2).state = 'CA'
+            db.session.commit()
+        runner = self.app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'artists.csv.gz')
+
+            result = runner.invoke(args=['export-catalog', 'artists', path, '--state', 'NY', '--batch-size', '2'])
+
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Exported 4 artists', result.output)
+            with gzip.open(path, 'rt', newline='') as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual([row['id'] for row in rows], ['1', '3', '4', '5'])
+            self.assertEqual(rows[0]['genres'], 'Jazz')
+
+            path = os.path.join(directory, 'artists.ndjson')
+            runner.invoke(args=['export-catalog', 'artists', path, '--from', '2000-01-01'])
+            with open(path) as f:
+                self.assertEqual(len(f.readlines()), 5)
+
+    def test_relay_waits_for_events_committing_late(self):
+        long_ago = datetime.utcnow() - timedelta(hours=1)
+        with self.app.app_context():
+            # event 3 belongs to a transaction that flushed long ago and hasn't committed yet
+            for id in (1, 2, 4):
+                db.session.add(OutboxEvent(id=id, entity='artist', entity_id=id, op='created', created_at=long_ago))
+            db.session.commit()
+            with tempfile.TemporaryDirectory() as directory:
+                sink = outbox.open_sink(os.path.join(directory, 'events.jsonl'))
+
+                self.assertEqual(outbox.relay_batch(sink, 'default'), 2)
+                self.assertEqual(outbox.relay_batch(sink, 'default'), 0)
+                db.session.add(OutboxEvent(id=3, entity='artist', entity_id=3, op='created', created_at=long_ago))
+                db.session.commit()
+                self.assertEqual(outbox.relay_batch(sink, 'default'), 2)
+
+                # a rolled back id is given up on once the relay has waited GAP_TIMEOUT for it
+                db.session.add(OutboxEvent(id=6, entity='artist', entity_id=6, op='created'))
+                db.session.commit()
+                self.assertEqual(outbox.relay_batch(sink, 'default'), 0)
+                db.session.get(OutboxOffset, 'default').waiting_since -= outbox.GAP_TIMEOUT
+                db.session.commit()
+                self.assertEqual(outbox.relay_batch(sink, 'default'), 1)
+                sink.close()
+            offset = db.session.get(OutboxOffset, 'default')
+            self.assertEqual((offset.position, offset.waiting_since), (6, None))
+
+    def test_create_show_rejects_double_booking(self):
+        self.seed(venues=2, artists=1, shows=0)
+        start_time = datetime(2035, 1, 1, 20, 0)
+        self.client().post('/shows/create', data={
+            'artist_id': '1', 'venue_id': '1', 'start_time': '2035-01-01 20:00:00'})
+
+        res = self.client().post('/shows/create', data={
+            'artist_id': '1', 'venue_id': '2', 'start_time': '2035-01-01 21:00:00'})
+
+        self.assertIn(b'The artist is already booked', res.data)
+        self.assertIn((start_time + SHOW_LENGTH).strftime('%Y-%m-%d %H:%M:%S').encode(), res.data)
+        with self.app.app_context():
+            self.assertEqual(Show.query.count(), 1)
+
+    def test_get_next_free_slot(self):
+        self.seed(venues=1, artists=2, shows=0)
+        with self.app.app_context():
+            db.session.add_all([Show(artist_id=1, venue_id=1, start_time=datetime(2035, 1, 1, 18, 0)),
+                                Show(artist_id=2, venue_id=1, start_time=datetime(2035, 1, 1, 21, 0))])
+            db.session.commit()
+
+        res = self.client().get('/shows/next-free-slot?artist_id=2&venue_id=1&after=2035-01-01T19:00:00')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['start_time'], '2035-01-02T00:00:00')
+
+    def test_rollover_moves_started_shows_to_past(self):
+        self.seed(venues=2, artists=2, shows=10)
+        with self.app.app_context():
+            venue_ids, artist_ids = summaries.rollover(datetime.utcnow() + 2.5 * SHOW_LENGTH)
+            db.session.commit()
+            venue = db.session.get(Venue, 1)
+
+            self.assertEqual(sorted(venue_ids), [1, 2])
+            self.assertEqual(sorted(artist_ids), [1, 2])
+            self.assertEqual((venue.past_shows_count, venue.upcoming_shows_count), (4, 1))
+
+        res = self.client().get('/venues/1')
+        self.assertIn(b'4 Past Shows', res.data)
+        self.assertIn(b'1 Upcoming Show', res.data)
+
+    def test_show_added_during_a_rollover_counts_against_its_boundary(self):
+        self.require_postgresql('needs row locks')
+        self.seed(venues=1, artists=1, shows=0)
+        now = datetime.utcnow()
+        rolled, release = threading.Event(), threading.Event()
+
+        def roll_over():
+            with self.app.app_context():
+                summaries.rollover(now + timedelta(hours=2))
+                rolled.set()
+                release.wait(10)
+                db.session.commit()
+
+        def add_show():
+            with self.app.app_context():
+                # starts between the old and the new boundary, after the rollover scanned for such shows
+                db.session.add(Show(venue_id=1, artist_id=1, start_time=now + timedelta(hours=1)))
+                db.session.commit()
+
+        rollover_thread = threading.Thread(target=roll_over)
+        rollover_thread.start()
+        self.assertTrue(rolled.wait(10))
+        insert_thread = threading.Thread(target=add_show)
+        insert_thread.start()
+        # the insert waits for the rollover instead of counting the show as upcoming
+        insert_thread.join(0.5)
+        self.assertTrue(insert_thread.is_alive())
+        release.set()
+        rollover_thread.join(10)
+        insert_thread.join(10)
+
+        with self.app.app_context():
+            venue = db.session.get(Venue, 1)
+            self.assertEqual((venue.past_shows_count, venue.upcoming_shows_count), (1, 0))
+
+    def test_import_catalog_resumes_from_checkpoint(self):
+        self.seed(venues=2, artists=2, shows=0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shows.jsonl')
+            with open(path, 'w') as f:
+                for i in range(10):
+                    f.write(json.dumps({'artist_id': i % 2 + 1, 'venue_id': i % 2 + 1,
+                                        'start_time': '2035-01-{:02d} 20:00:00'.format(i + 1)}) + '\n')
+                f.write(json.dumps({'artist_id': 1, 'venue_id': 99, 'start_time': '2035-02-01 20:00:00'}) + '\n')
+                f.write(json.dumps({'artist_id': 1, 'venue_id': 2, 'start_time': '2035-01-05 21:00:00'}) + '\n')
+            with self.app.app_context():
+                db.session.add(ImportCheckpoint(path=path, kind='shows', records=4, imported=4, rejected=0))
+                db.session.commit()
+
+            result = self.app.test_cli_runner().invoke(args=['import-catalog', 'shows', path, '--batch-size', '3'])
+
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Imported 10 shows, rejected 2', result.output)
+            with self.app.app_context():
+                self.assertEqual(ImportCheckpoint.query.count(), 0)
+            with open(path + '.rejects') as f:
+                rejects = f.read()
+                self.assertIn('Unknown artist or venue', rejects)
+                self.assertIn('already booked', rejects)
+        with self.app.app_context():
+            self.assertEqual(Show.query.count(), 6)
+            self.assertEqual(db.session.get(Venue, 1).upcoming_shows_count, 3)
+
+    def test_import_catalog_does_not_repeat_a_committed_batch(self):
+        self.seed(venues=2, artists=2, shows=0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shows.jsonl')
+            with open(path, 'w') as f:
+                for i in range(6):
+                    f.write(json.dumps({'artist_id': i % 2 + 1, 'venue_id': i % 2 + 1,
+                                        'start_time': '2035-01-{:02d} 20:00:00'.format(i + 1)}) + '\n')
+            committed = []
+
+            def crash_after_last_batch(session):
+                # killed between committing the last batch and removing the checkpoint
+                committed.append(True)
+                if len(committed) == 2:
+                    raise RuntimeError('killed')
+
+            with self.app.app_context():
+                event.listen(db.session, 'after_commit', crash_after_last_batch)
+                try:
+                    with self.assertRaises(RuntimeError):
+                        importer.import_file('shows', path, batch_size=3, progress=lambda message: None)
+                finally:
+                    event.remove(db.session, 'after_commit', crash_after_last_batch)
+                db.session.remove()
+                checkpoint = db.session.get(ImportCheckpoint, path)
+                self.assertEqual((checkpoint.records, checkpoint.imported), (6, 6))
+                self.assertEqual(Show.query.count(), 6)
+
+            result = self.app.test_cli_runner().invoke(args=['import-catalog', 'shows', path, '--batch-size', '3'])
+
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Imported 6 shows, rejected 0', result.output)
+        with self.app.app_context():
+            self.assertEqual(Show.query.count(), 6)
+
+    def test_get_api_venues_pages_with_cursor(self):
+        self.seed(venues=5, artists=1, shows=0)
+        res = self.client().get('/api/v1/venues?limit=3')
+        data = json.loads(res.data)
+        following = json.loads(self.client().get(data['next']).data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([venue['id'] for venue in data['venues']], [1, 2, 3])
+        self.assertEqual(data['venues'][0]['genres'], ['Jazz'])
+        self.assertEqual([venue['id'] for venue in following['venues']], [4, 5])
+        self.assertIsNone(following['next'])
+
+    def test_api_returns_304_for_unchanged_artist(self):
+        self.seed(venues=1, artists=1, shows=0)
+        res = self.client().get('/api/v1/artists/1')
+        etag_res = self.client().get('/api/v1/artists/1', headers={'If-None-Match': res.headers['ETag']})
+        date_res = self.client().get('/api/v1/artists/1', headers={'If-Modified-Since': res.headers['Last-Modified']})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(etag_res.status_code, 304)
+        self.assertEqual(date_res.status_code, 304)
+
+    def test_api_compresses_large_responses(self):
+        self.seed(venues=50, artists=1, shows=0)
+        res = self.client().get('/api/v1/venues', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(res.data))['venues']), 50)
+
+    def test_404_sent_requesting_missing_api_show_venue(self):
+        res = self.client().get('/api/v1/venues/1000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
+    @unittest.skipIf(asgi is None, 'ASGI mode dependencies not installed')
+    def test_asgi_serves_api_from_async_views(self):
+        self.seed(venues=2, artists=1, shows=0)
+
+        async def get(path):
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            path, _, query = path.partition('?')
+            await asgi.application({'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+                                    'headers': [(b'host', b'localhost')], 'http_version': '1.1'}, receive, send)
+            return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+        async def run():
+            try:
+                return [await get(path) for path in ('/api/v1/venues/1', '/api/v1/venues?limit=1',
+                                                     '/api/v1/venues/1000', '/venues/create')]
+            finally:
+                await asgi.application.engine.dispose()
+
+        venue, venues, missing, form = asyncio.run(run())
+
+        self.assertEqual(venue, (200, self.client().get('/api/v1/venues/1').data))
+        self.assertEqual(json.loads(venues[1])['next'], '/api/v1/venues?limit=1&after=1')
+        self.assertEqual(missing[0], 404)
+        self.assertEqual(json.loads(missing[1])['message'], 'resource not found')
+        # routes without an async view are served by the Flask app
+        self.assertEqual(form[0], 200)
+        self.assertIn(b'List a new venue', form[1])
+
+    @unittest.skipIf(asgi is None, 'ASGI mode dependencies not installed')
+    def test_asgi_serves_pages_from_async_views(self):
+        self.seed(venues=2, artists=2, shows=4)
+        with self.app.app_context():
+            # a page without a document yet is built from the tables
+            db.session.query(DetailDocument).filter_by(kind='venues', id=2).delete()
+            db.session.commit()
+        paths = ('/venues', '/venues?state=NY', '/venues/1', '/venues/2', '/venues/1000', '/artists', '/artists/1',
+                 '/shows', '/shows?per_page=2')
+        for path in paths:
+            self.assertIn(self.app.url_map.bind('localhost').match(path.partition('?')[0])[0],
+                          asgi.application.views)
+
+        async def get(path):
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            path, _, query = path.partition('?')
+            await asgi.application({'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+                                    'headers': [(b'host', b'localhost')], 'http_version': '1.1'}, receive, send)
+            return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+        async def run():
+            try:
+                return [await get(path) for path in paths]
+            finally:
+                await asgi.application.engine.dispose()
+
+        pages = asyncio.run(run())
+
+        page_cache.clear()
+        for path, page in zip(paths, pages):
+            res = self.client().get(path)
+            self.assertEqual(page, (res.status_code, res.data), path)
+
+    @unittest.skipIf(asgi is None, 'ASGI mode dependencies not installed')
+    def test_asgi_runs_flask_routes_on_a_thread_pool(self):
+        # two requests only get past the barrier together if they run on different threads
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wsgi_app(environ, start_response):
+            barrier.wait()
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [threading.current_thread().name.encode()]
+
+        application = asgi.ThreadPoolWsgiToAsgi(wsgi_app, 2)
+
+        async def get():
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            await application({'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'headers': [],
+                               'http_version': '1.1'}, receive, send)
+            return messages[0]['status'], messages[1]['body']
+
+        async def run():
+            return await asyncio.wait_for(asyncio.gather(get(), get()), 10)
+
+        try:
+            responses = asyncio.run(run())
+        finally:
+            application.executor.shutdown()
+
+        self.assertEqual([status for status, body in responses], [200, 200])
+        self.assertNotEqual(responses[0][1], responses[1][1])
+
+    def test_get_metrics(self):
+        self.seed(venues=3, artists=3, shows=10)
+        self.client().get('/venues/1')
+        self.client().get('/venues/2')
+        res = self.client().get('/metrics')
+        text = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('fyyur_requests_total{route="/venues/<int:venue_id>",method="GET",status="200"} 2', text)
+        self.assertIn('fyyur_request_duration_seconds_count{route="/venues/<int:venue_id>"} 2', text)
+        self.assertIn('fyyur_request_latency_seconds{route="/venues/<int:venue_id>",quantile="0.99"}', text)
+        self.assertIn('fyyur_db_statements_total{route="/venues/<int:venue_id>"} 2', text)
+        self.assertIn('fyyur_template_seconds_total{route="/venues/<int:venue_id>"}', text)
+
+    def test_get_slow_queries(self):
+        self.seed(venues=3, artists=3, shows=10)
+        metrics.reset()
+        # every statement counts as slow
+        metrics.slow_query_threshold = 0
+        self.addCleanup(setattr, metrics, 'slow_query_threshold', 0.1)
+        self.client().get('/venues/1')
+        data = json.loads(self.client().get('/metrics/slow-queries').data)
+
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['queries']))
+        self.assertTrue(any(query['call_site'].startswith('readmodel.py:') for query in data['queries']))
+
+    def test_slow_queries_skip_statements_under_the_threshold(self):
+        self.seed(venues=3, artists=3, shows=10)
+        metrics.reset()
+        metrics.slow_query_threshold = 60
+        self.addCleanup(setattr, metrics, 'slow_query_threshold', 0.1)
+        with self.assertNoLogs(self.app.logger, 'INFO'):
+            self.client().get('/venues/1')
+        data = json.loads(self.client().get('/metrics/slow-queries').data)
+
+        self.assertEqual(data['queries'], [])
+
+    def test_reads_go_to_replica_until_client_writes(self):
+        self.seed(venues=1, artists=1, shows=0)
+        # a second engine on the same database stands in for the replica
+        replica = create_engine(self.app.config['SQLALCHEMY_DATABASE_URI'])
+        replica_statements = []
+        event.listen(replica, 'before_cursor_execute', lambda *args: replica_statements.append(args[2]))
+        replicas.engines, replicas.primary_until = [replica], 0.0
+        try:
+            client = self.client()
+            client.get('/artists')
+            self.assertTrue(replica_statements)
+
+            res = client.post('/artists/1/edit', data={
+                'name': 'The Wild Sax Band', 'city': 'San Francisco', 'state': 'CA', 'phone': '432-325-5432',
+                'genres': ['Jazz'], 'facebook_link': 'https://www.facebook.com/sax', 'website': 'https://sax.com',
+                'seeking_venue': 'True'})
+            self.assertIn(PRIMARY_COOKIE, res.headers['Set-Cookie'])
+            # as if the write had been served by another process
+            replicas.primary_until = 0.0
+            del replica_statements[:]
+            res = client.get('/artists/1')
+            self.assertIn(b'The Wild Sax Band', res.data)
+            self.assertEqual(replica_statements, [])
+
+            self.client().get('/venues/1')
+            self.assertTrue(replica_statements)
+        finally:
+            replicas.engines = []
+            replica.dispose()
+
+    def test_pages_are_not_cached_while_replicas_may_lag(self):
+        self.seed(venues=5, artists=1, shows=0)
+        page_cache.hold = 0.5
+        self.addCleanup(setattr, page_cache, 'hold', 0)
+        self.client().post('/venues/create', data={
+            'name': 'The Musical Hop', 'city': 'San Francisco', 'state': 'CA', 'address': '1015 Folsom Street',
+            'phone': '123-123-1234', 'genres': ['Jazz'], 'facebook_link': 'https://www.facebook.com/hop',
+            'seeking_talent': 'True'})
+
+        # another process, reading a replica that may not have the new venue yet, renders but doesn't store
+        self.client().get('/venues')
+        self.client().get('/venues')
+        stats = page_cache.stats()
+        self.assertEqual((stats['hits'], stats['fragment_hits']), (0, 0))
+
+        time.sleep(0.6)
+        self.client().get('/venues')
+        self.client().get('/venues')
+        self.assertEqual(page_cache.stats()['hits'], 1)
+
+    @unittest.skipIf(asgi is None, 'ASGI mode dependencies not installed')
+    def test_asgi_reads_go_to_replica_until_client_writes(self):
+        self.seed(venues=1, artists=1, shows=0)
+        page_cache.clear()
+        replica = asgi.create_async_engine(asgi.async_url(self.app.config['SQLALCHEMY_DATABASE_URI']))
+        replica_statements = []
+        event.listen(replica.sync_engine, 'before_cursor_execute', lambda *args: replica_statements.append(args[2]))
+        asgi.application.replica_engines, replicas.primary_until = [replica], 0.0
+
+        async def get(path, cookie=None):
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            headers = [(b'host', b'localhost')] + ([(b'cookie', cookie.encode())] if cookie else [])
+            await asgi.application({'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'',
+                                    'headers': headers, 'http_version': '1.1'}, receive, send)
+            return messages[0]['status']
+
+        async def run():
+            try:
+                statuses = [await get('/venues/1')]
+                read_replica = bool(replica_statements)
+                del replica_statements[:]
+                # a client that has just written reads its own changes from the primary
+                statuses.append(await get('/artists/1', '{}={}'.format(PRIMARY_COOKIE, time.time() + 60)))
+                return statuses, read_replica
+            finally:
+                asgi.application.replica_engines = []
+                await replica.dispose()
+                await asgi.application.engine.dispose()
+
+        statuses, read_replica = asyncio.run(run())
+
+        self.assertEqual(statuses, [200, 200])
+        self.assertTrue(read_replica)
+        self.assertEqual(replica_statements, [])
+
+    def test_404_sent_requesting_missing_venue(self):
+        res = self.client().get('/venues/1000')
+
+        self.assertEqual(res.status_code, 404)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,298 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from flask import jsonify, request
+from sqlalchemy import exc
+from werkzeug.datastructures import MultiDict
+
+try:
+    import fcntl
+except ImportError:  # no advisory file locks on this platform
+    fcntl = None
+
+from cache import page_cache
+from models import db, Submission
+
+# ----------------------------------------------------------------------------#
+# Write-behind queue for the create and edit forms.
+#
+# With WRITE_BEHIND on, a submitted form is appended to a local journal
+# (fsynced) and acknowledged at once with a ticket; a background thread
+# writes the queued submissions in one transaction per batch, once
+# WRITE_BEHIND_BATCH_SIZE of them are waiting or the oldest has waited
+# WRITE_BEHIND_INTERVAL seconds. The transaction also records every ticket in
+# the submissions table, which /submissions?id= reads to tell the user whether
+# their listing landed, and which makes replaying the journal after a crash
+# skip what was already written. A submission that fails is retried alone so
+# it doesn't take the rest of its batch down with it.
+# ----------------------------------------------------------------------------#
+
+# seconds to wait before retrying a batch while the database is unreachable
+RETRY_DELAY = 1.0
+
+# tries at a batch failing for another reason before its submissions are given up on
+MAX_ATTEMPTS = 3
+
+
+class WriteBehind:
+    def __init__(self, app=None):
+        self.writers = {}  # name -> (writer, form class, url of the written row)
+        self.enabled = False
+        self.pending = deque()  # (queued at, submission)
+        self.in_flight = set()  # ids of the batch being written
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.journal = None
+        self.thread = None
+        self.stopping = False
+        self.errors = {}  # id -> error of the submissions given up on without recording them in the table
+        self.counts = {'submitted': 0, 'written': 0, 'failed': 0, 'batches': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('WRITE_BEHIND', False)
+        app.config.setdefault('WRITE_BEHIND_JOURNAL', os.path.join(app.root_path, 'write_behind.journal'))
+        app.config.setdefault('WRITE_BEHIND_BATCH_SIZE', 100)
+        app.config.setdefault('WRITE_BEHIND_INTERVAL', 0.5)
+        app.add_url_rule('/submissions', 'submissions', self.status_view)
+        app.extensions['write_behind'] = self
+        if app.config['WRITE_BEHIND']:
+            self.start(app)
+
+    def writer(self, form_class, url=None):
+        """Register a view's write, writer(form, **args) -> (id of the written row, page cache tags), as one the
+        queue can run later on the submitted form; url formats the id into the page of the written row."""
+        def decorator(writer):
+            self.writers[writer.__name__] = (writer, form_class, url)
+            return writer
+        return decorator
+
+    #  Queue
+    #  ----------------------------------------------------------------
+
+    def start(self, app, journal=None):
+        """Open the journal, queue what it holds from a previous run and start writing in the background.
+
+        Another process holding the journal leaves the queue off, so this process writes synchronously.
+        """
+        path = journal or app.config['WRITE_BEHIND_JOURNAL']
+        self.journal = open(path, 'a+', encoding='utf-8')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                app.logger.warning('write-behind journal %s is in use, writing synchronously', path)
+                self.journal.close()
+                self.journal = None
+                return
+        self.batch_size = app.config['WRITE_BEHIND_BATCH_SIZE']
+        self.interval = app.config['WRITE_BEHIND_INTERVAL']
+        self.stopping = False
+        self.replay()
+        self.enabled = True
+        self.thread = threading.Thread(target=self.run, args=(app,), name='write-behind', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background writer; what is still queued stays in the journal for the next start()."""
+        with self.lock:
+            self.enabled = False
+            self.stopping = True
+            self.wakeup.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self.pending.clear()
+            # None when start() found the journal locked by another process, or was never called
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    def replay(self):
+        self.journal.seek(0)
+        for line in self.journal:
+            try:
+                submission = json.loads(line)
+            except ValueError:  # torn last line of a crash mid-append, never acknowledged
+                continue
+            self.pending.append((time.monotonic(), submission))
+
+    def submit(self, writer, **args):
+        """Journal the form of the current request for writer(form, **args) and queue it. Returns its ticket."""
+        submission = {
+            'id': uuid.uuid4().hex,
+            'writer': writer.__name__,
+            'form': request.form.to_dict(flat=False),
+            'args': args,
+        }
+        line = json.dumps(submission) + '\n'
+        with self.lock:
+            self.journal.write(line)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.pending.append((time.monotonic(), submission))
+            self.counts['submitted'] += 1
+            if len(self.pending) >= self.batch_size:
+                self.wakeup.notify()
+        return submission['id']
+
+    def next_batch(self, wait=True):
+        with self.lock:
+            while wait and not self.stopping and (not self.pending or (
+                    len(self.pending) < self.batch_size and time.monotonic() < self.pending[0][0] + self.interval)):
+                self.wakeup.wait(self.pending[0][0] + self.interval - time.monotonic() if self.pending else None)
+            if self.stopping:
+                return []
+            batch = [self.pending.popleft()[1] for _ in range(min(self.batch_size, len(self.pending)))]
+            self.in_flight.update(submission['id'] for submission in batch)
+            return batch
+
+    def run(self, app):
+        try:
+            while True:
+                batch = self.next_batch()
+                if not batch:
+                    return
+                with app.app_context():
+                    try:
+                        self.write_batch(batch)
+                    except Exception as e:
+                        app.logger.exception('write-behind batch of %d submissions failed', len(batch))
+                        self.retry(batch, e)
+        except Exception:
+            app.logger.exception('write-behind writer failed')
+        finally:
+            with self.lock:
+                if not self.stopping:
+                    # the forms write synchronously from now on; the journal is written on the next start
+                    app.logger.error('write-behind writer stopped, writing synchronously')
+                    self.enabled = False
+
+    def retry(self, batch, error):
+        """Queue a batch that failed unexpectedly again, giving up on the submissions tried MAX_ATTEMPTS times."""
+        with self.lock:
+            again = []
+            for submission in batch:
+                submission['attempts'] = submission.get('attempts', 0) + 1
+                if submission['attempts'] < MAX_ATTEMPTS:
+                    again.append(submission)
+                else:
+                    self.errors[submission['id']] = error_message(error)
+                    self.counts['failed'] += 1
+            self.pending.extendleft((time.monotonic(), submission) for submission in reversed(again))
+            self.in_flight.difference_update(submission['id'] for submission in batch)
+        time.sleep(RETRY_DELAY)
+
+    def flush(self):
+        """Write everything queued now, in the calling thread (which needs an app context)."""
+        while True:
+            batch = self.next_batch(wait=False)
+            if not batch:
+                return
+            self.write_batch(batch)
+
+    #  Writing
+    #  ----------------------------------------------------------------
+
+    def apply(self, submission):
+        writer, form_class, url = self.writers[submission['writer']]
+        formdata = MultiDict([(name, value) for name, values in submission['form'].items() for value in values])
+        form = form_class(formdata=formdata, meta={'csrf': False})
+        result_id, tags = writer(form, **submission['args'])
+        db.session.add(Submission(id=submission['id'], writer=submission['writer'], result_id=result_id))
+        return tags
+
+    def write_batch(self, batch):
+        # todo is the whole batch until the lookup below drops the submissions written before
+        tags, failed, todo = [], 0, batch
+        try:
+            written = {id for id, in db.session.query(Submission.id)
+                       .filter(Submission.id.in_([submission['id'] for submission in batch]))}
+            todo = [submission for submission in batch if submission['id'] not in written]
+            for submission in todo:
+                tags += self.apply(submission)
+            db.session.commit()
+        except exc.OperationalError:
+            # the database is unreachable: keep the batch, in order, for another try
+            db.session.rollback()
+            db.session.remove()
+            with self.lock:
+                self.pending.extendleft((time.monotonic(), submission) for submission in reversed(batch))
+                self.in_flight.difference_update(submission['id'] for submission in batch)
+            time.sleep(RETRY_DELAY)
+            return
+        except Exception:
+            # one of them is bad: write each on its own, so only the bad ones fail
+            db.session.rollback()
+            tags = []
+            for submission in todo:
+                try:
+                    submission_tags = self.apply(submission)
+                    db.session.commit()
+                    tags += submission_tags
+                except Exception as e:
+                    db.session.rollback()
+                    db.session.add(Submission(id=submission['id'], writer=submission['writer'],
+                                              error=error_message(e)))
+                    db.session.commit()
+                    failed += 1
+        finally:
+            db.session.remove()
+            page_cache.invalidate(*set(tags))
+
+        with self.lock:
+            self.counts['batches'] += 1
+            self.counts['written'] += len(todo) - failed
+            self.counts['failed'] += failed
+            self.in_flight.difference_update(submission['id'] for submission in batch)
+            if not self.pending and not self.in_flight:
+                # every journaled submission is in the submissions table now
+                self.journal.truncate(0)
+                self.journal.flush()
+
+    #  Status
+    #  ----------------------------------------------------------------
+
+    def statuses(self, ids):
+        with self.lock:
+            queued = {submission['id'] for _, submission in self.pending} | self.in_flight
+        rows = {row.id: row for row in Submission.query.filter(Submission.id.in_(ids))} if ids else {}
+        statuses = []
+        for id in ids:
+            row = rows.get(id)
+            if row is None and id in self.errors:
+                statuses.append({'id': id, 'status': 'failed', 'error': self.errors[id], 'written_at': None})
+            elif row is None:
+                statuses.append({'id': id, 'status': 'pending' if id in queued else 'unknown'})
+            elif row.error is not None:
+                statuses.append({'id': id, 'status': 'failed', 'error': row.error,
+                                 'written_at': row.written_at.isoformat()})
+            else:
+                url = self.writers[row.writer][2] if row.writer in self.writers else None
+                statuses.append({'id': id, 'status': 'written', 'result_id': row.result_id,
+                                 'url': url.format(row.result_id) if url else None,
+                                 'written_at': row.written_at.isoformat()})
+        return statuses
+
+    def status_view(self):
+        # ?id= (repeatable) the tickets handed out on submission; without one, just the state of the queue
+        with self.lock:
+            queue = dict(self.counts, enabled=self.enabled, pending=len(self.pending) + len(self.in_flight))
+        return jsonify({
+            'success': True,
+            'queue': queue,
+            'submissions': self.statuses(request.args.getlist('id')),
+        })
+
+
+def error_message(error):
+    return (str(getattr(error, 'orig', error)).splitlines() or [type(error).__name__])[0][:500]
+
+
+write_behind = WriteBehind()